@@ -5,7 +5,88 @@ import subprocess
 from pathlib import Path
 import time
 import pandas as pd
+import numpy as np
 import shutil
+import instrumentation
+from lineage_cache import LineageCache, hash_fasta, write_fasta_subset, \
+    split_cached, merge_cached, assign_unique
+import json
+import hashlib
+import urllib.request
+from functools import lru_cache
+from contextlib import ExitStack
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+
+
+NEXTCLADE_DTYPES = {'seqName': str,
+                    'clade': 'category',
+                    'qc.overallStatus': 'category',
+                    'errors': str,
+                    'totalGaps': 'Int64',
+                    'totalInsertions': 'Int64',
+                    'totalMissing': 'Int64',
+                    'totalMutations': 'Int64',
+                    'totalNonACGTNs': 'Int64',
+                    'totalPcrPrimerChanges': 'Int64',
+                    'substitutions': str,
+                    'deletions': str,
+                    'insertions': str,
+                    'missing': str,
+                    'nonACGTNs': str,
+                    'pcrPrimerChanges': str,
+                    'aaSubstitutions': str,
+                    'totalAminoacidSubstitutions': 'Int64',
+                    'aaDeletions': str,
+                    'totalAminoacidDeletions': 'Int64',
+                    'alignmentStart': 'Int64',
+                    'alignmentEnd': 'Int64',
+                    'alignmentScore': 'Int64'}
+
+NEXTCLADE_RENAME = {'seqName': 'isolate',
+                    'clade': 'nextstrain_clade',
+                    'qc.overallStatus': 'nextclade_qc',
+                    'errors': 'nextclade_errors'}
+
+PANGOLIN_DTYPES = {'taxon': str,
+                   'lineage': 'category',
+                   'conflict': float,
+                   'status': 'category',
+                   'note': str}
+
+PANGOLIN_RENAME = {'taxon': 'isolate',
+                   'lineage': 'pangolin_lineage',
+                   'status': 'pangolin_qc',
+                   'note': 'pangolin_note',
+                   'conflict': 'pangolin_lineage_conflicts'}
+
+# types of every column after renaming, versions are repeated on every row
+# so are stored as categories
+ASSIGNMENT_DTYPES = {**{NEXTCLADE_RENAME.get(col, col): dtype
+                        for col, dtype in NEXTCLADE_DTYPES.items()},
+                     **{PANGOLIN_RENAME.get(col, col): dtype
+                        for col, dtype in PANGOLIN_DTYPES.items()},
+                     'pangolin_version': 'category',
+                     'pangoLEARN_version': 'category',
+                     'nextclade_version': 'category'}
+ASSIGNMENT_DTYPES['isolate'] = str
+
+OUTPUT_COLUMNS = ['isolate', 'pangolin_lineage',
+                  'pangolin_lineage_conflicts', 'pangolin_note',
+                  'pangolin_qc', 'nextstrain_clade',
+                  'nextclade_qc', 'nextclade_errors',
+                  'totalGaps', 'totalInsertions', 'totalMissing',
+                  'totalMutations', 'totalNonACGTNs',
+                  'totalPcrPrimerChanges',
+                  'substitutions', 'deletions', 'insertions',
+                  'missing', 'nonACGTNs',
+                  'pcrPrimerChanges', 'aaSubstitutions',
+                  'totalAminoacidSubstitutions',
+                  'aaDeletions', 'totalAminoacidDeletions',
+                  'alignmentStart', 'alignmentEnd', 'alignmentScore',
+                  'pangolin_version',
+                  'pangoLEARN_version', 'nextclade_version']
 
 
 def check_file(path: str) -> Path:
@@ -19,18 +100,112 @@ def check_file(path: str) -> Path:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
 
+@lru_cache(maxsize=None)
+def get_tool_versions():
+    """
+    Get installed nextclade, pangolin and pangoLEARN versions, the version
+    commands are run concurrently and cached for the rest of the process
+    """
+    commands = {'nextclade_version': "nextclade --version",
+                'pangolin_version': "pangolin --version",
+                'pangoLEARN_version': "pangolin --pangoLEARN-version"}
+    processes = {tool: subprocess.Popen(command.split(),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+                 for tool, command in commands.items()}
+    versions = {}
+    for tool, process in processes.items():
+        stdout, _ = process.communicate()
+        versions[tool] = stdout.decode('utf-8').strip()
+    return versions
+
+
+# seconds to wait for a release check and for an update to install
+CHECK_TIMEOUT = 10
+UPDATE_TIMEOUT = 600
+
+
+def latest_github_release(repo):
+    """
+    Get the tag of the latest release for a github repository, None if it
+    can't be checked (e.g., no network access)
+    """
+    url = f"https://api.github.com/repos/{repo}/releases/latest"
+    try:
+        with urllib.request.urlopen(url, timeout=CHECK_TIMEOUT) as response:
+            return json.load(response)['tag_name'].lstrip('v')
+    except Exception:
+        return None
+
+
+def latest_npm_version(package):
+    """
+    Get the latest published version of an npm package, None if it can't
+    be checked
+    """
+    try:
+        latest = subprocess.run(["npm", "view", package, "version"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                timeout=CHECK_TIMEOUT)
+    except (subprocess.TimeoutExpired, OSError):
+        return None
+    latest = latest.stdout.decode('utf-8').strip()
+    return latest if latest else None
+
+
+def run_update(tool, command):
+    """
+    Run an update command, returns False (keeping the installed version) if
+    it fails or doesn't finish in time
+    """
+    try:
+        subprocess.run(command, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, timeout=UPDATE_TIMEOUT,
+                       check=True)
+    except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as error:
+        sys.stderr.write(f"Updating {tool} failed, using the installed "
+                         f"version: {error}\n")
+        return False
+    return True
+
+
 def update_pangolin():
     """
-    Ensure pangolin is updated to the latest release
+    Ensure pangolin is updated to the latest release, skipping the update
+    if the installed pangolin and pangoLEARN already match the latest or
+    the latest can't be checked, returns whether it was updated
     """
-    subprocess.check_output(["pangolin", "--update"])
+    versions = get_tool_versions()
+    latest_pangolin = latest_github_release('cov-lineages/pangolin')
+    latest_pangolearn = latest_github_release('cov-lineages/pangoLEARN')
+    if latest_pangolin is None or latest_pangolearn is None:
+        sys.stderr.write("Couldn't check the latest pangolin release, "
+                         "skipping the update\n")
+        return False
+    if versions['pangolin_version'].split()[-1:] == [latest_pangolin] and \
+            versions['pangoLEARN_version'].split()[-1:] == \
+            [latest_pangolearn]:
+        return False
+    return run_update('pangolin', ["pangolin", "--update"])
 
 
 def update_nextclade():
     """
-    Ensure nextclade is updated to the latest release
+    Ensure nextclade is updated to the latest release, skipping the update
+    if the installed version already matches the latest or the latest can't
+    be checked, returns whether it was updated
     """
-    subprocess.check_output(["npm", "install", "-g", "@neherlab/nextclade"])
+    versions = get_tool_versions()
+    latest = latest_npm_version("@neherlab/nextclade")
+    if latest is None:
+        sys.stderr.write("Couldn't check the latest nextclade release, "
+                         "skipping the update\n")
+        return False
+    if versions['nextclade_version'] == latest:
+        return False
+    return run_update('nextclade',
+                      ["npm", "install", "-g", "@neherlab/nextclade"])
 
 
 def run_nextclade(input_genomes, threads):
@@ -44,22 +219,18 @@ def run_nextclade(input_genomes, threads):
     if not output_file.exists():
         raise FileNotFoundError(f"{str(output_file)} not created, check "
                                  "nextclade install")
-    nextclade_df = pd.read_csv(str(output_file), sep=";")
+    # only read the reported columns with fixed types
+    nextclade_df = pd.read_csv(str(output_file), sep=";",
+                               usecols=lambda col: col in NEXTCLADE_DTYPES,
+                               dtype=NEXTCLADE_DTYPES)
 
     # get version information
-    nextclade_version = subprocess.run(f"nextclade --version".split(),
-                                       stdout=subprocess.PIPE)
-    nextclade_version = nextclade_version.stdout.decode('utf-8').strip()
-    nextclade_df['nextclade_version'] = f"nextclade {nextclade_version}"
+    nextclade_version = get_tool_versions()['nextclade_version']
+    nextclade_df['nextclade_version'] = \
+        pd.Categorical([f"nextclade {nextclade_version}"] * len(nextclade_df))
 
     # tidy up dataframe
-    nextclade_df = nextclade_df.rename(columns={'seqName': 'isolate',
-                                          'clade': 'nextstrain_clade',
-                                          'qc.overallStatus': 'nextclade_qc',
-                                          'errors': 'nextclade_errors'})
-    nextclade_df = nextclade_df.drop([qc_col for qc_col in \
-                                        nextclade_df.columns \
-                                        if qc_col.startswith('qc.')], axis=1)
+    nextclade_df = nextclade_df.rename(columns=NEXTCLADE_RENAME)
 
     output_file.unlink()
 
@@ -80,25 +251,19 @@ def run_pangolin(input_genomes, threads):
         raise FileNotFoundError(f"{str(output_path)} not created, check "
                                  "pangolin install")
 
-    pangolin_df = pd.read_csv(str(output_path), sep=',')
+    pangolin_df = pd.read_csv(str(output_path), sep=',',
+                              usecols=lambda col: col in PANGOLIN_DTYPES,
+                              dtype=PANGOLIN_DTYPES)
 
     # get version information for pangolin, pangolearn model, and lineages
-    pangolearn_version = subprocess.run("pangolin --pangoLEARN-version".split(),
-                                        stdout=subprocess.PIPE)
-    pangolearn_version = pangolearn_version.stdout.decode('utf-8').strip()
-    pangolin_df['pangoLEARN_version'] = pangolearn_version
-
-    pangolin_version = subprocess.run("pangolin --version".split(),
-                                      stdout=subprocess.PIPE)
-    pangolin_version = pangolin_version.stdout.decode('utf-8').strip()
-    pangolin_df['pangolin_version'] = pangolin_version
+    versions = get_tool_versions()
+    pangolin_df['pangoLEARN_version'] = \
+        pd.Categorical([versions['pangoLEARN_version']] * len(pangolin_df))
+    pangolin_df['pangolin_version'] = \
+        pd.Categorical([versions['pangolin_version']] * len(pangolin_df))
 
     # tidy up the dataframe
-    pangolin_df = pangolin_df.rename(columns={'taxon': 'isolate',
-                                        'lineage': 'pangolin_lineage',
-                                        'status': 'pangolin_qc',
-                                        'note': 'pangolin_note',
-                                        'conflict': 'pangolin_lineage_conflicts'})
+    pangolin_df = pangolin_df.rename(columns=PANGOLIN_RENAME)
 
     # remove temp output
     shutil.rmtree(output_dir)
@@ -106,28 +271,395 @@ def run_pangolin(input_genomes, threads):
     return pangolin_df
 
 
-def collate_output(nextclade, pangolin, output):
+def set_dtypes(df, dtypes):
     """
-    Merge and tidy lineage assignments
+    Cast columns to the collated output types, needed for assignments that
+    were re-read from shard tables or the cache
     """
-    merged_df = pangolin.merge(nextclade, on='isolate', how='outer')
+    df = df.copy()
+    df['isolate'] = df['isolate'].astype(str)
+    for col, dtype in dtypes.items():
+        # string columns are left as objects so missing values stay NaN
+        if col not in df.columns or dtype is str:
+            continue
+        if df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
 
-    merged_df = merged_df[['isolate', 'pangolin_lineage',
-                           'pangolin_lineage_conflicts', 'pangolin_note',
-                           'pangolin_qc', 'nextstrain_clade',
-                           'nextclade_qc', 'nextclade_errors',
-                           'totalGaps', 'totalInsertions', 'totalMissing',
-                           'totalMutations', 'totalNonACGTNs',
-                           'totalPcrPrimerChanges',
-                           'substitutions', 'deletions', 'insertions',
-                           'missing', 'nonACGTNs',
-                           'pcrPrimerChanges', 'aaSubstitutions',
-                           'totalAminoacidSubstitutions',
-                           'aaDeletions', 'totalAminoacidDeletions',
-                           'alignmentStart', 'alignmentEnd', 'alignmentScore',
-                           'pangolin_version',
-                           'pangoLEARN_version', 'nextclade_version']]
-    merged_df.to_csv(output, sep='\t', index=False)
+
+def merged_chunks(nextclade, pangolin, chunksize):
+    """
+    Outer join pangolin and nextclade on the sorted isolate key a chunk of
+    isolates at a time
+    """
+    pangolin = pangolin.sort_values('isolate', ignore_index=True)
+    nextclade = nextclade.sort_values('isolate', ignore_index=True)
+    pangolin_keys = pangolin['isolate'].to_numpy()
+    nextclade_keys = nextclade['isolate'].to_numpy()
+    keys = np.union1d(pangolin_keys, nextclade_keys)
+
+    for start in range(0, len(keys), chunksize):
+        first = keys[start]
+        last = keys[min(start + chunksize, len(keys)) - 1]
+        pangolin_chunk = pangolin.iloc[
+            np.searchsorted(pangolin_keys, first, side='left'):
+            np.searchsorted(pangolin_keys, last, side='right')]
+        nextclade_chunk = nextclade.iloc[
+            np.searchsorted(nextclade_keys, first, side='left'):
+            np.searchsorted(nextclade_keys, last, side='right')]
+        merged_chunk = pangolin_chunk.merge(nextclade_chunk, on='isolate',
+                                            how='outer')
+        yield merged_chunk[OUTPUT_COLUMNS]
+
+
+def parquet_schema(df):
+    """
+    Build an explicit parquet schema so every chunk is written with the
+    same types even if a column is empty in the first chunk
+    """
+    import pyarrow as pa
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            fields.append(pa.field(col, pa.dictionary(pa.int32(),
+                                                      pa.string())))
+        elif pd.api.types.is_integer_dtype(dtype):
+            fields.append(pa.field(col, pa.int64()))
+        elif pd.api.types.is_float_dtype(dtype):
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def collate_output(nextclade, pangolin, output, chunksize=100000):
+    """
+    Merge and tidy lineage assignments, written as parquet if the output
+    ends in .parquet otherwise as a tsv
+    """
+    nextclade = set_dtypes(nextclade, ASSIGNMENT_DTYPES)
+    pangolin = set_dtypes(pangolin, ASSIGNMENT_DTYPES)
+
+    if str(output).endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        for chunk in merged_chunks(nextclade, pangolin, chunksize):
+            if writer is None:
+                schema = parquet_schema(chunk)
+                writer = pq.ParquetWriter(str(output), schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema,
+                                                    preserve_index=False))
+        if writer is not None:
+            writer.close()
+    else:
+        header = True
+        with open(output, 'w') as out_fh:
+            for chunk in merged_chunks(nextclade, pangolin, chunksize):
+                chunk.to_csv(out_fh, sep='\t', index=False, header=header)
+                header = False
+            if header:
+                out_fh.write("\t".join(OUTPUT_COLUMNS) + "\n")
+
+
+def update_tools(parallel):
+    """
+    Update pangolin and nextclade, at the same time if running in parallel
+    """
+    # warm the version cache before both updates need it
+    get_tool_versions()
+    if parallel:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            updates = [executor.submit(update_pangolin),
+                       executor.submit(update_nextclade)]
+            updated = [update.result() for update in updates]
+    else:
+        updated = [update_pangolin(), update_nextclade()]
+    # versions are only re-read once both updates have finished
+    if any(updated):
+        get_tool_versions.cache_clear()
+
+
+def assign_serial(input_genomes, threads):
+    """
+    Run pangolin then nextclade each with all the threads
+    """
+    pangolin = run_pangolin(input_genomes, threads)
+    nextclade = run_nextclade(input_genomes, threads)
+    return nextclade, pangolin
+
+
+def assign_parallel(input_genomes, threads, nextclade_threads=None):
+    """
+    Run pangolin and nextclade at the same time splitting the threads
+    between them (evenly by default)
+    """
+    if nextclade_threads is None:
+        nextclade_threads = max(1, threads // 2)
+    pangolin_threads = max(1, threads - nextclade_threads)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pangolin = executor.submit(run_pangolin, input_genomes,
+                                   pangolin_threads)
+        nextclade = executor.submit(run_nextclade, input_genomes,
+                                    nextclade_threads)
+        return nextclade.result(), pangolin.result()
+
+
+DEFAULT_JOB_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name={name}
+#SBATCH --cpus-per-task={threads}
+#SBATCH --output={name}.log
+{command}
+"""
+
+
+def split_fasta(input_genomes, shards, shard_dir):
+    """
+    Split a fasta into a number of shards with whole records in each,
+    existing shards are kept if they were split from the same set of records
+    (in any order or line wrapping, e.g., a rewritten uncached subset) so a
+    resumed run uses the same split
+    """
+    record_hashes = []
+    record_hash = None
+    with open(input_genomes, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if record_hash is not None:
+                    record_hashes.append(record_hash.hexdigest())
+                record_hash = hashlib.md5(line.strip() + b'\n')
+            elif record_hash is not None:
+                record_hash.update(line.strip())
+            elif line.strip():
+                raise ValueError(f"{input_genomes} has sequence before its "
+                                 "first fasta header")
+    if record_hash is not None:
+        record_hashes.append(record_hash.hexdigest())
+    record_count = len(record_hashes)
+    input_hash = hashlib.md5("\n".join(sorted(record_hashes)).encode('utf-8'))
+    if record_count == 0:
+        raise ValueError(f"{input_genomes} contains no fasta records")
+    shards = min(shards, record_count)
+    records_per_shard = -(-record_count // shards)
+
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    shard_paths = [shard_dir / f"shard_{ix:04d}.fasta" for ix in range(shards)]
+    manifest_path = shard_dir / "manifest.json"
+    manifest = {'records_md5': input_hash.hexdigest(), 'shards': shards}
+    if manifest_path.exists() and \
+            json.loads(manifest_path.read_text()) == manifest and \
+            all(shard_path.exists() for shard_path in shard_paths):
+        return shard_paths
+
+    # stale shards from a different input must not be reused
+    manifest_path.unlink(missing_ok=True)
+    for stale in shard_dir.glob("shard_*"):
+        stale.unlink()
+
+    with ExitStack() as stack:
+        shard_handles = [stack.enter_context(open(str(shard_path) + ".tmp",
+                                                  'wb'))
+                         for shard_path in shard_paths]
+        record_ix = -1
+        with open(input_genomes, 'rb') as fh:
+            for line in fh:
+                if line.startswith(b'>'):
+                    record_ix += 1
+                elif record_ix < 0:
+                    # only blank lines can come before the first header
+                    continue
+                shard_handles[record_ix // records_per_shard].write(line)
+    for shard_path in shard_paths:
+        Path(str(shard_path) + ".tmp").rename(shard_path)
+    manifest_path.write_text(json.dumps(manifest))
+    return shard_paths
+
+
+def shard_outputs(shard_path):
+    """
+    Paths of the nextclade and pangolin tables for a shard
+    """
+    shard_path = Path(shard_path)
+    return (shard_path.with_suffix(".nextclade.tsv"),
+            shard_path.with_suffix(".pangolin.tsv"))
+
+
+def shard_complete(shard_path):
+    """
+    Check if a shard has already been assigned
+    """
+    return all(output.exists() for output in shard_outputs(shard_path))
+
+
+def assign_shard(shard_path, threads):
+    """
+    Run nextclade and pangolin on a single shard and save their tables,
+    outputs are only moved into place once written so a failed shard is
+    rerun on resume
+    """
+    nextclade_path, pangolin_path = shard_outputs(shard_path)
+    if not nextclade_path.exists():
+        nextclade = run_nextclade(shard_path, threads)
+        nextclade.to_csv(str(nextclade_path) + ".tmp", sep='\t', index=False)
+        Path(str(nextclade_path) + ".tmp").rename(nextclade_path)
+    if not pangolin_path.exists():
+        pangolin = run_pangolin(shard_path, threads)
+        pangolin.to_csv(str(pangolin_path) + ".tmp", sep='\t', index=False)
+        Path(str(pangolin_path) + ".tmp").rename(pangolin_path)
+    return shard_path
+
+
+def run_shards_local(shard_paths, threads, workers):
+    """
+    Assign shards using a local process pool, failed shards are reported
+    but don't stop the other shards
+    """
+    threads_per_shard = max(1, threads // workers)
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(assign_shard, shard_path,
+                                   threads_per_shard): shard_path
+                   for shard_path in shard_paths}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                print(f"{futures[future]} failed: {error}")
+                failed.append(futures[future])
+    return failed
+
+
+def write_shard_jobs(shard_paths, threads, job_template):
+    """
+    Write a batch scheduler job script for each shard from a template with
+    {name}, {threads}, and {command} fields
+    """
+    if job_template is None:
+        template = DEFAULT_JOB_TEMPLATE
+    else:
+        template = Path(job_template).read_text()
+
+    job_scripts = []
+    for shard_path in shard_paths:
+        command = f"python {Path(__file__).resolve()} --run_shard " \
+                  f"--input_genomes {shard_path.resolve()} " \
+                  f"--threads {threads}"
+        job_script = shard_path.with_suffix(".job.sh")
+        job_script.write_text(template.format(name=shard_path.stem,
+                                              threads=threads,
+                                              command=command))
+        job_scripts.append(job_script)
+    return job_scripts
+
+
+def merge_shards(shard_paths):
+    """
+    Combine the per-shard tables for collation
+    """
+    nextclade = []
+    pangolin = []
+    for shard_path in shard_paths:
+        nextclade_path, pangolin_path = shard_outputs(shard_path)
+        nextclade.append(pd.read_csv(nextclade_path, sep='\t',
+                                     dtype=ASSIGNMENT_DTYPES))
+        pangolin.append(pd.read_csv(pangolin_path, sep='\t',
+                                    dtype=ASSIGNMENT_DTYPES))
+    return pd.concat(nextclade), pd.concat(pangolin)
+
+
+def assign_sharded(input_genomes, threads, shards, shard_dir, executor,
+                   workers, job_template):
+    """
+    Split input into shards, assign any unfinished shards, and merge
+    results once every shard is complete
+    """
+    shard_paths = split_fasta(input_genomes, shards, shard_dir)
+    pending = [shard_path for shard_path in shard_paths
+               if not shard_complete(shard_path)]
+    print(f"{len(shard_paths) - len(pending)}/{len(shard_paths)} shards "
+          "already assigned")
+
+    if pending and executor == 'local':
+        run_shards_local(pending, threads, workers)
+    elif pending and executor == 'batch':
+        job_scripts = write_shard_jobs(pending, threads, job_template)
+        print(f"Wrote {len(job_scripts)} job scripts to {shard_dir}, submit "
+              "them and rerun this command once they finish")
+
+    pending = [shard_path for shard_path in shard_paths
+               if not shard_complete(shard_path)]
+    if pending:
+        raise RuntimeError(f"{len(pending)} shards not assigned yet, rerun "
+                           "to resume: " + ", ".join(map(str, pending)))
+    return merge_shards(shard_paths)
+
+
+def assign(input_genomes, args):
+    """
+    Assign lineages using the mode selected on the command line
+    """
+    if args.shards is not None:
+        return assign_sharded(input_genomes, args.threads, args.shards,
+                              args.shard_dir, args.executor,
+                              args.shard_workers, args.job_template)
+    elif args.parallel:
+        return assign_parallel(input_genomes, args.threads,
+                               args.nextclade_threads)
+    else:
+        return assign_serial(input_genomes, args.threads)
+
+
+def assign_deduplicated(input_genomes, unique_fasta, args):
+    """
+    Assign one genome per unique sequence and copy its assignments to the
+    identical genomes
+    """
+    name_hashes = hash_fasta(input_genomes)
+    return assign_unique(input_genomes, list(name_hashes), name_hashes,
+                         unique_fasta, lambda fasta: assign(fasta, args),
+                         'isolate')
+
+
+def assign_cached(input_genomes, cache_path, uncached_fasta, args,
+                  deduplicate=False):
+    """
+    Only assign genomes whose sequence isn't already in the cache for the
+    current tool versions, then merge fresh and cached assignments
+    """
+    versions = get_tool_versions()
+    tools = {'nextclade': versions['nextclade_version'],
+             'pangolin': f"{versions['pangolin_version']} "
+                         f"{versions['pangoLEARN_version']}"}
+
+    cache = LineageCache(cache_path)
+    name_hashes = hash_fasta(input_genomes)
+    cached, uncached = split_cached(cache, tools, name_hashes)
+    print(f"{len(name_hashes) - len(uncached)}/{len(name_hashes)} genomes "
+          "already assigned in cache")
+
+    nextclade, pangolin = None, None
+    if uncached and deduplicate:
+        nextclade, pangolin = assign_unique(input_genomes, uncached,
+                                            name_hashes, uncached_fasta,
+                                            lambda fasta: assign(fasta, args),
+                                            'isolate')
+    elif uncached:
+        write_fasta_subset(input_genomes, uncached, uncached_fasta)
+        try:
+            nextclade, pangolin = assign(uncached_fasta, args)
+        finally:
+            Path(uncached_fasta).unlink(missing_ok=True)
+
+    nextclade = merge_cached(cache, 'nextclade', tools['nextclade'],
+                             nextclade, cached['nextclade'], name_hashes,
+                             'isolate')
+    pangolin = merge_cached(cache, 'pangolin', tools['pangolin'],
+                            pangolin, cached['pangolin'], name_hashes,
+                            'isolate')
+    cache.close()
+    return nextclade, pangolin
 
 
 if __name__ == '__main__':
@@ -139,13 +671,65 @@ if __name__ == '__main__':
     parser.add_argument("-t", "--threads", default=8, type=int,
                         help="Number of threads for pangolin/nextclade")
     parser.add_argument("-o", "--output", default="lineage_assignments.tsv",
-                        help="Output file for collated assignment table")
+                        help="Output file for collated assignment table "
+                             "(parquet if it ends in .parquet, otherwise tsv)")
+    parser.add_argument("-p", "--parallel", default=False,
+                        action='store_true',
+                        help="Run pangolin and nextclade at the same time "
+                             "splitting --threads between them")
+    parser.add_argument("--nextclade_threads", default=None, type=int,
+                        help="Threads from --threads given to nextclade "
+                             "with --parallel (default: half)")
+    parser.add_argument("--shards", default=None, type=int,
+                        help="Split input into this many shards and assign "
+                             "each separately, rerun to resume failed shards")
+    parser.add_argument("--shard_dir", default="lineage_shards",
+                        help="Directory for shard fasta and outputs")
+    parser.add_argument("--executor", default="local",
+                        choices=['local', 'batch'],
+                        help="Run shards in a local process pool or write "
+                             "batch scheduler job scripts for each shard")
+    parser.add_argument("--shard_workers", default=2, type=int,
+                        help="Shards assigned at once with local executor, "
+                             "--threads is split between them")
+    parser.add_argument("--job_template", default=None, type=check_file,
+                        help="Job script template for batch executor with "
+                             "{name}, {threads}, {command} fields "
+                             "(default: SLURM)")
+    parser.add_argument("--run_shard", default=False, action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument("-c", "--cache", default=None,
+                        help="SQLite cache of assignments by sequence hash, "
+                             "only uncached genomes are assigned")
+    parser.add_argument("--deduplicate", default=False,
+                        action='store_true',
+                        help="Only assign one genome per unique sequence and "
+                             "copy its assignments to the identical genomes")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
 
-    update_pangolin()
-    pangolin = run_pangolin(args.input_genomes, args.threads)
+    if args.run_shard:
+        assign_shard(args.input_genomes, args.threads)
+        sys.exit(0)
+
+    metrics = instrumentation.from_args("assign_lineages", args)
+
+    with metrics.stage("update_tools"):
+        update_tools(args.parallel)
 
-    update_nextclade()
-    nextclade = run_nextclade(args.input_genomes, args.threads)
+    with metrics.stage("assign") as stage:
+        if args.cache is not None:
+            nextclade, pangolin = assign_cached(args.input_genomes, args.cache,
+                                                args.output + ".uncached.fasta",
+                                                args, args.deduplicate)
+        elif args.deduplicate:
+            nextclade, pangolin = assign_deduplicated(args.input_genomes,
+                                                      args.output +
+                                                      ".unique.fasta", args)
+        else:
+            nextclade, pangolin = assign(args.input_genomes, args)
+        stage['rows'] = len(pangolin)
 
-    collate_output(nextclade, pangolin, args.output)
+    with metrics.stage("collate", rows=len(pangolin)):
+        collate_output(nextclade, pangolin, args.output)
+    metrics.close()
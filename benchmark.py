@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib
+import json
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+BASES = "ACGT"
+GENES = {"ORF1a": 4405, "ORF1b": 2695, "S": 1273, "ORF3a": 275, "E": 75,
+         "M": 222, "ORF6": 61, "ORF7a": 121, "ORF8": 121, "N": 419}
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+LINEAGES = ["B.1", "B.1.1", "B.1.1.7", "B.1.1.28", "P.1", "B.1.351",
+            "B.1.2", "B.1.429", "B.1.526", "A.1", "A.2", "B.1.1.519"]
+DIVISIONS = ["Ontario", "Quebec", "British Columbia", "Alberta", "Manitoba",
+             "Saskatchewan", "Nova Scotia", "New Brunswick"]
+SNPEFF_EFFECTS = ["missense_variant", "synonymous_variant",
+                  "intergenic_region"]
+
+
+def random_date(rng):
+    """
+    Date with realistic ambiguity (some missing day or month)
+    """
+    date = f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    ambiguity = rng.random()
+    if ambiguity < 0.05:
+        return date[:4] + "-XX-XX"
+    elif ambiguity < 0.15:
+        return date[:7] + "-XX"
+    return date
+
+
+def random_aa_mutations(rng, count):
+    """
+    Sorted, comma joined nextclade style amino acid substitutions
+    """
+    mutations = set()
+    for _ in range(count):
+        gene = rng.choice(list(GENES))
+        mutations.add((gene, rng.randint(1, GENES[gene]),
+                       rng.choice(AMINO_ACIDS), rng.choice(AMINO_ACIDS)))
+    return ",".join(f"{gene}:{ref}{pos}{alt}"
+                    for gene, pos, ref, alt in sorted(mutations))
+
+
+def generate_nextmeta(path, size, seed):
+    """
+    nextmeta formatted metadata for size genomes
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as out_fh:
+        out_fh.write("strain\tdate\tcountry\tdivision\tlocation\t"
+                     "pangolin_lineage\tlength\n")
+        for ix in range(size):
+            location = f"{rng.choice('KLMNPR')}{rng.randint(0, 9)}" \
+                       f"{rng.choice('ABCEGHJ')}" if rng.random() < 0.3 else ""
+            out_fh.write(f"hCoV-19/Canada/{ix}/2020\t{random_date(rng)}\t"
+                         f"Canada\t{rng.choice(DIVISIONS)}\t{location}\t"
+                         f"{rng.choice(LINEAGES)}\t29903\n")
+
+
+def generate_nextfasta(path, size, seed, genome_length, block_size=1000):
+    """
+    nextfasta formatted genomes with runs of N at the ends and some
+    dropouts, generated in blocks of genomes as arrays so millions of
+    genomes are feasible
+    """
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(BASES.encode('utf-8'), dtype=np.uint8)
+    reference = bases[rng.integers(0, len(bases), genome_length)]
+    positions = np.arange(genome_length)
+    with open(path, 'wb') as out_fh:
+        for block_start in range(0, size, block_size):
+            block = min(block_size, size - block_start)
+            genomes = np.tile(reference, (block, 1))
+
+            mutation_counts = rng.integers(5, 41, block)
+            genomes[np.repeat(np.arange(block), mutation_counts),
+                    rng.integers(0, genome_length, mutation_counts.sum())] = \
+                bases[rng.integers(0, len(bases), mutation_counts.sum())]
+
+            start_ns = rng.integers(0, 61, block)[:, None]
+            end_ns = rng.integers(0, 61, block)[:, None]
+            dropouts = rng.integers(0, genome_length - 300, block)[:, None]
+            has_dropout = (rng.random(block) < 0.2)[:, None]
+            genomes[(positions < start_ns) |
+                    (positions >= genome_length - end_ns) |
+                    (has_dropout & (positions >= dropouts) &
+                     (positions < dropouts + 300))] = ord('N')
+
+            for ix, genome in enumerate(genomes, block_start):
+                out_fh.write(f">hCoV-19/Canada/{ix}/2020\n".encode('utf-8'))
+                out_fh.write(genome.tobytes() + b'\n')
+
+
+def generate_nextclade(path, size, seed):
+    """
+    nextclade output tsv for size genomes
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as out_fh:
+        out_fh.write("seqName\tclade\taaSubstitutions\taaDeletions\n")
+        for ix in range(size):
+            deletions = ""
+            if rng.random() < 0.3:
+                deletions = "S:H69-,S:V70-"
+            out_fh.write(f"hCoV-19/Canada/{ix}/2020\t20B\t"
+                         f"{random_aa_mutations(rng, rng.randint(5, 30))}\t"
+                         f"{deletions}\n")
+
+
+def generate_mutation_metadata(path, size, seed):
+    """
+    nextmeta with mutation sets as produced by collect_mutations.py
+    """
+    rng = random.Random(seed)
+    with open(path, 'w') as out_fh:
+        out_fh.write("strain\tpangolin_lineage\tdivision\t"
+                     "all mutation/deletion sets\tS mutation/deletion sets\n")
+        for ix in range(size):
+            mutations = random_aa_mutations(rng, rng.randint(5, 30))
+            spike = ",".join(mutation for mutation in mutations.split(',')
+                             if mutation.startswith("S:"))
+            out_fh.write(f"hCoV-19/Canada/{ix}/2020\t{rng.choice(LINEAGES)}\t"
+                         f"{rng.choice(DIVISIONS)}\t{mutations}\t{spike}\n")
+
+
+def generate_ivar(directory, size, seed):
+    """
+    One ivar variants tsv per 100 genomes, each with around 30 variants
+    """
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for ix in range(max(1, size // 100)):
+        path = directory / f"sample{ix}_ivar_variants.tsv"
+        with open(path, 'w') as out_fh:
+            out_fh.write("REGION\tPOS\tREF\tALT\tREF_DP\tREF_RV\tREF_QUAL\t"
+                         "ALT_DP\tALT_RV\tALT_QUAL\tALT_FREQ\tTOTAL_DP\tPVAL\t"
+                         "PASS\tGFF_FEATURE\tREF_CODON\tREF_AA\tALT_CODON\t"
+                         "ALT_AA\n")
+            for pos in sorted(rng.sample(range(21563, 25384), 30)):
+                ref, alt = rng.sample(BASES, 2)
+                ref_aa, alt_aa = rng.choice(AMINO_ACIDS), rng.choice(AMINO_ACIDS)
+                out_fh.write(f"MN908947.3\t{pos}\t{ref}\t{alt}\t1\t0\t70\t500\t"
+                             f"100\t60\t0.99\t501\t0\tTRUE\tcds-QHD43416.1\t"
+                             f"AAA\t{ref_aa}\tAAC\t{alt_aa}\n")
+        paths.append(path)
+    return paths
+
+
+def generate_snpeff_vcfs(directory, size, seed):
+    """
+    One SnpEff annotated freebayes VCF per 1000 genomes (at least 2)
+    """
+    rng = random.Random(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for ix in range(max(2, size // 1000)):
+        path = directory / f"sample{ix}.ann.vcf"
+        with open(path, 'w') as out_fh:
+            out_fh.write("##fileformat=VCFv4.2\n"
+                         "##INFO=<ID=AO,Number=A,Type=Integer,Description=\"\">\n"
+                         "##INFO=<ID=DP,Number=1,Type=Integer,Description=\"\">\n"
+                         "##INFO=<ID=VAF,Number=A,Type=Float,Description=\"\">\n"
+                         "##INFO=<ID=ANN,Number=.,Type=String,Description=\"\">\n"
+                         "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+            for pos in sorted(rng.sample(range(21563, 25384), 30)):
+                ref, alt = rng.sample(BASES, 2)
+                effect = rng.choice(SNPEFF_EFFECTS)
+                aa_change = f"p.Asn{(pos - 21563) // 3 + 1}Tyr"
+                ann = f"{alt}|{effect}|MODERATE|S|GU280_gp02|transcript|" \
+                      f"GU280_gp02||1/1|c.{pos - 21562}{ref}>{alt}|{aa_change}"
+                out_fh.write(f"MN908947.3\t{pos}\t.\t{ref}\t{alt}\t100\t.\t"
+                             f"AO={rng.randint(10, 500)};DP=500;"
+                             f"VAF={rng.random():.3f};ANN={ann}\n")
+        paths.append(path)
+    return paths
+
+
+def generated(data_dir, name, size, seed, generator, *args):
+    """
+    Generate a dataset once per size and seed and reuse it afterwards
+    """
+    path = Path(data_dir) / f"{name}_{size}_{seed}"
+    if not path.exists():
+        tmp_path = Path(str(path) + ".tmp")
+        generator(tmp_path, size, seed, *args)
+        tmp_path.rename(path)
+    return path
+
+
+def bench_filter_seqs(data_dir, size, seed, genome_length):
+    extract_seqs = importlib.import_module("extract_seqs")
+    metadata = generated(data_dir, "nextmeta", size, seed, generate_nextmeta)
+    fasta = generated(data_dir, "nextfasta", size, seed, generate_nextfasta,
+                      genome_length)
+    filtered = extract_seqs.filter_metadata(metadata,
+                                            "pangolin_lineage=='B.1.1.28'",
+                                            True, False)
+    return lambda: extract_seqs.filter_seqs(fasta, filtered)
+
+
+def bench_add_mutations(data_dir, size, seed, genome_length):
+    collect_mutations = importlib.import_module("collect_mutations")
+    metadata = generated(data_dir, "nextmeta", size, seed, generate_nextmeta)
+    nextclade = generated(data_dir, "nextclade", size, seed,
+                          generate_nextclade)
+    metadata = pd.read_csv(metadata, sep='\t').set_index('strain')
+    nextclade = pd.read_csv(nextclade, sep='\t').set_index('seqName')
+    return lambda: collect_mutations.add_mutations_to_metadata(
+        metadata.copy(), nextclade.copy(), "all,S")
+
+
+def bench_compare_metadata(data_dir, size, seed, genome_length):
+    compare = importlib.import_module("compare_lineages_and_mutations")
+    previous = generated(data_dir, "mutation_metadata", size, seed,
+                         generate_mutation_metadata)
+    current = generated(data_dir, "mutation_metadata", size, seed + 1,
+                        generate_mutation_metadata)
+    previous = pd.read_csv(previous, sep='\t')
+    current = pd.read_csv(current, sep='\t')
+    return lambda: compare.compare_metadata_files(previous.copy(),
+                                                  current.copy())
+
+
+def bench_summarise_ivar(data_dir, size, seed, genome_length):
+    summarise_ivar = importlib.import_module("summarise_ivar")
+    import gffutils
+    ivar_dir = Path(data_dir) / f"ivar_{size}_{seed}"
+    ivar_files = generate_ivar(ivar_dir, size, seed)
+    ref_db = gffutils.create_db(str(Path(__file__).parent /
+                                    "data/MN908947_3.gff3"),
+                                dbfn=":memory:", keep_order=True,
+                                merge_strategy='merge',
+                                sort_attribute_values=True)
+    return lambda: summarise_ivar.parse_inputs(ivar_files, ref_db)
+
+
+def bench_snp_analysis_plot(data_dir, size, seed, genome_length):
+    snp_analysis_plot = importlib.import_module("snp_analysis_plot")
+    import vcf
+    import matplotlib.pyplot as plt
+    vcf_dir = Path(data_dir) / f"snpeff_{size}_{seed}"
+    vcf_paths = generate_snpeff_vcfs(vcf_dir, size, seed)
+    output = Path(data_dir) / "snp_plot.png"
+
+    def run():
+        parsed_records = []
+        for vcf_path in vcf_paths:
+            with open(vcf_path) as fh:
+                for record in vcf.Reader(fh):
+                    parsed_records.extend(
+                        snp_analysis_plot.parse_vcf_snpeff_record(
+                            record, vcf_path.stem))
+        variants = pd.DataFrame(parsed_records)
+        snp_analysis_plot.plot_allele_pres_absence(variants, "benchmark",
+                                                   output, all_mutations=True)
+        plt.close('all')
+    return run
+
+
+BENCHMARKS = {"extract_seqs.filter_seqs": bench_filter_seqs,
+              "collect_mutations.add_mutations_to_metadata": bench_add_mutations,
+              "compare_lineages_and_mutations.compare_metadata_files":
+                  bench_compare_metadata,
+              "summarise_ivar.parse_inputs": bench_summarise_ivar,
+              "snp_analysis_plot": bench_snp_analysis_plot}
+
+
+def measure(func, repeat):
+    """
+    Best wall time over repeats, then peak traced memory from a separate
+    run so tracing doesn't inflate the timing
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak / 1024 / 1024
+
+
+# differences smaller than these are timer/allocator noise
+NOISE = {'seconds': 0.05, 'peak_mb': 1.0}
+
+
+def compare_baseline(results, baseline, tolerance):
+    """
+    Find benchmarks that are slower or use more memory than the baseline
+    by more than the tolerance
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric in ['seconds', 'peak_mb']:
+            allowed = max(baseline[key][metric] * (1 + tolerance),
+                          baseline[key][metric] + NOISE[metric])
+            if result[metric] > allowed:
+                regressions.append(f"{key} {metric}: {result[metric]:.3f} vs "
+                                   f"baseline {baseline[key][metric]:.3f}")
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Benchmark script hot paths on "
+                                     "generated data")
+    parser.add_argument("-s", "--sizes", nargs="+", type=int,
+                        default=[1000, 10000],
+                        help="Numbers of genomes to generate data for "
+                             "(e.g., 1000 10000 100000 1000000)")
+    parser.add_argument("-b", "--benchmarks", nargs="+", default=None,
+                        choices=list(BENCHMARKS),
+                        help="Benchmarks to run (default: all)")
+    parser.add_argument("-d", "--data_dir", default="benchmark_data",
+                        help="Directory to generate and reuse data in")
+    parser.add_argument("--seed", default=42, type=int,
+                        help="Seed for the data generators")
+    parser.add_argument("--genome_length", default=29903, type=int,
+                        help="Length of generated genomes")
+    parser.add_argument("-r", "--repeat", default=3, type=int,
+                        help="Timed runs per benchmark (best is reported)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json",
+                        help="Baseline results file")
+    parser.add_argument("--save", default=False, action='store_true',
+                        help="Save results as the new baseline")
+    parser.add_argument("--check", default=False, action='store_true',
+                        help="Exit with an error if any benchmark regresses "
+                             "against the baseline")
+    parser.add_argument("--tolerance", default=0.2, type=float,
+                        help="Allowed fractional slowdown/memory increase")
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    Path(args.data_dir).mkdir(parents=True, exist_ok=True)
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        for size in args.sizes:
+            key = f"{name}[{size}]"
+            try:
+                func = BENCHMARKS[name](args.data_dir, size, args.seed,
+                                       args.genome_length)
+            except ImportError as error:
+                print(f"{key}: skipped ({error})")
+                continue
+            seconds, peak_mb = measure(func, args.repeat)
+            results[key] = {'seconds': seconds, 'peak_mb': peak_mb}
+            print(f"{key}: {seconds:.3f}s, {peak_mb:.1f}MB peak")
+
+    baseline_path = Path(args.baseline)
+    if args.check and baseline_path.exists():
+        regressions = compare_baseline(results,
+                                       json.loads(baseline_path.read_text()),
+                                       args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+    if args.save:
+        baseline = {}
+        if baseline_path.exists():
+            baseline = json.loads(baseline_path.read_text())
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2))
+        print(f"Baseline saved to {baseline_path}")
@@ -3,6 +3,7 @@
 import pandas as pd
 import argparse
 from pathlib import Path
+import instrumentation
 
 def check_file(path: str) -> Path:
     """
@@ -64,13 +65,20 @@ if __name__ == "__main__":
                          help="Output path for metadata tsv with mutations")
     parser.add_argument("-g", "--genes", default="all,S", help="Genes for which to"
                          " extract mutations/deletions")
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics = instrumentation.from_args("collect_mutations", args)
 
-    nextclade = pd.read_csv(args.nextclade_output, sep='\t').set_index('seqName')
+    with metrics.stage("read") as stage:
+        nextclade = pd.read_csv(args.nextclade_output, sep='\t').set_index('seqName')
 
-    metadata =  pd.read_csv(args.metadata, sep='\t').set_index('strain')
+        metadata =  pd.read_csv(args.metadata, sep='\t').set_index('strain')
+        stage['rows'] = len(metadata)
 
-    metadata = add_mutations_to_metadata(metadata, nextclade, args.genes)
+    with metrics.stage("annotate", rows=len(nextclade)):
+        metadata = add_mutations_to_metadata(metadata, nextclade, args.genes)
 
-    metadata.reset_index().to_csv(args.output, sep='\t', index=False)
+    with metrics.stage("write", rows=len(metadata)):
+        metadata.reset_index().to_csv(args.output, sep='\t', index=False)
+    metrics.close()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 import pickle
-import plotly.express as px
 import argparse
 import pandas as pd
 from pathlib import Path
+import instrumentation
+from datetime import date, timedelta
+from seen_index import SeenIndex
 
 
 def check_file(path: str) -> Path:
@@ -18,10 +20,11 @@ def check_file(path: str) -> Path:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
 
-def compare_metadata_files(previous, current):
+def compare_metadata_files(previous, current, seen=None, date=None):
     """
     Generate a report highlighting any new mutations or lineages in
-    between the two dataframes
+    between the two dataframes, if a SeenIndex is given only items never
+    seen before in any snapshot (or first seen on date) are novel
     """
 
     report = {}
@@ -46,6 +49,8 @@ def compare_metadata_files(previous, current):
         previous_set = set(previous[category].values)
         current_set = set(current[category].values)
         new_items = current_set - previous_set
+        if seen is not None:
+            new_items = seen.novel(category, new_items, date)
 
         # add new to canada column to category df
         if len(new_items) > 0:
@@ -77,6 +82,8 @@ def compare_metadata_files(previous, current):
             differences_mutations = differences_mutations.rename(columns={'index': individual})
 
             new_mutations =  set(current_mutations.index) - set(previous_mutations.index)
+            if seen is not None:
+                new_mutations = seen.novel(individual, new_mutations, date)
 
             if len(new_mutations) > 0:
                 differences_mutations.loc[differences_mutations[individual].isin(new_mutations), 'Novel in Canada'] = "Yes"
@@ -89,6 +96,34 @@ def compare_metadata_files(previous, current):
     return report
 
 
+def add_seen(seen, genomes, date):
+    """
+    Add the lineages, divisions and mutations of genomes to the seen index
+    """
+    reported_mutations = [col for col in genomes if col.endswith("mutation/deletion sets")]
+    for category in ['pangolin_lineage'] + reported_mutations + ["division"]:
+        seen.add(category, genomes[category].value_counts(), date)
+        if category.endswith('mutation/deletion sets'):
+            individual = category.replace('sets', 'individual')
+            seen.add(individual,
+                     genomes[category].str.split(',').explode().value_counts(),
+                     date)
+
+
+def update_seen(seen, previous, current, snapshot, date, previous_date):
+    """
+    Add the genomes that are new in the current snapshot to the seen index,
+    the previous snapshot's genomes are added first (as seen on
+    previous_date) when the index is new
+    """
+    if seen.has_snapshot(snapshot):
+        return
+    if seen.is_empty():
+        add_seen(seen, previous, previous_date)
+    add_seen(seen, current[~current['strain'].isin(previous['strain'])], date)
+    seen.record_snapshot(snapshot, date)
+
+
 def get_figure_height(number_categories: int) -> int:
     """
     Given a number of categories to plot gets an appropriate figure height.
@@ -118,6 +153,8 @@ def apply_color(row, category):
 
 
 def plot_category(report, category):
+    # plotly is slow to import so only load it when plotting
+    import plotly.express as px
     report[category][category] = report[category].apply(lambda x: apply_color(x, category), axis=1)
 
     if len(report[category][category]) == 0:
@@ -176,13 +213,46 @@ if __name__ == "__main__":
                         help="Current days nextmeta file with mutations added")
     parser.add_argument("-o", "--output",  default="report.txt",
                         help="Output prefix")
+    parser.add_argument("-s", "--seen_index", default=None,
+                        help="SQLite index of every lineage/mutation ever "
+                             "seen, only never seen items are reported as "
+                             "novel and the index is updated with this run")
+    parser.add_argument("--date", default=date.today().isoformat(),
+                        help="Date of the current snapshot recorded as when "
+                             "new items were first seen (default: today)")
+    parser.add_argument("--previous_date", default=None,
+                        help="Date of the previous snapshot, recorded for its "
+                             "items when a new seen index is started "
+                             "(default: the day before --date)")
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics = instrumentation.from_args("compare_lineages_and_mutations", args)
 
-    previous = pd.read_csv(args.previous, sep='\t')
-    current = pd.read_csv(args.current, sep='\t')
+    with metrics.stage("read") as stage:
+        previous = pd.read_csv(args.previous, sep='\t')
+        current = pd.read_csv(args.current, sep='\t')
+        stage['rows'] = len(previous) + len(current)
 
     report_title = f"Canada {args.previous.parts[0]} vs {args.current.parts[0]}" \
                    f"<br>{len(current) - len(previous)} new genomes"
-    report = compare_metadata_files(previous, current)
-    summarise_report(report, report_title, args.output)
+    seen = SeenIndex(args.seen_index) if args.seen_index else None
+
+    with metrics.stage("compare", rows=len(current)):
+        report = compare_metadata_files(previous, current, seen, args.date)
+
+    with metrics.stage("plot"):
+        summarise_report(report, report_title, args.output)
+
+    # only record this snapshot as seen once its report is written so a
+    # failed report can be rerun without losing its novel items
+    if seen is not None:
+        previous_date = args.previous_date or \
+            (date.fromisoformat(args.date) - timedelta(days=1)).isoformat()
+        with metrics.stage("update_seen"):
+            snapshot = f"{args.current.resolve()}:" \
+                       f"{args.current.stat().st_mtime_ns}"
+            update_seen(seen, previous, current, snapshot, args.date,
+                        previous_date)
+        seen.close()
+    metrics.close()
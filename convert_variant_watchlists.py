@@ -3,8 +3,8 @@
 from collections import defaultdict
 import argparse
 from pathlib import Path
-from Bio import SeqIO
-from Bio import Data
+import instrumentation
+import service_client
 
 ## modified from https://github.com/jts/ncov-watch
 class Variant:
@@ -65,13 +65,17 @@ def check_file(path: str) -> Path:
 
 
 
-def convert_type_variants_to_vcf(reference: dict, type_variants_path: Path) -> list:
+def convert_type_variants_to_vcf(reference: dict, type_variants_path: Path,
+                                 out=None) -> list:
     """
 
     """
 
     converted_variants = []
 
+    # biopython is slow to import so only load it when converting
+    from Bio import Data
+
     # the "backwards_table" function in biopython only returns one codon for
     # some reason so we have to make it ourselves
     codon_table = Data.CodonTable.standard_dna_table
@@ -79,12 +83,12 @@ def convert_type_variants_to_vcf(reference: dict, type_variants_path: Path) -> l
     for codon, aa in codon_table.forward_table.items():
         back_codon_table[aa].append(codon)
 
-    print(back_codon_table)
+    print(back_codon_table, file=out)
 
     with open(type_variants_path) as fh:
         for variant in fh:
             variant = variant.strip().split(':')
-            print(variant)
+            print(variant, file=out)
             if variant[0] == 'aa':
                 orf = variant[1]
                 ref_aa = variant[2][0]
@@ -107,7 +111,8 @@ def convert_type_variants_to_vcf(reference: dict, type_variants_path: Path) -> l
                                                                      ref_codon,
                                                                      alt_codon):
                         if ref_codon_nt != alt_codon_nt:
-                            print(f"{ref_codon_nt}{codon_pos}{alt_codon_nt}")
+                            print(f"{ref_codon_nt}{codon_pos}{alt_codon_nt}",
+                                  file=out)
 
 
                 var = None
@@ -142,6 +147,7 @@ def parse_genbank(gbk_path: Path) -> dict:
     Parse a gbk file for the reference genome into a dictionary for quick
     lookup
     """
+    from Bio import SeqIO
     ref_data = {}
     for record in SeqIO.parse(gbk_path, 'genbank'):
         for feature in record.features:
@@ -154,6 +160,22 @@ def parse_genbank(gbk_path: Path) -> dict:
     return ref_data
 
 
+def convert(input_path: Path, input_type: str, reference: dict, out=None):
+    """
+    Convert a watchlist and print the result (to stdout unless given another
+    output handle)
+    """
+    if input_type == 'type_variants_config':
+        converted_vcf = convert_type_variants_to_vcf(reference, input_path,
+                                                     out)
+        print(converted_vcf, file=out)
+
+    elif input_type == "vcf":
+        convert_type_variants = convert_vcf_to_type_variants(input_path,
+                                                             reference)
+        print(convert_type_variants, file=out)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser("Convert between type_variants format and "
@@ -167,17 +189,25 @@ if __name__ == "__main__":
                              "a config file for type_variants")
     parser.add_argument("-g", "--ref_gbk", required=True, type=check_file,
                          help="Path to full genbank annotation for reference genome")
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    metrics = instrumentation.from_args("convert_variant_watchlists", args)
 
-    reference = parse_genbank(args.ref_gbk)
+    # use the worker service's already parsed genbank if it is running
+    with metrics.stage("service"):
+        output = service_client.submit('convert_watchlist',
+                                       {'input': args.input,
+                                        'input_type': args.input_type,
+                                        'ref_gbk': args.ref_gbk})
 
-    if args.input_type == 'type_variants_config':
-        converted_vcf = convert_type_variants_to_vcf(reference, args.input)
-        print(converted_vcf)
+    if output is not None:
+        print(output, end='')
+    else:
+        with metrics.stage("load_reference"):
+            reference = parse_genbank(args.ref_gbk)
 
-    elif args.input_type == "vcf":
-        convert_type_variants = convert_vcf_to_type_variants(args.input,
-                                                             reference)
-        print(convert_type_variants)
+        with metrics.stage("convert"):
+            convert(args.input, args.input_type, reference)
+    metrics.close()
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import argparse
+import runpy
+import subprocess
+import sys
+from pathlib import Path
+
+
+# subcommand: (script module, description), scripts are only imported when
+# their subcommand is run so heavy dependencies of other scripts aren't loaded
+COMMANDS = {
+    'assign_lineages': ('assign_lineages',
+                        "Assign pangolin and nextclade lineages"),
+    'pho_reporting': ('pho_reporting',
+                      "Completeness and pangolin report in PHO format"),
+    'extract_seqs': ('extract_seqs',
+                     "Extract sequences matching a metadata query"),
+    'collect_mutations': ('collect_mutations',
+                          "Add nextclade mutations to metadata"),
+    'genome_store': ('genome_store',
+                     "Pack genomes into a memory-mapped genome store"),
+    'mutation_index': ('mutation_index',
+                       "Build the nextclade mutation index for extract_seqs"),
+    'compare': ('compare_lineages_and_mutations',
+                "Report new lineages and mutations between metadata files"),
+    'summarise_ivar': ('summarise_ivar', "Summarise ivar variant files"),
+    'snp_plot': ('snp_analysis_plot',
+                 "Heatmap of SNPs across SnpEff annotated VCFs"),
+    'lat_long': ('get_lat_long_for_postcode',
+                 "Add Canadian postcode lat/longs to an ncov lat_long file"),
+    'convert_watchlist': ('convert_variant_watchlists',
+                          "Convert between type_variants and VCF watchlists"),
+    'yaml_to_vcf': ('variant_yaml_to_vcf',
+                    "Convert PHE variant definition yamls to VCF"),
+    'type_genomes': ('type_genomes',
+                     "Type aligned genomes against variant definitions"),
+    'variant_intersections': ('variant_intersections',
+                              "Upset plot of shared variants"),
+    'consensus': ('quick_consensus',
+                  "Generate consensus genomes from VCFs"),
+    'check_consensus': ('vcf_consensus',
+                        "Check in-process consensus matches bcftools"),
+    'tree_build': ('tree_build', "Run the lineage tree build"),
+    'benchmark': ('benchmark', "Benchmark scripts on generated data"),
+    'service': ('worker_service',
+                "Keep references loaded for summarise_ivar, "
+                "convert_watchlist, and pho_reporting"),
+}
+
+
+def import_time(module: str) -> float:
+    """
+    Time importing a script module in a fresh interpreter
+    """
+    code = "import time; start = time.perf_counter(); " \
+           f"import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd=Path(__file__).parent,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    return float(result.stdout)
+
+
+def report_import_times(commands):
+    """
+    Print how long each subcommand's script takes to import
+    """
+    for command in commands:
+        module = COMMANDS[command][0]
+        try:
+            print(f"{command}\t{import_time(module):.3f}s")
+        except ImportError as error:
+            print(f"{command}\tfailed ({error})")
+
+
+def run_command(command, command_args):
+    """
+    Run a subcommand's script as if it were called directly, the script is
+    __main__ while it runs so its functions can be pickled for process pools
+    """
+    module = COMMANDS[command][0]
+    # argv[0] is replaced with the script path by run_module
+    sys.argv = [sys.argv[0]] + command_args
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+
+    descriptions = "\n".join(f"  {command:<22}{description}"
+                             for command, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        description="SARS-CoV-2 analysis scripts, run "
+                    "'covid_scripts.py <command> --help' for a command's "
+                    "options",
+        epilog=f"commands:\n{descriptions}\n  {'import_times':<22}"
+               "Time how long each command takes to import",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=list(COMMANDS) + ['import_times'],
+                        metavar="command", help="Script to run")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="Options for the command")
+    args = parser.parse_args()
+
+    if args.command == 'import_times':
+        unknown = set(args.args) - set(COMMANDS)
+        if unknown:
+            parser.error(f"unknown commands: {', '.join(sorted(unknown))}")
+        report_import_times(args.args or list(COMMANDS))
+    else:
+        sys.path.insert(0, str(Path(__file__).parent))
+        run_command(args.command, args.args)
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import argparse
-import gzip
 from pathlib import Path
-from Bio import SeqIO
 import pandas as pd
+import numpy as np
+import instrumentation
+from mutation_index import load_or_build
+from genome_store import GenomeStore
+from fasta_reader import read_fasta
 
 
 def check_file(path: str) -> Path:
@@ -17,52 +20,194 @@ def check_file(path: str) -> Path:
     else:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
-def filter_metadata(metadata_fp, query, include_reference, exclude_incomplete_dates):
+# bytes that aren't standard nucleotides, deleted when counting length
+NON_ACGT = bytes(base for base in range(256) if base not in b'ACGTacgt')
+
+REFERENCE_STRAINS = ['Wuhan/Hu-1/2019', 'Wuhan/WH01/2019']
+
+
+def ambiguous_dates(dates, ambiguity):
     """
-    Parse and filter metadata
+    Find dates that are ambiguous at the given resolution (day, month, year
+    or any) in the same way as augur filter --exclude-ambiguous-dates-by
+    """
+    date_parts = dates.str.extract(r'^(?P<year>\d{4})?-?(?P<month>\d{2})?-?'
+                                   r'(?P<day>\d{2})?')
+    if ambiguity in ['day', 'any']:
+        return date_parts.isna().any(axis=1)
+    elif ambiguity == 'month':
+        return date_parts[['year', 'month']].isna().any(axis=1)
+    elif ambiguity == 'year':
+        return date_parts['year'].isna()
+    else:
+        raise ValueError("ambiguity must be 'day', 'month', 'year', or "
+                         f"'any': {ambiguity}")
+
+
+def filter_metadata(metadata_fp, query, include_reference, exclude_incomplete_dates,
+                    exclude_ambiguous_dates_by=None, strains=None,
+                    exclude_strains=None):
+    """
+    Parse and filter metadata, optionally also restricting it to a set of
+    strains (e.g., those with mutations from the mutation index) and
+    removing another set (e.g., those with excluded mutations)
     """
     df = pd.read_csv(str(metadata_fp), sep='\t')
 
+    if exclude_ambiguous_dates_by is not None:
+        df = df[~ambiguous_dates(df['date'].astype(str),
+                                 exclude_ambiguous_dates_by)]
+
     # remove XX in dates
     df['date'] = df['date'].str.replace('-XX', '')
 
     if exclude_incomplete_dates:
         df = df[df['date'].str.len() == 10]
 
-    filt_df = df.query(query)
+    filt_df = df.query(query) if query is not None else df
+    if strains is not None:
+        filt_df = filt_df[filt_df['strain'].isin(strains)]
+    if exclude_strains is not None:
+        filt_df = filt_df[~filt_df['strain'].isin(exclude_strains)]
     if include_reference:
-        ref_df = df[df['strain'].isin(['Wuhan/Hu-1/2019', 'Wuhan/WH01/2019'])]
+        ref_df = df[df['strain'].isin(REFERENCE_STRAINS)]
         filt_df = pd.concat([filt_df, ref_df])
     return filt_df
 
 
-def filter_seqs(seqs_fp, filtered_metadata):
+def subsample(metadata, group_by, max_per_group, priority_strains=(),
+              seed=0):
+    """
+    Randomly keep at most max_per_group genomes for each combination of the
+    group_by columns ('year' and 'month' are derived from the date as in
+    augur filter --group-by), priority strains are always kept and count
+    towards their group's cap
+    """
+    groups = pd.DataFrame(index=metadata.index)
+    for column in group_by:
+        if column in metadata.columns:
+            groups[column] = metadata[column].to_numpy()
+        elif column in ['year', 'month']:
+            width = 4 if column == 'year' else 7
+            dates = metadata['date'].astype(str).str[:width]
+            groups[column] = dates.where(dates.str.len() == width).to_numpy()
+        else:
+            raise KeyError(f"can't group by {column}, it isn't a metadata "
+                           "column, year, or month")
+
+    group_ids = groups.groupby(group_by, dropna=False, sort=False).ngroup()
+    priority = metadata['strain'].isin(priority_strains).to_numpy()
+
+    # priority strains first then a random order within each group
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(len(metadata)), ~priority))
+    ordered_ids = group_ids.to_numpy()[order]
+    rank = pd.Series(ordered_ids).groupby(ordered_ids).cumcount().to_numpy()
+    keep = np.zeros(len(metadata), dtype=bool)
+    keep[order] = (rank < max_per_group) | priority[order]
+    return metadata[keep]
+
+
+def acgt_length(seq):
+    """
+    Length of a sequence only counting A, C, G, and T (as augur filter
+    --min-length does)
+    """
+    return len(seq.translate(None, NON_ACGT))
+
+
+def acgt_lengths(seqs_fp, strains):
+    """
+    A/C/G/T length of each of the strains in the seqs file, read in a pass
+    before subsampling so genomes failing --min_length aren't sampled
+    """
+    strains = set(strains)
+    lengths = {}
+    for header, seq in read_fasta(seqs_fp):
+        strain = header.split()[0].decode('utf-8')
+        if strain in strains:
+            lengths[strain] = acgt_length(seq)
+    return pd.Series(lengths, dtype=np.int64)
+
+
+def load_mask_sites(mask_vcf):
+    """
+    Load sites to mask from a VCF (e.g., problematic_sites_sarsCov2.vcf)
+    into a boolean array indexed by 0-based position
+    """
+    positions = []
+    with open(mask_vcf) as fh:
+        for line in fh:
+            if not line.startswith('#') and line.strip():
+                positions.append(int(line.split('\t')[1]) - 1)
+    mask = np.zeros(max(positions, default=-1) + 1, dtype=bool)
+    mask[positions] = True
+    return mask
+
+
+def mask_seq(seq, mask_sites=None, mask_from_beginning=0, mask_from_end=0):
     """
-    Parse and filter the seqs file based on the filtered metadata
+    Replace masked sites and the start/end of a sequence with N (as augur
+    mask does)
+    """
+    if mask_sites is None and mask_from_beginning == 0 and mask_from_end == 0:
+        return seq
+    seq = np.frombuffer(seq, dtype=np.uint8).copy()
+    if mask_sites is not None:
+        seq[:len(mask_sites)][mask_sites[:len(seq)]] = ord('N')
+    seq[:mask_from_beginning] = ord('N')
+    if mask_from_end > 0:
+        seq[-mask_from_end:] = ord('N')
+    return seq.tobytes()
+
+
+def filter_seqs(seqs_fp, filtered_metadata, min_length=0, mask_sites=None,
+                mask_from_beginning=0, mask_from_end=0):
+    """
+    Parse and filter the seqs file based on the filtered metadata and
+    (optionally) a minimum ACGT length, masking sequences as they are read
     """
     seq_names = set(filtered_metadata['strain'].values)
     filtered_seqs = []
 
-    if str(seqs_fp).endswith('.gz'):
-        fh = gzip.open(seqs_fp, "rt")
-    else:
-        fh = open(seqs_fp, "r")
-
-    for record in SeqIO.parse(fh, 'fasta'):
-        if record.id in seq_names:
-            filtered_seqs.append(record)
+    for header, seq in read_fasta(seqs_fp):
+        if header.split()[0].decode('utf-8') in seq_names and \
+                acgt_length(seq) >= min_length:
+            filtered_seqs.append((header, mask_seq(seq, mask_sites,
+                                                   mask_from_beginning,
+                                                   mask_from_end)))
     return filtered_seqs
 
 
+def filter_store_seqs(store, filtered_metadata, min_length=0, mask_sites=None,
+                      mask_from_beginning=0, mask_from_end=0):
+    """
+    Filter a genome store using its precomputed A/C/G/T counts so only the
+    selected sequences are unpacked and masked
+    """
+    index = store.index
+    strains = index['name'].str.split(n=1).str[0]
+    selected = index[strains.isin(filtered_metadata['strain']) &
+                     (index['acgt_count'] >= min_length)]
+    return [(name.encode('utf-8'), mask_seq(seq, mask_sites,
+                                            mask_from_beginning,
+                                            mask_from_end))
+            for name, seq in store.items(selected['name'])]
+
+
 def write_output(filtered_metadata, filtered_seqs, output_prefix):
     """
-    Write filtered results
+    Write filtered results, metadata is limited to the sequences written
     """
+    seq_names = set(header.split()[0].decode('utf-8')
+                    for header, _ in filtered_seqs)
+    filtered_metadata = filtered_metadata[filtered_metadata['strain'].isin(seq_names)]
     filtered_metadata.to_csv(output_prefix + "_metadata.tsv", sep='\t',
                              index=False)
 
-    with open(output_prefix + "_seqs.fasta", 'w') as out_fh:
-        SeqIO.write(filtered_seqs, out_fh, 'fasta-2line')
+    with open(output_prefix + "_seqs.fasta", 'wb') as out_fh:
+        for header, seq in filtered_seqs:
+            out_fh.write(b'>' + header + b'\n' + seq + b'\n')
 
 
 if __name__ == "__main__":
@@ -71,10 +216,28 @@ if __name__ == "__main__":
                                      "pandas filter on nextmeta")
     parser.add_argument('-m', '--nextmeta', type=check_file, required=True,
                         help="Path to nextmeta file")
-    parser.add_argument('-f', '--nextfasta', type=check_file, required=True,
+    parser.add_argument('-f', '--nextfasta', type=check_file, default=None,
                         help="Path to nextfasta file")
-    parser.add_argument("-q", "--query", type=str, required=True,
+    parser.add_argument('-g', '--genome_store', default=None,
+                        help="Genome store (genome_store.py) of the nextfasta "
+                             "to read instead of the fasta")
+    parser.add_argument("-q", "--query", type=str, default=None,
                          help="Pandas query e.g., \"pangolin_lineage=='B.1.1.28'\"")
+    parser.add_argument("--mutations", nargs="+", default=[],
+                        help="Only extract genomes with all of these nextclade "
+                             "mutations/deletions e.g., S:E484K S:N501Y "
+                             "(requires --nextclade_output)")
+    parser.add_argument("--exclude_mutations", nargs="+", default=[],
+                        help="Remove genomes with any of these nextclade "
+                             "mutations/deletions, on its own genomes missing "
+                             "from the nextclade output are kept")
+    parser.add_argument("-n", "--nextclade_output", type=check_file,
+                        default=None,
+                        help="nextclade output tsv for the nextfasta used to "
+                             "build/update the mutation index")
+    parser.add_argument("--mutation_index", default=None,
+                        help="Mutation index path (default: "
+                             "<nextclade_output>.mutation_index.npz)")
     parser.add_argument("-o", "--output_prefix", default="filtered",
                         help="Prefix for output filtered metadata and seqs")
     parser.add_argument("--include_reference", default=False,
@@ -83,14 +246,123 @@ if __name__ == "__main__":
     parser.add_argument("--exclude_incomplete_dates", default=False,
                         action='store_true',
                         help="Remove any isolates without a complete date")
-
+    parser.add_argument("--exclude_ambiguous_dates_by", default=None,
+                        choices=['day', 'month', 'year', 'any'],
+                        help="Remove isolates with dates ambiguous at this "
+                             "resolution (as augur filter)")
+    parser.add_argument("--min_length", default=0, type=int,
+                        help="Remove sequences with fewer A/C/G/T bases "
+                             "than this (as augur filter)")
+    parser.add_argument("--mask_sites", default=None, type=check_file,
+                        help="VCF of sites to mask with N e.g., "
+                             "problematic_sites_sarsCov2.vcf (as augur mask)")
+    parser.add_argument("--mask_from_beginning", default=0, type=int,
+                        help="Number of bases to mask from the start of "
+                             "each sequence")
+    parser.add_argument("--mask_from_end", default=0, type=int,
+                        help="Number of bases to mask from the end of each "
+                             "sequence")
+    parser.add_argument("--subsample_by", nargs="+", default=[],
+                        help="Subsample genomes within groups of these "
+                             "metadata columns (year and month are taken "
+                             "from the date) e.g., division month")
+    parser.add_argument("--max_per_group", default=None, type=int,
+                        help="Maximum genomes kept from each --subsample_by "
+                             "group")
+    parser.add_argument("--priority_strains", default=None, type=check_file,
+                        help="File of strain names (one per line) always "
+                             "kept when subsampling, reference strains are "
+                             "always kept with --include_reference")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Random seed for subsampling")
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
+    if (args.nextfasta is None) == (args.genome_store is None):
+        parser.error("one of --nextfasta or --genome_store is required")
+    if args.query is None and not args.mutations and \
+            not args.exclude_mutations:
+        parser.error("one of --query, --mutations, or --exclude_mutations is "
+                     "required")
+    if (args.mutations or args.exclude_mutations) and \
+            args.nextclade_output is None:
+        parser.error("--nextclade_output is required to filter by mutations")
+    if bool(args.subsample_by) != (args.max_per_group is not None):
+        parser.error("--subsample_by and --max_per_group must be used "
+                     "together")
+    metrics = instrumentation.from_args("extract_seqs", args)
+
+    strains = None
+    exclude_strains = None
+    if args.mutations or args.exclude_mutations:
+        with metrics.stage("mutation_index") as stage:
+            index = load_or_build(args.nextclade_output, args.mutation_index)
+            if args.mutations:
+                strains = index.query(args.mutations, args.exclude_mutations)
+                stage['rows'] = len(strains)
+            else:
+                # genomes missing from the nextclade output are kept
+                exclude_strains = index.any_of(args.exclude_mutations)
+                stage['rows'] = len(exclude_strains)
+
+    with metrics.stage("filter_metadata") as stage:
+        filtered_metadata = filter_metadata(args.nextmeta, args.query,
+                                            args.include_reference,
+                                            args.exclude_incomplete_dates,
+                                            args.exclude_ambiguous_dates_by,
+                                            strains, exclude_strains)
+        stage['rows'] = len(filtered_metadata)
+
+    store = None
+    if args.genome_store is not None:
+        store = GenomeStore(args.genome_store)
+
+    if args.subsample_by:
+        with metrics.stage("subsample") as stage:
+            # drop genomes without a sequence or failing --min_length
+            # before sampling so groups are filled from genomes that are
+            # written, without a store that takes an extra pass over the
+            # fasta so it is only done for --min_length
+            lengths = None
+            if store is not None:
+                lengths = pd.Series(
+                    store.index['acgt_count'].to_numpy(),
+                    index=store.index['name'].str.split(n=1).str[0])
+            elif args.min_length > 0:
+                lengths = acgt_lengths(args.nextfasta,
+                                       filtered_metadata['strain'])
+            if lengths is not None:
+                long_enough = lengths.index[lengths >= args.min_length]
+                filtered_metadata = filtered_metadata[
+                    filtered_metadata['strain'].isin(long_enough)]
+            priority_strains = []
+            if args.priority_strains is not None:
+                priority_strains = args.priority_strains.read_text().split()
+            if args.include_reference:
+                priority_strains += REFERENCE_STRAINS
+            filtered_metadata = subsample(filtered_metadata, args.subsample_by,
+                                          args.max_per_group,
+                                          priority_strains, args.seed)
+            stage['rows'] = len(filtered_metadata)
 
-    filtered_metadata = filter_metadata(args.nextmeta, args.query,
-                                        args.include_reference,
-                                        args.exclude_incomplete_dates)
+    mask_sites = None
+    if args.mask_sites is not None:
+        mask_sites = load_mask_sites(args.mask_sites)
 
-    filtered_seqs = filter_seqs(args.nextfasta, filtered_metadata)
+    with metrics.stage("filter_seqs") as stage:
+        if store is not None:
+            filtered_seqs = filter_store_seqs(store,
+                                              filtered_metadata,
+                                              args.min_length, mask_sites,
+                                              args.mask_from_beginning,
+                                              args.mask_from_end)
+        else:
+            filtered_seqs = filter_seqs(args.nextfasta, filtered_metadata,
+                                        args.min_length, mask_sites,
+                                        args.mask_from_beginning,
+                                        args.mask_from_end)
+        stage['rows'] = len(filtered_seqs)
 
-    write_output(filtered_metadata, filtered_seqs, args.output_prefix)
+    with metrics.stage("write", rows=len(filtered_seqs)):
+        write_output(filtered_metadata, filtered_seqs, args.output_prefix)
+    metrics.close()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import gzip
+
+
+def parse_fasta(fh):
+    """
+    Stream (header, sequence) byte pairs from a fasta file handle, header is
+    the full header line without the '>'
+    """
+    header = None
+    seq_chunks = []
+    for line in fh:
+        if line.startswith(b'>'):
+            if header is not None:
+                yield header, b''.join(seq_chunks)
+            header = line[1:].strip()
+            seq_chunks = []
+        else:
+            seq_chunks.append(line.strip())
+    if header is not None:
+        yield header, b''.join(seq_chunks)
+
+
+def read_fasta(fasta_path):
+    """
+    Stream (header, sequence) byte pairs from a (optionally gzipped) fasta
+    """
+    opener = gzip.open if str(fasta_path).endswith('.gz') else open
+    with opener(fasta_path, 'rb') as fh:
+        yield from parse_fasta(fh)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from fasta_reader import read_fasta
+import instrumentation
+
+
+# 4-bit codes for gaps, bases, and IUPAC ambiguity codes, anything else is
+# stored as N
+ALPHABET = b'-ACGTRYSWKMBDHVN'
+ENCODE = np.full(256, ALPHABET.index(b'N'), dtype=np.uint8)
+for code, base in enumerate(ALPHABET):
+    ENCODE[base] = code
+    ENCODE[ord(chr(base).lower())] = code
+DECODE = np.frombuffer(ALPHABET, dtype=np.uint8)
+N_CODE = ALPHABET.index(b'N')
+ACGT_CODES = [ALPHABET.index(base) for base in b'ACGT']
+
+INDEX_COLUMNS = ['name', 'offset', 'length', 'n_count', 'acgt_count']
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def pack(seq: bytes):
+    """
+    Pack a sequence two bases per byte, returns the packed bytes and the
+    N and A/C/G/T counts
+    """
+    codes = ENCODE[np.frombuffer(seq, dtype=np.uint8)]
+    counts = np.bincount(codes, minlength=len(ALPHABET))
+    if len(codes) % 2:
+        codes = np.append(codes, np.uint8(0))
+    packed = (codes[0::2] << 4) | codes[1::2]
+    return (packed.astype(np.uint8).tobytes(), int(counts[N_CODE]),
+            int(counts[ACGT_CODES].sum()))
+
+
+def unpack(packed: np.ndarray, length: int) -> np.ndarray:
+    """
+    Unpack 4-bit codes to sequence bytes as a uint8 array
+    """
+    codes = np.empty(len(packed) * 2, dtype=np.uint8)
+    codes[0::2] = packed >> 4
+    codes[1::2] = packed & 0x0F
+    return DECODE[codes[:length]]
+
+
+class GenomeStore:
+    """
+    Directory of 4-bit packed genomes (sequences.bin) memory-mapped for
+    random access, with an index (index.tsv) of each genome's byte offset,
+    length, N count, and A/C/G/T count
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.sequences_path = self.path / "sequences.bin"
+        self.index_path = self.path / "index.tsv"
+        self.load()
+
+    def load(self):
+        if self.index_path.exists():
+            self.index = pd.read_csv(self.index_path, sep='\t',
+                                     quoting=csv.QUOTE_NONE,
+                                     dtype={'name': str, 'offset': np.int64,
+                                            'length': np.int64,
+                                            'n_count': np.int64,
+                                            'acgt_count': np.int64},
+                                     keep_default_na=False)
+        else:
+            self.index = pd.DataFrame({column: [] for column in INDEX_COLUMNS})
+        self.index = self.index.set_index('name', drop=False)
+        if self.sequences_path.exists() and \
+                self.sequences_path.stat().st_size > 0:
+            self.sequences = np.memmap(self.sequences_path, dtype=np.uint8,
+                                       mode='r')
+        else:
+            self.sequences = np.array([], dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index.index
+
+    @property
+    def names(self):
+        return self.index['name']
+
+    def get_array(self, name) -> np.ndarray:
+        """
+        Sequence as a uint8 array (e.g., for masking in place)
+        """
+        record = self.index.loc[name]
+        offset, length = int(record['offset']), int(record['length'])
+        return unpack(self.sequences[offset: offset + (length + 1) // 2],
+                      length)
+
+    def get(self, name) -> bytes:
+        return self.get_array(name).tobytes()
+
+    def items(self, names=None):
+        """
+        Stream (name, sequence bytes) for all or only the named genomes in
+        the order they are stored
+        """
+        index = self.index if names is None else \
+            self.index[self.index['name'].isin(names)]
+        for name in index.sort_values('offset')['name']:
+            yield name, self.get(name)
+
+    def add_fasta(self, fasta_path):
+        """
+        Pack genomes from a (optionally gzipped) fasta into the store,
+        genomes already in the store are skipped, returns number added
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        offset = self.sequences_path.stat().st_size \
+            if self.sequences_path.exists() else 0
+        existing = set(self.index['name'])
+        new_index = not self.index_path.exists()
+        added = 0
+        with open(self.sequences_path, 'ab') as seq_fh, \
+                open(self.index_path, 'a') as index_fh:
+            if new_index:
+                index_fh.write("\t".join(INDEX_COLUMNS) + "\n")
+            for header, seq in read_fasta(fasta_path):
+                name = header.decode('utf-8')
+                if name in existing:
+                    continue
+                if '\t' in name:
+                    raise ValueError(f"{fasta_path}: can't store {name!r}, "
+                                     "the index is tab separated so headers "
+                                     "can't contain tabs")
+                packed, n_count, acgt_count = pack(seq)
+                seq_fh.write(packed)
+                index_fh.write(f"{name}\t{offset}\t{len(seq)}\t{n_count}\t"
+                               f"{acgt_count}\n")
+                offset += len(packed)
+                existing.add(name)
+                added += 1
+        self.load()
+        return added
+
+    def export_fasta(self, output, names=None, line_width=None):
+        """
+        Write all or only the named genomes to a fasta, returns number
+        written
+        """
+        written = 0
+        with open(output, 'wb') as out_fh:
+            for name, seq in self.items(names):
+                written += 1
+                out_fh.write(b'>' + name.encode('utf-8') + b'\n')
+                if line_width is None:
+                    out_fh.write(seq + b'\n')
+                else:
+                    for start in range(0, len(seq), line_width):
+                        out_fh.write(seq[start: start + line_width] + b'\n')
+        return written
+
+    def composition(self):
+        """
+        Per genome %N and %A/C/G/T from the precomputed counts
+        """
+        length = self.index['length'].clip(lower=1)
+        return pd.DataFrame({'name': self.index['name'].to_numpy(),
+                             'PERCENT_N': (self.index['n_count'] / length
+                                           * 100).to_numpy(),
+                             'PERCENT_ACGT': (self.index['acgt_count'] / length
+                                              * 100).to_numpy()})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Pack genomes into a memory-mapped 4-bit "
+                                     "genome store or export them to fasta")
+    parser.add_argument("-s", "--store", required=True,
+                        help="Genome store directory")
+    parser.add_argument("-i", "--import_fasta", nargs="+", default=[],
+                        type=check_file,
+                        help="Fasta files (optionally gzipped) to add to the "
+                             "store")
+    parser.add_argument("-e", "--export_fasta", default=None,
+                        help="Write genomes in the store to this fasta")
+    parser.add_argument("-n", "--names", default=None, type=check_file,
+                        help="File of genome names (one per line) to export "
+                             "instead of all genomes")
+    parser.add_argument("-w", "--line_width", default=None, type=int,
+                        help="Wrap exported sequences at this width")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("genome_store", args)
+
+    store = GenomeStore(args.store)
+    for fasta in args.import_fasta:
+        with metrics.stage("import") as stage:
+            added = store.add_fasta(fasta)
+            stage['rows'] = added
+        print(f"Added {added} genomes from {fasta}")
+
+    if args.export_fasta is not None:
+        names = None
+        if args.names is not None:
+            names = set(args.names.read_text().split())
+        with metrics.stage("export") as stage:
+            stage['rows'] = store.export_fasta(args.export_fasta, names,
+                                               args.line_width)
+    metrics.close()
+
+    print(f"{len(store)} genomes in {args.store} "
+          f"({store.sequences_path.stat().st_size / 1024 / 1024:.1f}MB)"
+          if store.sequences_path.exists() else f"{args.store} is empty")
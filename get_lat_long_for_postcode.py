@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
-import pgeocode
 from pathlib import Path
 import pandas as pd
+import instrumentation
 
 def check_file(path: str) -> Path:
     """
@@ -16,33 +16,111 @@ def check_file(path: str) -> Path:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
 
-def add_canada_lat_long(metadata, lat_long):
+GEONAMES_COLUMNS = ["country_code", "postal_code", "place_name",
+                    "state_name", "state_code", "county_name", "county_code",
+                    "community_name", "community_code", "latitude",
+                    "longitude", "accuracy"]
+
+
+def load_postal_table(postal_table_path=None):
+    """
+    Load Canadian postal code coordinates into a lat/long table indexed by
+    FSA (first 3 characters of the postcode).
+
+    Reads either a geonames postal code dump (e.g., CA.txt) or pgeocode's
+    locally cached copy, only downloading through pgeocode if neither is
+    available
+    """
+    if postal_table_path is None:
+        import pgeocode
+        postal_table_path = Path(pgeocode.STORAGE_DIR) / "CA.txt"
+        if not postal_table_path.exists():
+            # downloads and caches CA.txt
+            pgeocode.Nominatim('CA')
+
+    # pgeocode caches as a csv with a header, geonames dumps are
+    # headerless tsvs
+    with open(postal_table_path) as fh:
+        has_header = fh.readline().startswith("country_code")
+    postal_table = pd.read_csv(postal_table_path,
+                               sep=',' if has_header else '\t',
+                               header=0 if has_header else None,
+                               names=None if has_header else GEONAMES_COLUMNS,
+                               usecols=["postal_code", "latitude",
+                                        "longitude"],
+                               dtype={"postal_code": str})
+    return fsa_lat_longs(postal_table)
+
+
+def fsa_lat_longs(postal_table):
+    """
+    Collapse a postal code table to one mean lat/long per FSA
+    """
+    postal_table = postal_table[["postal_code", "latitude", "longitude"]]
+    fsa = postal_table["postal_code"].str.upper().str[:3]
+    fsa_table = postal_table.groupby(fsa)[["latitude", "longitude"]].mean()
+    return fsa_table.sort_index()
+
+
+def load_fsa_cache(cache_path):
     """
-    Use pgeocode to add lat and longs for canadian locations
+    Load previously resolved FSA lat/longs
+    """
+    if cache_path is None or not Path(cache_path).exists():
+        return pd.DataFrame(columns=["lat", "long"],
+                            index=pd.Index([], name="geo_loc"))
+    return pd.read_csv(cache_path, sep='\t', index_col="geo_loc")
+
+
+def geocode_postcodes(postcodes, postal_table_path=None, cache_path=None):
+    """
+    Get lat/long for a set of postcodes in one batch lookup, only postcodes
+    not already in the FSA cache are looked up in the postal table
+    """
+    fsa_cache = load_fsa_cache(cache_path)
+    postcodes = pd.Index(sorted(postcodes), name="geo_loc")
+    new_postcodes = postcodes.difference(fsa_cache.index)
+
+    if len(new_postcodes) > 0:
+        fsa_table = load_postal_table(postal_table_path)
+        resolved = fsa_table.reindex(new_postcodes.str.upper())
+        resolved = pd.DataFrame({"lat": resolved["latitude"].to_numpy(),
+                                 "long": resolved["longitude"].to_numpy()},
+                                index=new_postcodes)
+        fsa_cache = pd.concat([fsa_cache, resolved])
+        if cache_path is not None:
+            fsa_cache.to_csv(cache_path, sep='\t')
+
+    return fsa_cache.reindex(postcodes)
+
+
+def add_canada_lat_long(metadata, lat_longs, postal_table_path=None,
+                        cache_path=None):
+    """
+    Add lat and longs for canadian postcode locations
     """
     # get all locations in lat long file to check which need added
     loc_lat_longs = set(lat_longs.query('geo_scale=="location"')['geo_loc'].unique())
 
-    # get canada locs that are postcodes and not in lat long already
-    canada = metadata.query('country=="Canada"')
-    postcodes = canada.loc[canada['location'].str.match("^[a-zA-Z][0-9][a-zA-Z]$").fillna(False), 'location'].unique()
+    # get canada locs that are postcodes and not in lat long already,
+    # matching each distinct location once rather than every row
+    canada_locations = metadata.loc[metadata['country'] == "Canada",
+                                    'location'].dropna().unique()
+    canada_locations = pd.Index(canada_locations).astype(str)
+    postcodes = canada_locations[canada_locations.str.match("^[a-zA-Z][0-9][a-zA-Z]$")]
     postcodes = set(postcodes) - loc_lat_longs
 
-    # get geocode database
-    geocode = pgeocode.Nominatim('CA')
-    postcode_lat_long = {'geo_scale': [],
-                         'geo_loc': [],
-                         'lat': [],
-                         'long': []}
-    for postcode in postcodes:
-        geoloc_for_postcode = geocode.query_postal_code(postcode)
-        postcode_lat_long['geo_scale'].append('location')
-        postcode_lat_long['geo_loc'].append(postcode)
-        postcode_lat_long['lat'].append(geoloc_for_postcode['latitude'])
-        postcode_lat_long['long'].append(geoloc_for_postcode['longitude'])
-
-    # update lat_longs with postcode locations
-    updated_lat_longs = lat_longs.append(pd.DataFrame(postcode_lat_long))
+    postcode_lat_long = geocode_postcodes(postcodes, postal_table_path,
+                                          cache_path)
+    postcode_lat_long = postcode_lat_long.reset_index()
+    postcode_lat_long.insert(0, 'geo_scale', 'location')
+
+    # update lat_longs with postcode locations keeping existing entries
+    updated_lat_longs = pd.concat([lat_longs, postcode_lat_long],
+                                  ignore_index=True)
+    updated_lat_longs = updated_lat_longs.drop_duplicates(subset=['geo_scale',
+                                                                  'geo_loc'],
+                                                          keep='first')
     return updated_lat_longs
 
 
@@ -57,15 +135,33 @@ if __name__ == "__main__":
                          help="ncov lat_long file e.g., ncov/defaults/lat_longs.tsv")
     parser.add_argument("-o", "--output", default="custom_lat_longs.tsv",
                         help="Path to write updated lat_longs file")
+    parser.add_argument("-p", "--postal_table", default=None,
+                        type=check_file,
+                        help="Local geonames postal code table for Canada "
+                             "(default: pgeocode's cached CA.txt)")
+    parser.add_argument("-c", "--fsa_cache", default="fsa_lat_longs.tsv",
+                        help="Persistent cache of resolved postcode "
+                             "lat/longs")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    metrics = instrumentation.from_args("get_lat_long_for_postcode", args)
 
-    metadata = pd.read_csv(args.metadata, sep='\t')
-    lat_longs = pd.read_csv(args.lat_longs, sep='\t', names=["geo_scale",
-                                                             "geo_loc",
-                                                             "lat",
-                                                             "long"])
+    with metrics.stage("read") as stage:
+        # only the country and location are needed
+        metadata = pd.read_csv(args.metadata, sep='\t',
+                               usecols=['country', 'location'],
+                               dtype='category')
+        lat_longs = pd.read_csv(args.lat_longs, sep='\t',
+                                names=["geo_scale", "geo_loc", "lat", "long"])
+        stage['rows'] = len(metadata)
 
-    postcode_added_lat_longs = add_canada_lat_long(metadata, lat_longs)
+    with metrics.stage("geocode") as stage:
+        postcode_added_lat_longs = add_canada_lat_long(metadata, lat_longs,
+                                                       args.postal_table,
+                                                       args.fsa_cache)
+        stage['rows'] = len(postcode_added_lat_longs) - len(lat_longs)
 
-    postcode_added_lat_longs.to_csv(args.output, sep='\t', header=False,
-                                    index=False)
+    with metrics.stage("write", rows=len(postcode_added_lat_longs)):
+        postcode_added_lat_longs.to_csv(args.output, sep='\t', header=False,
+                                        index=False)
+    metrics.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def add_arguments(parser):
+    """
+    Add the shared --metrics_out and --profile options to a script's parser
+    """
+    parser.add_argument("--metrics_out", default=None,
+                        help="Append per-stage wall/CPU time, peak RSS, and "
+                             "row counts to this JSON-lines file (process_* "
+                             "values cover the whole process, including any "
+                             "stages running at the same time)")
+    parser.add_argument("--profile", default=None,
+                        help="Write a cProfile dump of the run's main thread "
+                             "to this path, work in worker threads or "
+                             "processes isn't included (view with python -m "
+                             "pstats)")
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size over the whole run so far of this process and of
+    its largest waited-for child (e.g., pangolin, minimap2) in MB
+    """
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_rss / scale, children_rss / scale
+
+
+class Metrics:
+    """
+    Records stage metrics as JSON lines, does nothing other than run the
+    stages when no metrics file or profile is given.  Only wall time and
+    thread CPU time are specific to a stage, CPU time of the process and
+    its children and peak RSS include anything else running at the time
+    """
+    def __init__(self, script, metrics_out=None, profile=None):
+        self.script = script
+        self.metrics_out = metrics_out
+        self.profile = profile
+        self.run = datetime.now().isoformat(timespec='seconds')
+        self.profiler = None
+        if profile is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            # still write the profile if the script fails
+            atexit.register(self.close)
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Time a stage, set record['rows'] in the block to record a row
+        count once it is known
+        """
+        record = {'rows': rows}
+        if self.metrics_out is None:
+            yield record
+            return
+
+        wall_start = time.perf_counter()
+        thread_start = time.thread_time()
+        cpu_start = time.process_time()
+        children_start = os.times()
+        failed = True
+        try:
+            yield record
+            failed = False
+        finally:
+            children_end = os.times()
+            self_rss, children_rss = peak_rss_mb()
+            record = {'script': self.script,
+                      'run': self.run,
+                      'stage': name,
+                      'wall_seconds': round(time.perf_counter() - wall_start,
+                                            4),
+                      'thread_cpu_seconds': round(
+                          time.thread_time() - thread_start, 4),
+                      'process_cpu_seconds': round(
+                          time.process_time() - cpu_start, 4),
+                      'process_child_cpu_seconds': round(
+                          (children_end.children_user +
+                           children_end.children_system) -
+                          (children_start.children_user +
+                           children_start.children_system), 4),
+                      'process_peak_rss_mb': round(self_rss, 1),
+                      'process_child_peak_rss_mb': round(children_rss, 1),
+                      'rows': record['rows'],
+                      'failed': failed}
+            with open(self.metrics_out, 'a') as out_fh:
+                out_fh.write(json.dumps(record) + "\n")
+
+    def close(self):
+        """
+        Write the cProfile dump if profiling
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile)
+            self.profiler = None
+
+
+def from_args(script, args):
+    """
+    Metrics for a script from its parsed --metrics_out/--profile options
+    """
+    return Metrics(script, args.metrics_out, args.profile)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+import pandas as pd
+from sqlite_batches import select_in
+from fasta_reader import read_fasta
+
+
+def sequence_hash(seq):
+    """
+    Hash a normalised (uppercase, no gaps or whitespace) sequence
+    """
+    return hashlib.sha256(seq.upper().replace(b'-', b'')).hexdigest()
+
+
+def hash_fasta(fasta_path):
+    """
+    Get the sequence hash for every record in a fasta
+    """
+    return {name.decode('utf-8'): sequence_hash(seq)
+            for name, seq in read_fasta(fasta_path)}
+
+
+def write_fasta_subset(fasta_path, names, output_path):
+    """
+    Write only the named records from a fasta, returns number written
+    """
+    names = set(names)
+    written = 0
+    with open(output_path, 'wb') as out_fh:
+        for name, seq in read_fasta(fasta_path):
+            if name.decode('utf-8') in names:
+                out_fh.write(b'>' + name + b'\n' + seq + b'\n')
+                written += 1
+    return written
+
+
+def deduplicate(name_hashes, names=None):
+    """
+    First name for each unique sequence hash among the names (all by default)
+    """
+    names = name_hashes if names is None else names
+    representatives = {}
+    for name in names:
+        representatives.setdefault(name_hashes[name], name)
+    return list(representatives.values())
+
+
+def match_headers(ids, headers):
+    """
+    Map the IDs a tool reports back to fasta headers, pangolin reports
+    headers with whitespace replaced by '_' or only their first word,
+    IDs that don't match any header are NaN
+    """
+    lookup = {header: header for header in headers}
+    for header in headers:
+        words = header.split()
+        if words:
+            lookup.setdefault('_'.join(words), header)
+            lookup.setdefault(words[0], header)
+    return ids.astype(str).map(lookup)
+
+
+def fan_out(df, name_hashes, names, id_column):
+    """
+    Copy each representative's row to every named sequence with the same
+    hash, warning about rows that can't be matched to a sequence and
+    sequences left without a row
+    """
+    if df is None or df.empty:
+        return df
+    names = list(names)
+    targets = pd.DataFrame({id_column: names,
+                            'seq_hash': [name_hashes[name] for name in names]})
+    headers = match_headers(df[id_column],
+                            deduplicate(name_hashes, names))
+    unmatched = df.loc[headers.isna(), id_column].astype(str)
+    if len(unmatched):
+        sys.stderr.write(f"{len(unmatched)} {id_column} values don't match "
+                         "an input fasta header e.g., "
+                         f"{', '.join(unmatched[:5])}\n")
+    rows = df.drop(columns=id_column)
+    rows['seq_hash'] = headers.map(name_hashes)
+    fanned = targets.merge(rows, on='seq_hash').drop(columns='seq_hash')[
+        df.columns]
+    if len(fanned) < len(names):
+        sys.stderr.write(f"{len(names) - len(fanned)}/{len(names)} genomes "
+                         "have no assignment\n")
+    return fanned
+
+
+def assign_unique(input_genomes, names, name_hashes, unique_fasta, assign,
+                  id_column, log_fh=None):
+    """
+    Run assign (returning a dataframe or tuple of dataframes) on a fasta of
+    one representative per unique sequence among the names then fan the rows
+    back out to every name, reporting how many assignments were saved
+    """
+    representatives = deduplicate(name_hashes, names)
+    write_fasta_subset(input_genomes, representatives, unique_fasta)
+    start = time.perf_counter()
+    try:
+        assigned = assign(unique_fasta)
+    finally:
+        Path(unique_fasta).unlink(missing_ok=True)
+    elapsed = time.perf_counter() - start
+
+    duplicates = len(names) - len(representatives)
+    saved = elapsed / max(len(representatives), 1) * duplicates
+    message = (f"{len(representatives)}/{len(names)} genomes unique "
+               f"(dedup ratio {len(names) / max(len(representatives), 1):.2f}"
+               f"), ~{saved:.1f}s of assignment saved")
+    print(message)
+    if log_fh is not None:
+        log_fh.write(message + "\n")
+        log_fh.flush()
+
+    if isinstance(assigned, tuple):
+        return tuple(fan_out(df, name_hashes, names, id_column)
+                     for df in assigned)
+    return fan_out(assigned, name_hashes, names, id_column)
+
+
+class LineageCache:
+    """
+    Persistent store of assignment rows for each tool keyed by sequence
+    hash, all rows for a tool are dropped when the tool version changes
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions "
+                        "(tool TEXT PRIMARY KEY, version TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS assignments "
+                        "(tool TEXT, seq_hash TEXT, row TEXT, "
+                        "PRIMARY KEY (tool, seq_hash))")
+        self.db.commit()
+
+    def check_version(self, tool, version):
+        """
+        Invalidate cached rows for a tool if its version has changed
+        """
+        cached = self.db.execute("SELECT version FROM versions WHERE tool=?",
+                                 (tool,)).fetchone()
+        if cached is None or cached[0] != version:
+            self.db.execute("DELETE FROM assignments WHERE tool=?", (tool,))
+            self.db.execute("INSERT OR REPLACE INTO versions VALUES (?, ?)",
+                            (tool, version))
+            self.db.commit()
+
+    def lookup(self, tool, version, seq_hashes):
+        """
+        Get cached rows for a set of sequence hashes as a dict of
+        hash: row dict
+        """
+        self.check_version(tool, version)
+        cached = {}
+        for seq_hash, row in select_in(self.db,
+                                       "SELECT seq_hash, row FROM assignments "
+                                       "WHERE tool=? AND seq_hash IN "
+                                       "({placeholders})",
+                                       [tool], set(seq_hashes)):
+            cached[seq_hash] = json.loads(row)
+        return cached
+
+    def store(self, tool, version, rows):
+        """
+        Save a dict of hash: row dict for a tool
+        """
+        self.check_version(tool, version)
+        self.db.executemany("INSERT OR REPLACE INTO assignments "
+                            "VALUES (?, ?, ?)",
+                            [(tool, seq_hash, json.dumps(row))
+                             for seq_hash, row in rows.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def split_cached(cache, tools, name_hashes):
+    """
+    Find which sequences are cached for every tool, returns the cached rows
+    per tool and the names of sequences that still need assigned
+    """
+    cached = {tool: cache.lookup(tool, version, name_hashes.values())
+              for tool, version in tools.items()}
+    uncached = [name for name, seq_hash in name_hashes.items()
+                if any(seq_hash not in cached[tool] for tool in tools)]
+    return cached, uncached
+
+
+def cached_rows_to_df(cached_rows, name_hashes, names, id_column):
+    """
+    Build a dataframe of cached rows for the named sequences
+    """
+    rows = []
+    for name in names:
+        seq_hash = name_hashes[name]
+        if seq_hash in cached_rows:
+            row = dict(cached_rows[seq_hash])
+            row[id_column] = name
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def df_to_cache_rows(df, name_hashes, id_column):
+    """
+    Convert fresh assignments into hash: row dicts for storing
+    """
+    rows = {}
+    uncached = 0
+    for row in df.to_dict(orient='records'):
+        name = str(row.pop(id_column))
+        if name in name_hashes:
+            # missing values (NaN/pd.NA) are stored as null
+            rows[name_hashes[name]] = {col: None if pd.isna(value) else value
+                                       for col, value in row.items()}
+        else:
+            uncached += 1
+    if uncached:
+        sys.stderr.write(f"{uncached} assignments don't match an input "
+                         "fasta header and weren't cached\n")
+    return rows
+
+
+def merge_cached(cache, tool, version, fresh_df, cached_rows, name_hashes,
+                 id_column):
+    """
+    Store fresh assignments and combine them with the cached rows for
+    every sequence that wasn't freshly assigned
+    """
+    if fresh_df is not None and not fresh_df.empty:
+        # use the fasta headers for fresh rows as cached rows do
+        fresh_df = fresh_df.copy()
+        fresh_df[id_column] = match_headers(fresh_df[id_column],
+                                            list(name_hashes)).fillna(
+            fresh_df[id_column].astype(str))
+        cache.store(tool, version, df_to_cache_rows(fresh_df, name_hashes,
+                                                    id_column))
+        fresh_names = set(fresh_df[id_column].astype(str))
+    else:
+        fresh_names = set()
+    cached_names = [name for name in name_hashes if name not in fresh_names]
+    cached_df = cached_rows_to_df(cached_rows, name_hashes, cached_names,
+                                  id_column)
+    frames = [df for df in [fresh_df, cached_df]
+              if df is not None and not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=[id_column])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import instrumentation
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def source_signature(path) -> str:
+    """
+    Size and modification time of the nextclade output an index was built
+    from, to tell when it needs rebuilding
+    """
+    stat = Path(path).stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def encode_strings(strings) -> np.ndarray:
+    """
+    Newline joined bytes, much smaller and faster to load than a numpy
+    unicode array
+    """
+    return np.frombuffer("\n".join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def decode_strings(encoded: np.ndarray) -> list:
+    if len(encoded) == 0:
+        return []
+    return encoded.tobytes().decode('utf-8').split("\n")
+
+
+class MutationIndex:
+    """
+    Inverted index of nextclade amino acid substitutions and deletions to
+    the sorted IDs of the genomes carrying them
+    """
+    def __init__(self, names, mutations, offsets, ids, source=""):
+        self.names = np.asarray(names, dtype=object)
+        self.mutations = list(mutations)
+        self.mutation_ix = {mutation: ix
+                            for ix, mutation in enumerate(self.mutations)}
+        self.offsets = offsets
+        self.ids = ids
+        self.source = source
+
+    @classmethod
+    def build(cls, nextclade_path):
+        """
+        Build the index from a nextclade output tsv
+        """
+        nextclade = pd.read_csv(nextclade_path, sep='\t',
+                                usecols=['seqName', 'aaSubstitutions',
+                                         'aaDeletions'],
+                                dtype=str)
+        changes = nextclade['aaSubstitutions'].fillna('') + ',' + \
+            nextclade['aaDeletions'].fillna('')
+        changes = changes.str.split(',').explode()
+        changes = changes[changes != '']
+
+        genome_ids = changes.index.to_numpy(dtype=np.uint32)
+        codes, mutations = pd.factorize(changes.to_numpy(), sort=True)
+        # group genome IDs by mutation, each group sorted for intersections
+        order = np.lexsort((genome_ids, codes))
+        codes, genome_ids = codes[order], genome_ids[order]
+        # a mutation listed twice for a genome is only indexed once
+        unique = np.ones(len(codes), dtype=bool)
+        unique[1:] = (codes[1:] != codes[:-1]) | \
+            (genome_ids[1:] != genome_ids[:-1])
+        codes, genome_ids = codes[unique], genome_ids[unique]
+
+        counts = np.bincount(codes, minlength=len(mutations))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(nextclade['seqName'].to_numpy(), mutations, offsets,
+                   genome_ids, source_signature(nextclade_path))
+
+    def save(self, path):
+        # written through a handle so numpy doesn't add a .npz suffix
+        with open(path, 'wb') as out_fh:
+            np.savez_compressed(out_fh, names=encode_strings(self.names),
+                                mutations=encode_strings(self.mutations),
+                                offsets=self.offsets, ids=self.ids,
+                                source=np.array(self.source))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            return cls(decode_strings(index['names']),
+                       decode_strings(index['mutations']), index['offsets'],
+                       index['ids'], str(index['source']))
+
+    def genomes(self, mutation) -> np.ndarray:
+        """
+        Sorted IDs of genomes with a mutation
+        """
+        ix = self.mutation_ix.get(mutation)
+        if ix is None:
+            return np.array([], dtype=np.uint32)
+        return self.ids[self.offsets[ix]: self.offsets[ix + 1]]
+
+    def any_of(self, mutations) -> np.ndarray:
+        """
+        Names of genomes with any of the mutations
+        """
+        ids = [self.genomes(mutation) for mutation in mutations]
+        if not ids:
+            return self.names[:0]
+        return self.names[np.unique(np.concatenate(ids))]
+
+    def query(self, require=(), exclude=()) -> np.ndarray:
+        """
+        Names of genomes with all the required mutations and none of the
+        excluded ones
+        """
+        if require:
+            # intersect starting from the rarest mutation
+            selected = sorted((self.genomes(mutation) for mutation in require),
+                              key=len)
+            ids = selected[0]
+            for genomes in selected[1:]:
+                ids = np.intersect1d(ids, genomes, assume_unique=True)
+        else:
+            ids = np.arange(len(self.names), dtype=np.uint32)
+        for mutation in exclude:
+            ids = np.setdiff1d(ids, self.genomes(mutation), assume_unique=True)
+        return self.names[ids]
+
+
+def index_path(nextclade_path) -> Path:
+    """
+    Default location of the index for a nextclade output
+    """
+    return Path(str(nextclade_path) + ".mutation_index.npz")
+
+
+def load_or_build(nextclade_path, path=None) -> MutationIndex:
+    """
+    Load a saved index, building (and saving) it first if there isn't one
+    or the nextclade output has changed since it was built
+    """
+    path = Path(path) if path is not None else index_path(nextclade_path)
+    if path.exists():
+        index = MutationIndex.load(path)
+        if index.source == source_signature(nextclade_path):
+            return index
+    index = MutationIndex.build(nextclade_path)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Build an inverted index of nextclade "
+                                     "mutations for extract_seqs.py "
+                                     "--mutations queries")
+    parser.add_argument("-n", "--nextclade_output", required=True,
+                        type=check_file,
+                        help="Path to nextclade output tsv")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Index path (default: <nextclade_output>"
+                             ".mutation_index.npz)")
+    parser.add_argument("-m", "--mutations", nargs="+", default=[],
+                        help="Report how many genomes carry all of these "
+                             "mutations e.g., S:E484K S:N501Y")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("mutation_index", args)
+
+    with metrics.stage("build") as stage:
+        index = load_or_build(args.nextclade_output, args.output)
+        stage['rows'] = len(index.names)
+    print(f"{len(index.mutations)} mutations indexed across "
+          f"{len(index.names)} genomes")
+    if args.mutations:
+        with metrics.stage("query") as stage:
+            start = time.perf_counter()
+            genomes = index.query(args.mutations)
+            stage['rows'] = len(genomes)
+        print(f"{len(genomes)} genomes with {', '.join(args.mutations)} "
+              f"({(time.perf_counter() - start) * 1000:.1f}ms)")
+    metrics.close()
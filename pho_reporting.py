@@ -2,11 +2,25 @@
 
 import argparse
 import subprocess
+import sys
 from pathlib import Path
 import time
+import re
+import tempfile
+import threading
 import pandas as pd
-import pysam
+import numpy as np
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+import service_client
+from genome_store import GenomeStore
+from fasta_reader import read_fasta
+from lineage_cache import LineageCache, hash_fasta, write_fasta_subset, \
+    split_cached, merge_cached, assign_unique
+
+
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
 
 
 def check_file(path: str) -> Path:
@@ -20,21 +34,21 @@ def check_file(path: str) -> Path:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
 
-def update_pangolin():
+def update_pangolin(stderr=None):
     """
     Ensure pangolin is updated to the latest release
     """
-    subprocess.check_output(["pangolin", "--update"])
+    subprocess.check_output(["pangolin", "--update"], stderr=stderr)
 
 
-def run_pangolin(input_genomes, threads):
+def run_pangolin(input_genomes, threads, stderr=subprocess.DEVNULL):
     """
     Execute pangolin and collect assignments
     """
     output_dir = Path(f"pangolin_tmp_{time.time()}")
     subprocess.check_output(f"pangolin {input_genomes} -t {threads} "
                             f"-o {str(output_dir)}".split(),
-                            stderr=subprocess.DEVNULL)
+                            stderr=stderr)
 
     output_path = output_dir / "lineage_report.csv"
     if not output_path.exists():
@@ -64,36 +78,300 @@ def run_pangolin(input_genomes, threads):
     return pangolin_df
 
 
-def genome_completeness(input_genomes, reference_genome, threads):
+def cigar_match_length(cigar):
     """
-    Just calculate genome completeness by %N from minimap2 alignment
+    Sum the aligned (M/=/X) lengths in a CIGAR string without expanding
+    it into per-base pairs
     """
-    output_dir = Path(f"minimap2_tmp_{time.time()}")
-    output_dir.mkdir()
-    subprocess.check_output(f"minimap2 -a -x asm5 --secondary=no "
-                            f"-t {threads} "
-                            f"{reference_genome} {input_genomes} "
-                            f"-o {output_dir}/align.sam".split(),
-                            stderr=subprocess.DEVNULL)
+    return sum(int(length) for length, op in CIGAR_RE.findall(cigar)
+               if op in 'M=X')
 
-    output_path = output_dir / "align.sam"
-    if not output_path.exists():
-        raise FileNotFoundError(f"{str(output_path)} not created, check "
-                                 "minimap2 install")
 
-    completeness = {'SPECIMEN_ID': [],
-                    'GENOME_COMPLETENESS': []}
-    samfile = pysam.AlignmentFile(output_path, 'r')
-    for genome in samfile.fetch():
-        completeness['SPECIMEN_ID'].append(str(genome.query_name))
-        completeness['GENOME_COMPLETENESS'].append(len(genome.get_aligned_pairs(matches_only=True)) / samfile.get_reference_length("MN908947.3") * 100)
-    completeness = pd.DataFrame(completeness)
+def specimen_ids(input_genomes):
+    """
+    SPECIMEN_ID (first word of the header) of every genome in a fasta
+    """
+    with open(input_genomes, 'rb') as fh:
+        return [(line[1:].split() or [b''])[0].decode('utf-8')
+                for line in fh if line.startswith(b'>')]
+
 
-    # remove temp output
-    shutil.rmtree(output_dir)
+def genome_completeness(input_genomes, reference_genome, threads,
+                        stderr=subprocess.DEVNULL):
+    """
+    Genome completeness as the % of the reference covered by aligned
+    (CIGAR M/=/X) bases in the minimap2 alignment, genomes that don't
+    align at all are 0% complete
+
+    minimap2 PAF output (with CIGAR) is streamed straight from the process
+    so nothing is written to disk and only the running totals per genome
+    are kept in memory
+    """
+    aligned = {}
+    reference_length = None
+    with subprocess.Popen(f"minimap2 -c -x asm5 --secondary=no "
+                          f"-t {threads} "
+                          f"{reference_genome} {input_genomes}".split(),
+                          stdout=subprocess.PIPE,
+                          stderr=stderr,
+                          text=True) as minimap2:
+        for alignment in minimap2.stdout:
+            alignment = alignment.rstrip('\n').split('\t')
+            query_name = alignment[0]
+            reference_length = int(alignment[6])
+            cigar = [tag[5:] for tag in alignment[12:]
+                     if tag.startswith('cg:Z:')]
+            if cigar:
+                match_length = cigar_match_length(cigar[0])
+            else:
+                # fall back to the alignment block length if no CIGAR
+                match_length = int(alignment[8]) - int(alignment[7])
+            aligned[query_name] = aligned.get(query_name, 0) + match_length
+
+    if minimap2.returncode != 0:
+        raise subprocess.CalledProcessError(minimap2.returncode,
+                                            minimap2.args)
+    if reference_length is None:
+        sys.stderr.write("No genomes aligned to the reference with "
+                         "minimap2, all are reported as 0% complete\n")
+        reference_length = 1
+
+    ids = specimen_ids(input_genomes)
+    completeness = pd.DataFrame({'SPECIMEN_ID': ids,
+                                 'GENOME_COMPLETENESS':
+                                 [aligned.get(specimen_id, 0)
+                                  for specimen_id in ids]})
+    completeness['GENOME_COMPLETENESS'] = \
+        completeness['GENOME_COMPLETENESS'] / reference_length * 100
     return completeness
 
 
+def completeness(input_genomes, reference_genome, threads,
+                 stderr=subprocess.DEVNULL):
+    """
+    Genome completeness from the worker service (which keeps a minimap2
+    index of the reference) if it is running, otherwise with minimap2 here
+    """
+    result = service_client.submit('completeness',
+                                   {'input_genomes': Path(input_genomes),
+                                    'reference': Path(reference_genome),
+                                    'threads': threads})
+    if result is not None:
+        return pd.DataFrame(result)
+    return genome_completeness(input_genomes, reference_genome, threads,
+                               stderr=stderr)
+
+
+def base_composition(input_genomes):
+    """
+    Directly count %N and %ACGT for each genome in the input fasta using a
+    byte histogram of each sequence rather than per-base python loops
+    """
+    acgt = np.zeros(256, dtype=bool)
+    acgt[np.frombuffer(b'ACGTacgt', dtype=np.uint8)] = True
+    n_bases = np.zeros(256, dtype=bool)
+    n_bases[np.frombuffer(b'Nn', dtype=np.uint8)] = True
+
+    composition = {'SPECIMEN_ID': [],
+                   'PERCENT_N': [],
+                   'PERCENT_ACGT': []}
+
+    for header, seq in read_fasta(input_genomes):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+        counts = np.bincount(seq, minlength=256)
+        length = max(len(seq), 1)
+        composition['SPECIMEN_ID'].append(header.split()[0].decode('utf-8'))
+        composition['PERCENT_N'].append(counts[n_bases].sum() / length * 100)
+        composition['PERCENT_ACGT'].append(counts[acgt].sum() / length * 100)
+
+    return pd.DataFrame(composition)
+
+
+def store_base_composition(store_path, specimen_ids):
+    """
+    %N and %ACGT for the specimens from a genome store's precomputed counts
+    without reading any sequences, None if any specimen isn't in the store
+    """
+    composition = GenomeStore(store_path).composition()
+    composition['name'] = composition['name'].str.split(n=1).str[0]
+    composition = composition.rename(columns={'name': 'SPECIMEN_ID'})
+    composition = composition[composition['SPECIMEN_ID'].isin(specimen_ids)]
+    composition = composition.drop_duplicates('SPECIMEN_ID')
+    missing = set(specimen_ids) - set(composition['SPECIMEN_ID'])
+    if missing:
+        sys.stderr.write(f"{len(missing)} input genomes aren't in "
+                         f"{store_path}, counting base composition from the "
+                         "input fasta instead\n")
+        return None
+    return composition
+
+
+def split_threads(threads, minimap2_threads=None):
+    """
+    Split the thread budget between pangolin and minimap2, minimap2 is much
+    quicker so by default only gets a quarter of the threads, both need at
+    least one thread without going over the budget
+    """
+    if threads < 2:
+        raise ValueError("pangolin and minimap2 run at the same time so need "
+                         "at least 2 threads")
+    if minimap2_threads is None:
+        minimap2_threads = max(1, threads // 4)
+    if not 1 <= minimap2_threads < threads:
+        raise ValueError(f"minimap2 threads ({minimap2_threads}) must leave "
+                         f"at least one of the {threads} threads for pangolin")
+    return threads - minimap2_threads, minimap2_threads
+
+
+class StageLog:
+    """
+    Log shared by the concurrent stages, each message is written and
+    flushed whole so messages from different stages can't interleave
+    """
+    def __init__(self, fh):
+        self.fh = fh
+        self.lock = threading.Lock()
+
+    def write(self, message):
+        with self.lock:
+            self.fh.write(message)
+            self.fh.flush()
+
+    def flush(self):
+        pass
+
+
+def stage_log_path(log_path, stage):
+    """
+    Separate log for an external tool's stderr next to the main log
+    """
+    return Path(log_path).with_suffix(f".{stage}.log")
+
+
+def timed_stage(stage, log_fh, func, *args, **kwargs):
+    """
+    Run a single pipeline stage and report the wall time it took
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    message = f"{stage} finished in {elapsed:.1f}s"
+    print(message)
+    log_fh.write(message + "\n")
+    log_fh.flush()
+    return result
+
+
+def pangolin_versions():
+    """
+    Get the installed pangolin and pangoLEARN versions
+    """
+    versions = []
+    for flag in ["--version", "--pangoLEARN-version"]:
+        version = subprocess.run(["pangolin", flag], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+        versions.append(version.stdout.decode('utf-8').strip())
+    return " ".join(versions)
+
+
+def header_specimen_ids(pangolin_df):
+    """
+    Deduplicated and cached rows are named by full fasta headers, use the
+    first word as minimap2 completeness does
+    """
+    if pangolin_df is not None and not pangolin_df.empty:
+        pangolin_df['SPECIMEN_ID'] = \
+            pangolin_df['SPECIMEN_ID'].str.split(n=1).str[0]
+    return pangolin_df
+
+
+def pangolin_stage(input_genomes, threads, log_fh, stderr_fh, cache_path=None,
+                   deduplicate=False, tmp_dir=None):
+    """
+    Update then run pangolin with stderr sent to stderr_fh, if a cache is
+    used only genomes without a cached assignment are run and if
+    deduplicating only one genome per unique sequence is run, with the
+    fasta of those genomes in a temporary directory in tmp_dir
+    """
+    timed_stage('pangolin update', log_fh, update_pangolin, stderr=stderr_fh)
+
+    def pangolin(fasta):
+        return timed_stage('pangolin', log_fh, run_pangolin, fasta, threads,
+                           stderr=stderr_fh)
+
+    if cache_path is None and not deduplicate:
+        return pangolin(input_genomes)
+
+    with tempfile.TemporaryDirectory(prefix='pangolin_',
+                                     dir=tmp_dir) as subset_dir:
+        return pangolin_subset(input_genomes, pangolin, log_fh, cache_path,
+                               deduplicate, Path(subset_dir))
+
+
+def pangolin_subset(input_genomes, pangolin, log_fh, cache_path, deduplicate,
+                    subset_dir):
+    """
+    Run pangolin on only the uncached and/or unique genomes written to a
+    fasta in subset_dir and fill in the rest from the cache or their
+    identical genomes
+    """
+    name_hashes = hash_fasta(input_genomes)
+    unique_fasta = subset_dir / "unique.fasta"
+    if cache_path is None:
+        pangolin_df = assign_unique(input_genomes, list(name_hashes),
+                                    name_hashes, unique_fasta, pangolin,
+                                    'SPECIMEN_ID', log_fh)
+        return header_specimen_ids(pangolin_df)
+
+    version = pangolin_versions()
+    cache = LineageCache(cache_path)
+    cached, uncached = split_cached(cache, {'pho_pangolin': version},
+                                    name_hashes)
+    print(f"{len(name_hashes) - len(uncached)}/{len(name_hashes)} genomes "
+          "already assigned in cache")
+
+    pangolin_df = None
+    if uncached and deduplicate:
+        pangolin_df = assign_unique(input_genomes, uncached, name_hashes,
+                                    unique_fasta, pangolin, 'SPECIMEN_ID',
+                                    log_fh)
+    elif uncached:
+        uncached_fasta = subset_dir / "uncached.fasta"
+        write_fasta_subset(input_genomes, uncached, uncached_fasta)
+        pangolin_df = pangolin(uncached_fasta)
+
+    pangolin_df = merge_cached(cache, 'pho_pangolin', version, pangolin_df,
+                               cached['pho_pangolin'], name_hashes,
+                               'SPECIMEN_ID')
+    cache.close()
+    return header_specimen_ids(pangolin_df)
+
+
+def run_stages(input_genomes, reference, threads, minimap2_threads, log_path,
+               cache_path=None, deduplicate=False, tmp_dir=None):
+    """
+    Run pangolin and minimap2 completeness concurrently as they are
+    independent external processes, stage timings go to the log and each
+    tool's stderr to its own log next to it
+    """
+    pangolin_threads, minimap2_threads = split_threads(threads,
+                                                       minimap2_threads)
+    with open(log_path, 'a') as log_fh, \
+            open(stage_log_path(log_path, 'pangolin'), 'a') as pangolin_fh, \
+            open(stage_log_path(log_path, 'minimap2'), 'a') as minimap2_fh, \
+            ThreadPoolExecutor(max_workers=2) as executor:
+        log_fh = StageLog(log_fh)
+        pangolin_future = executor.submit(pangolin_stage, input_genomes,
+                                          pangolin_threads, log_fh,
+                                          pangolin_fh, cache_path,
+                                          deduplicate, tmp_dir)
+        genome_future = executor.submit(timed_stage, 'minimap2 completeness',
+                                        log_fh, completeness,
+                                        input_genomes, reference,
+                                        minimap2_threads, stderr=minimap2_fh)
+        return pangolin_future.result(), genome_future.result()
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser('Generate completeness and pangolin '
@@ -102,21 +380,81 @@ if __name__ == '__main__':
                         help="Concatenated fasta containing consensus genomes")
     parser.add_argument("-t", "--threads", type=int, default=4,
                         help="Number of threads to use")
+    parser.add_argument("--minimap2_threads", type=int, default=None,
+                        help="Threads from --threads reserved for minimap2 "
+                             "while pangolin runs concurrently (default: "
+                             "a quarter of --threads)")
     parser.add_argument("-r", "--reference", type=check_file, required=True,
                         help="Path to MN908947.3 reference genome in fasta format")
     parser.add_argument("-o", "--output", default="pho_report.csv",
                         help="Output CSV containing reporting information")
+    parser.add_argument("--base_composition", default=False,
+                        action='store_true',
+                        help="Also report %%N and %%ACGT counted directly "
+                             "from the input fasta")
+    parser.add_argument("-g", "--genome_store", default=None,
+                        help="Genome store (genome_store.py) of the input "
+                             "genomes to take --base_composition from")
+    parser.add_argument("-l", "--log", default="pho_reporting.log",
+                        help="Log file for stage timings, pangolin and "
+                             "minimap2 stderr go to .pangolin.log and "
+                             ".minimap2.log files next to it")
+    parser.add_argument("-c", "--cache", default=None,
+                        help="SQLite cache of pangolin assignments by "
+                             "sequence hash, only uncached genomes are run")
+    parser.add_argument("--deduplicate", default=False,
+                        action='store_true',
+                        help="Only run pangolin on one genome per unique "
+                             "sequence and copy its assignment to the "
+                             "identical genomes")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    try:
+        split_threads(args.threads, args.minimap2_threads)
+    except ValueError as error:
+        parser.error(str(error))
+    metrics = instrumentation.from_args("pho_reporting", args)
+
+    # genomes are reported by the first word of their header so those have
+    # to be unique to match pangolin and minimap2 results up
+    input_ids = specimen_ids(args.input_genomes)
+    duplicated = pd.Series(input_ids)[pd.Series(input_ids).duplicated()]
+    if len(duplicated):
+        parser.error(f"{len(duplicated)} genomes in {args.input_genomes} "
+                     "share the first word of their header with another "
+                     "genome e.g., " + ", ".join(duplicated.unique()[:5]))
 
-    update_pangolin()
-    pangolin_df = run_pangolin(args.input_genomes, args.threads)
+    # pangolin and minimap2 run concurrently, their individual timings are
+    # in the log
+    with metrics.stage("pangolin_minimap2") as stage:
+        pangolin_df, genome_df = run_stages(args.input_genomes, args.reference,
+                                            args.threads, args.minimap2_threads,
+                                            args.log, args.cache,
+                                            args.deduplicate,
+                                            Path(args.output).parent)
+        stage['rows'] = len(pangolin_df)
 
-    genome_df = genome_completeness(args.input_genomes, args.reference,
-                                    args.threads)
+    if args.base_composition:
+        with metrics.stage("base_composition", rows=len(input_ids)):
+            composition_df = None
+            if args.genome_store is not None:
+                composition_df = store_base_composition(args.genome_store,
+                                                        input_ids)
+            if composition_df is None:
+                composition_df = base_composition(args.input_genomes)
+            # every input genome gets its composition whether or not it
+            # aligned, mostly N genomes are the ones it matters most for
+            genome_df = pd.DataFrame({'SPECIMEN_ID': input_ids}) \
+                .merge(genome_df, on='SPECIMEN_ID', how='left',
+                       validate='one_to_one') \
+                .merge(composition_df, on='SPECIMEN_ID', how='left',
+                       validate='one_to_one')
 
-    genome_df.to_csv('test.csv', sep='\t')
-    output = pd.merge(pangolin_df, genome_df, on='SPECIMEN_ID',
-                      how='outer',
-                      validate='one_to_one')
+    with metrics.stage("write") as stage:
+        output = pd.merge(pangolin_df, genome_df, on='SPECIMEN_ID',
+                          how='outer',
+                          validate='one_to_one')
 
-    output.to_csv(args.output, index=False, sep='\t')
+        output.to_csv(args.output, index=False, sep='\t')
+        stage['rows'] = len(output)
+    metrics.close()
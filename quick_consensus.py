@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import argparse
+import multiprocessing
+import subprocess
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
+import instrumentation
+from vcf_consensus import load_reference, vcf_consensus
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def consensus_path(vcf: Path) -> Path:
+    """
+    Consensus output path for a VCF, <sample>.vcf_consensus.fna next to the
+    VCF where the sample is the file name up to its first '.'
+    """
+    vcf = Path(vcf)
+    return vcf.parent / (vcf.name.split('.')[0] + ".vcf_consensus.fna")
+
+
+def is_up_to_date(vcf: Path, consensus: Path) -> bool:
+    """
+    Check if a consensus already exists and is newer than its VCF
+    """
+    return consensus.exists() and \
+        consensus.stat().st_mtime >= vcf.stat().st_mtime
+
+
+def bcftools_consensus(vcf: Path, reference: Path, consensus: Path):
+    """
+    Generate a consensus with bcftools from a bgzipped temporary copy of the
+    VCF so the input is left untouched
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        vcf_gz = Path(tmp_dir) / (vcf.name + ".gz")
+        with open(vcf_gz, 'wb') as out_fh:
+            subprocess.run(["bgzip", "-c", str(vcf)], stdout=out_fh,
+                           stderr=subprocess.PIPE, check=True)
+        subprocess.run(["bcftools", "index", str(vcf_gz)],
+                       stderr=subprocess.PIPE, check=True)
+        tmp_consensus = Path(tmp_dir) / consensus.name
+        subprocess.run(["bcftools", "consensus", "--fasta-ref",
+                        str(reference), "--output", str(tmp_consensus),
+                        str(vcf_gz)],
+                       stderr=subprocess.PIPE, check=True)
+        # only move into place once complete so partial outputs aren't
+        # mistaken for finished ones
+        tmp_consensus.replace(consensus)
+
+
+def make_consensus(vcfs, reference, threads, consensus_func=bcftools_consensus,
+                   executor_class=ThreadPoolExecutor):
+    """
+    Generate consensus genomes for each VCF in a worker pool, skipping any
+    that are already up to date and recording failures rather than stopping
+    """
+    consensuses = {}
+    failures = {}
+    pending = {}
+    for vcf in vcfs:
+        consensus = consensus_path(vcf)
+        consensuses[vcf] = consensus
+        if not is_up_to_date(vcf, consensus):
+            pending[vcf] = consensus
+    print(f"{len(vcfs) - len(pending)}/{len(vcfs)} consensus genomes already "
+          "up to date")
+
+    with executor_class(max_workers=threads) as executor:
+        futures = {executor.submit(consensus_func, vcf, reference,
+                                   consensus): vcf
+                   for vcf, consensus in pending.items()}
+        for future in as_completed(futures):
+            vcf = futures[future]
+            try:
+                future.result()
+            except subprocess.CalledProcessError as error:
+                failures[vcf] = error.stderr.decode('utf-8').strip() \
+                    if error.stderr else str(error)
+            except Exception as error:
+                failures[vcf] = str(error)
+
+    return {vcf: consensus for vcf, consensus in consensuses.items()
+            if vcf not in failures}, failures
+
+
+def spawn_executor(max_workers):
+    """
+    Process pool that doesn't rely on forking, workers only need the
+    importable vcf_consensus module rather than this script's __main__
+    """
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def write_combined(consensuses, output):
+    """
+    Concatenate consensus genomes into one fasta named by sample for
+    lineage assignment
+    """
+    with open(output, 'w') as out_fh:
+        for vcf, consensus in consensuses.items():
+            sample = consensus.name.replace(".vcf_consensus.fna", "")
+            with open(consensus) as fh:
+                for line in fh:
+                    if line.startswith('>'):
+                        out_fh.write(f">{sample}\n")
+                    else:
+                        out_fh.write(line)
+
+
+def write_failures(failures, output):
+    """
+    Record the per-sample failures
+    """
+    with open(output, 'w') as out_fh:
+        out_fh.write("vcf\terror\n")
+        for vcf, error in failures.items():
+            error = " ".join(error.split())
+            out_fh.write(f"{vcf}\t{error}\n")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Generate consensus genomes from VCFs "
+                                     "in parallel")
+    parser.add_argument("-r", "--reference", required=True, type=check_file,
+                        help="MN908947.3 reference fasta")
+    parser.add_argument("-t", "--threads", default=8, type=int,
+                        help="Number of samples to process at once")
+    parser.add_argument("-o", "--output", default="consensus_genomes.fasta",
+                        help="Combined multi-fasta of all consensus genomes")
+    parser.add_argument("-f", "--failures", default="consensus_failures.tsv",
+                        help="Table of samples that failed and why")
+    parser.add_argument("-e", "--engine", default="bcftools",
+                        choices=['bcftools', 'python'],
+                        help="Generate consensus with bcftools or by "
+                             "applying variants in-process (much faster, "
+                             "check with vcf_consensus.py)")
+    parser.add_argument("vcfs", nargs="+", type=check_file,
+                        help="VCFs to generate consensus genomes for")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("quick_consensus", args)
+
+    with metrics.stage("consensus", rows=len(args.vcfs)):
+        if args.engine == 'python':
+            # reference is loaded once and variants applied in worker
+            # processes, spawned rather than forked as covid_scripts runs
+            # this as __main__ from a thread-holding parent
+            consensuses, failures = make_consensus(
+                args.vcfs, load_reference(args.reference), args.threads,
+                consensus_func=vcf_consensus,
+                executor_class=spawn_executor)
+        else:
+            consensuses, failures = make_consensus(args.vcfs, args.reference,
+                                                   args.threads)
+    with metrics.stage("write", rows=len(consensuses)):
+        write_combined(consensuses, args.output)
+        write_failures(failures, args.failures)
+    metrics.close()
+    print(f"{len(consensuses)} consensus genomes written to {args.output}, "
+          f"{len(failures)} failed (see {args.failures})")
@@ -25,9 +25,6 @@ if [ -z "$ref" ] ; then
     exit 1
 fi
 
-for vcf in "$@"; do 
-    sample_name=$(echo "$vcf" | cut -d '.' -f1)
-    bgzip "$vcf"
-    bcftools index "$vcf".gz 
-    bcftools consensus --fasta-ref "$ref" "$vcf".gz > "$sample_name".vcf_consensus.fna
-done
+# consensus generation is run in parallel from python, leaving input VCFs
+# uncompressed and skipping samples whose consensus is already up to date
+python "$(dirname "$0")"/quick_consensus.py --reference "$ref" "$@"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import hashlib
+import sqlite3
+from pathlib import Path
+import pandas as pd
+from sqlite_batches import select_in
+
+
+def item_hash(item: str) -> int:
+    """
+    64-bit hash of an item (long mutation sets included) that fits an
+    SQLite integer key
+    """
+    return int.from_bytes(hashlib.blake2b(item.encode('utf-8'),
+                                          digest_size=8).digest(),
+                          'big', signed=True)
+
+
+class SeenIndex:
+    """
+    Append-only record of every lineage, division, mutation and mutation set
+    ever observed with the date it was first seen and the cumulative number
+    of genomes it has been seen in, keyed by category and item hash
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen "
+                        "(category TEXT, item_hash INTEGER, item TEXT, "
+                        "first_seen TEXT, genome_count INTEGER, "
+                        "PRIMARY KEY (category, item_hash)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots "
+                        "(snapshot TEXT PRIMARY KEY, date TEXT)")
+        self.db.commit()
+
+    def is_empty(self):
+        return self.db.execute("SELECT 1 FROM seen LIMIT 1").fetchone() is None
+
+    def has_snapshot(self, snapshot):
+        return self.db.execute("SELECT 1 FROM snapshots WHERE snapshot=?",
+                               (snapshot,)).fetchone() is not None
+
+    def novel(self, category, items, date=None):
+        """
+        Items that have never been seen in a category, items first seen on
+        date still count so rerunning that date's report doesn't lose them
+        """
+        hashes = {item_hash(item): item for item in items if not pd.isna(item)}
+        for seen_hash, in select_in(self.db,
+                                    "SELECT item_hash FROM seen WHERE "
+                                    "category=? AND first_seen IS NOT ? AND "
+                                    "item_hash IN ({placeholders})",
+                                    [category, date], list(hashes)):
+            del hashes[seen_hash]
+        return set(hashes.values())
+
+    def add(self, category, counts, date):
+        """
+        Add a dict of item: genome count, new items are recorded as first
+        seen on date and existing items have their counts increased
+        """
+        self.db.executemany("INSERT INTO seen VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT (category, item_hash) DO UPDATE "
+                            "SET genome_count = genome_count + "
+                            "excluded.genome_count",
+                            [(category, item_hash(item), item, date,
+                              int(count))
+                             for item, count in counts.items()
+                             if not pd.isna(item)])
+
+    def record_snapshot(self, snapshot, date):
+        self.db.execute("INSERT INTO snapshots VALUES (?, ?)",
+                        (snapshot, date))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import json
+import os
+import secrets
+import socket
+import sys
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+DEFAULT_TOKEN_FILE = Path.home() / ".covid_scripts_service_token"
+# seconds to wait for the service to answer a status check and for a job
+STATUS_TIMEOUT = 2
+DEFAULT_JOB_TIMEOUT = 600
+
+
+def service_address() -> str:
+    """
+    host:port of the worker service, set COVID_SCRIPTS_SERVICE to change it
+    or to 'off' to never use the service
+    """
+    return os.environ.get('COVID_SCRIPTS_SERVICE', DEFAULT_ADDRESS)
+
+
+def token_file() -> Path:
+    """
+    File holding the shared token the service requires, set
+    COVID_SCRIPTS_SERVICE_TOKEN_FILE to change it
+    """
+    return Path(os.environ.get('COVID_SCRIPTS_SERVICE_TOKEN_FILE',
+                               DEFAULT_TOKEN_FILE))
+
+
+def job_timeout() -> float:
+    """
+    Seconds to wait for a job, set COVID_SCRIPTS_SERVICE_TIMEOUT to change it
+    """
+    return float(os.environ.get('COVID_SCRIPTS_SERVICE_TIMEOUT',
+                                DEFAULT_JOB_TIMEOUT))
+
+
+def write_token(path) -> str:
+    """
+    Create a new random token readable only by the user running the service
+    """
+    token = secrets.token_urlsafe(32)
+    path = Path(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as out_fh:
+        # an existing file keeps its mode on open so set it explicitly
+        os.fchmod(out_fh.fileno(), 0o600)
+        out_fh.write(token)
+    return token
+
+
+def read_token():
+    try:
+        return token_file().read_text().strip()
+    except OSError:
+        return None
+
+
+def encode_path(value):
+    """
+    Paths are sent as given along with the working directory they are
+    relative to
+    """
+    if isinstance(value, Path):
+        return str(value)
+    raise TypeError(f"{value!r} can't be sent to the worker service")
+
+
+def submit(job: str, params: dict, timeout=None):
+    """
+    Run a job on the worker service (worker_service.py), returns None if
+    the service isn't running or can't run the job so callers can fall back
+    to running it themselves.  A job the service accepted but didn't finish
+    within the timeout is still running there, so that raises rather than
+    letting the caller run it again alongside the service
+    """
+    address = service_address()
+    if address == 'off':
+        return None
+    token = read_token()
+    if token is None:
+        return None
+    timeout = job_timeout() if timeout is None else timeout
+
+    # the service is always local so never go through a proxy
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    headers = {'Authorization': f"Bearer {token}"}
+    try:
+        # check the service is up before waiting on a job
+        opener.open(urllib.request.Request(f"http://{address}/status",
+                                           headers=headers),
+                    timeout=STATUS_TIMEOUT).close()
+    except urllib.error.HTTPError as error:
+        sys.stderr.write(f"Worker service refused the request ({error.code} "
+                         f"{error.reason}), running locally\n")
+        return None
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+    params = {**params, 'cwd': os.getcwd()}
+    request = urllib.request.Request(f"http://{address}/jobs/{job}",
+                                     data=json.dumps(params,
+                                                     default=encode_path)
+                                     .encode('utf-8'),
+                                     headers={**headers,
+                                              'Content-Type':
+                                              'application/json'})
+    try:
+        with opener.open(request, timeout=timeout) as response:
+            return json.loads(response.read())['result']
+    except urllib.error.HTTPError as error:
+        try:
+            message = json.loads(error.read())['error']
+        except (ValueError, KeyError):
+            message = error.reason
+        sys.stderr.write(f"Worker service couldn't run {job} ({message}), "
+                         "running locally\n")
+        return None
+    except socket.timeout:
+        raise RuntimeError(f"Worker service didn't finish {job} within "
+                           f"{timeout}s and is still running it, wait for it "
+                           "or set COVID_SCRIPTS_SERVICE_TIMEOUT higher "
+                           "rather than running it here at the same time")
+    except (urllib.error.URLError, ConnectionError):
+        return None
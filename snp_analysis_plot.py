@@ -2,11 +2,7 @@
 import pandas as pd
 import argparse
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
-import vcf
-sns.set_style('whitegrid')
-sns.set_palette('colorblind')
+import instrumentation
 
 
 def parse_vcf_snpeff_record(record, sample):
@@ -48,6 +44,11 @@ def parse_vcf_snpeff_record(record, sample):
     return parsed_records
 
 def plot_allele_pres_absence(variants_subset, title, savepath, all_mutations=False):
+    # plotting libraries are slow to import so only load them when plotting
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set_style('whitegrid')
+    sns.set_palette('colorblind')
 
     coverage_thresold = 50
 
@@ -109,7 +110,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Tool to summarise SNPs across samples")
     parser.add_argument("-n", "--name", required=True, help="Analysis name for output/titles")
     parser.add_argument("vcfs", nargs="+", help="List of SnpEff annotated VCFs")
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    metrics = instrumentation.from_args("snp_analysis_plot", args)
+    import vcf
 
     vcfs = []
     for vcf_fp in args.vcfs:
@@ -119,13 +123,18 @@ if __name__ == "__main__":
         else:
             vcfs.append((vcf_fp.name.replace('.vcf', '').replace('.ann', ''), vcf_fp.resolve()))
 
-    parsed_records = []
-    for sample, vcf_fp in vcfs:
-        with open(vcf_fp) as fh:
-            for record in vcf.Reader(fh):
-                parsed_records.extend(parse_vcf_snpeff_record(record, sample))
+    with metrics.stage("read") as stage:
+        parsed_records = []
+        for sample, vcf_fp in vcfs:
+            with open(vcf_fp) as fh:
+                for record in vcf.Reader(fh):
+                    parsed_records.extend(parse_vcf_snpeff_record(record, sample))
+
+        variants = pd.DataFrame(parsed_records)
+        stage['rows'] = len(variants)
 
-    variants = pd.DataFrame(parsed_records)
-    plot_allele_pres_absence(variants, args.name, f'{args.name}_passaging_all.png', all_mutations=True)
+    with metrics.stage("plot", rows=len(variants)):
+        plot_allele_pres_absence(variants, args.name, f'{args.name}_passaging_all.png', all_mutations=True)
+    metrics.close()
 
 
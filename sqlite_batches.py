@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+
+
+# sqlite's default limit on bound parameters is 999
+MAX_PARAMETERS = 900
+
+
+def select_in(db, query, params, values):
+    """
+    Run a query with an "IN ({placeholders})" clause over any number of
+    values, in batches that stay under sqlite's bound parameter limit,
+    yielding every result row
+    """
+    values = list(values)
+    for ix in range(0, len(values), MAX_PARAMETERS):
+        batch = values[ix: ix + MAX_PARAMETERS]
+        placeholders = ",".join("?" * len(batch))
+        yield from db.execute(query.format(placeholders=placeholders),
+                              list(params) + batch)
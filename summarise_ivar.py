@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import pandas as pd
-import gffutils
 import argparse
+import queue
+import sys
+import threading
+import time
+from fnmatch import fnmatch
 from pathlib import Path
+import instrumentation
+import service_client
 
 
 def check_file(path: str) -> Path:
@@ -28,7 +34,7 @@ def summarise_ivar_variants(ivar_file, reference_gff_db):
     var_df['isolate'] = ivar_file
     var_df = var_df.set_index('isolate')
 
-    var_df['CDS_Product'] = var_df['GFF_FEATURE'].apply(lambda gff_feat: ref_db[gff_feat].attributes['Parent'][0] if not pd.isnull(gff_feat) else 'non-coding')
+    var_df['CDS_Product'] = var_df['GFF_FEATURE'].apply(lambda gff_feat: reference_gff_db[gff_feat].attributes['Parent'][0] if not pd.isnull(gff_feat) else 'non-coding')
     var_df['CDS_Product'] = var_df['CDS_Product'].str.replace('gene-', '')
 
     var_df['Mutations'] = var_df.apply(describe_ivar_mutations, axis=1)
@@ -78,46 +84,260 @@ def parse_inputs(variant_file_list, ref_db):
 	return results
 
 
-def generate_output(results, output_type):
+def generate_output(results, output_type, tsv_path='summary.tsv'):
 	"""
-	Summarise and prepare outputs
+	Summarise and prepare outputs, returns the text to print
 	"""
-	if args.output_type == "tsv":
-		results.to_csv('summary.tsv', sep='\t')
-		print("Results printed to summary.tsv")
-	elif args.output_type == 'summary':
+	if output_type == "tsv":
+		results.to_csv(tsv_path, sep='\t')
+		return f"Results printed to {tsv_path}"
+	elif output_type == 'summary':
 		variant_sets = results.groupby('isolate')['Mutations']
 		variant_sets = variant_sets.apply(list)
-		for isolate, variant_set in variant_sets.iteritems():
+		summary = []
+		for isolate, variant_set in variant_sets.items():
 			variant_set = sorted(variant_set,
            						 key=lambda x: (x.split(':')[1],
                                 				x.split(':')[0]))
-			print(f"{isolate}: {variant_set}")
+			summary.append(f"{isolate}: {variant_set}")
+		return "\n".join(summary)
+
+
+def load_gff_features(reference_gff):
+	"""
+	Load the GFF features into a dict by ID, unlike a gffutils database this
+	can be shared between threads
+	"""
+	import gffutils
+	db = gffutils.create_db(str(reference_gff), dbfn=':memory:',
+                            keep_order=True, merge_strategy='merge',
+                            sort_attribute_values=True)
+	return {feature.id: feature for feature in db.all_features()}
+
+
+def file_signature(path):
+	"""
+	Size and modification time used to tell if a file has changed
+	"""
+	stat = path.stat()
+	return stat.st_size, stat.st_mtime_ns
+
+
+class FolderWatcher:
+	"""
+	Find files matching a pattern in a directory once they have stopped
+	changing for settle seconds, using inotify if inotify_simple is
+	installed and polling otherwise
+	"""
+	def __init__(self, directory, pattern, settle, poll_interval):
+		self.directory = Path(directory)
+		self.pattern = pattern
+		self.settle = settle
+		self.poll_interval = poll_interval
+		# path: (signature, time first seen with that signature)
+		self.pending = {}
+		# path: signature when it was last reported
+		self.reported = {}
+		try:
+			from inotify_simple import INotify, flags
+			self.inotify = INotify()
+			self.inotify.add_watch(str(self.directory),
+                                   flags.CREATE | flags.MODIFY |
+                                   flags.CLOSE_WRITE | flags.MOVED_TO)
+		except ImportError:
+			self.inotify = None
+		# files already in the directory are picked up on the first check
+		self.initial = set(self.directory.glob(self.pattern))
+
+	def changed_paths(self):
+		"""
+		Paths that may have changed since the last check
+		"""
+		paths, self.initial = self.initial, set()
+		if self.inotify is not None:
+			events = self.inotify.read(timeout=int(self.poll_interval * 1000))
+			paths |= {self.directory / event.name for event in events
+                      if fnmatch(event.name, self.pattern)}
+			# settling files are rechecked even if there were no new events
+			return paths | set(self.pending)
+		time.sleep(self.poll_interval)
+		return paths | set(self.directory.glob(self.pattern))
+
+	def ready(self):
+		"""
+		Files unchanged for settle seconds that haven't been reported in
+		their current state
+		"""
+		now = time.monotonic()
+		ready = []
+		for path in self.changed_paths():
+			try:
+				signature = file_signature(path)
+			except FileNotFoundError:
+				self.pending.pop(path, None)
+				continue
+			if self.reported.get(path) == signature:
+				self.pending.pop(path, None)
+				continue
+			seen = self.pending.get(path)
+			if seen is None or seen[0] != signature:
+				self.pending[path] = (signature, now)
+			elif now - seen[1] >= self.settle:
+				ready.append(path)
+				self.reported[path] = signature
+				del self.pending[path]
+		return sorted(ready)
+
+
+def write_summaries(summaries, summary_tsv, isolate_summary):
+	"""
+	Rewrite both summaries from every file's results, used when an already
+	summarised file changes
+	"""
+	results = [variants for variants in summaries.values()
+               if not variants.empty]
+	if results:
+		results = pd.concat(results).sort_values('isolate')
+		results.to_csv(summary_tsv, sep='\t')
+		Path(isolate_summary).write_text(
+			generate_output(results, 'summary') + "\n")
+
+
+def record_variants(path, variants, summaries, summary_tsv, isolate_summary):
+	"""
+	Append a newly summarised file to the running summaries
+	"""
+	modified = path in summaries
+	summaries[path] = variants
+	if modified:
+		write_summaries(summaries, summary_tsv, isolate_summary)
+		print(f"{path} changed, summaries rewritten")
+	elif not variants.empty:
+		write_header = not Path(summary_tsv).exists() or \
+			Path(summary_tsv).stat().st_size == 0
+		variants.to_csv(summary_tsv, sep='\t', mode='a', header=write_header)
+		summary = generate_output(variants, 'summary')
+		with open(isolate_summary, 'a') as out_fh:
+			out_fh.write(summary + "\n")
+		print(summary)
+
+
+def watch(directory, pattern, ref_db, summary_tsv, isolate_summary,
+          workers=4, queue_size=16, settle=10, poll_interval=2):
+	"""
+	Summarise ivar variant files as they appear in a directory, files are
+	summarised by a pool of workers fed from a bounded queue so a burst of
+	new files is worked through at a steady rate
+	"""
+	work = queue.Queue(maxsize=queue_size)
+	results = queue.Queue()
+
+	def worker():
+		while True:
+			path = work.get()
+			try:
+				results.put((path, summarise_ivar_variants(path, ref_db)))
+			except Exception as error:
+				results.put((path, error))
+
+	for _ in range(workers):
+		threading.Thread(target=worker, daemon=True).start()
+
+	# start from empty summaries as every existing file is summarised again
+	Path(summary_tsv).write_text("")
+	Path(isolate_summary).write_text("")
+
+	watcher = FolderWatcher(directory, pattern, settle, poll_interval)
+	summaries = {}
+	print(f"Watching {directory} for {pattern}, press Ctrl-C to stop")
+	while True:
+		for path in watcher.ready():
+			# blocks while the workers are behind
+			work.put(path)
+		while not results.empty():
+			path, variants = results.get()
+			if isinstance(variants, Exception):
+				sys.stderr.write(f"Couldn't summarise {path}: {variants}\n")
+				continue
+			record_variants(path, variants, summaries, summary_tsv,
+                            isolate_summary)
 
 
 if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser("Script to summarise ivar variants "
 								     "in a convenient human readable manner")
-	parser.add_argument('-i', '--input', required=True, nargs="+",
+	parser.add_argument('-i', '--input', nargs="+",
                         type=check_file,
 						help="List of ivar_variants.tsv files to summarise")
 	parser.add_argument('-t', '--output_type', choices=['tsv', 'summary'],
-						 required=True, help="Output full concatenated "
+						 help="Output full concatenated "
                          "ivar variants file (tsv) or just a sorted summary "
                          "for each isolate (summary)")
 	parser.add_argument('-r', '--reference_gff', default='data/MN908947_3.gff3',
                         type=check_file,
 						 help="Path to MN908947.3 gff3 file")
+	parser.add_argument('-w', '--watch', default=None,
+						help="Directory to watch, summarising ivar variant files "
+                             "as they finish being written and appending to "
+                             "the running summaries (instead of --input)")
+	parser.add_argument('--pattern', default="*variants.tsv",
+						help="Files to summarise in the watched directory")
+	parser.add_argument('--settle', default=10, type=float,
+						help="Seconds a watched file must be unchanged before it "
+                             "is summarised")
+	parser.add_argument('--workers', default=4, type=int,
+						help="Number of watched files summarised at once")
+	parser.add_argument('--queue_size', default=16, type=int,
+						help="Maximum watched files waiting for a worker")
+	parser.add_argument('--isolate_summary', default='isolate_summary.txt',
+						help="Running per-isolate summary written in watch mode")
+	instrumentation.add_arguments(parser)
 
 	args = parser.parse_args()
+	if args.watch is None and (args.input is None or args.output_type is None):
+		parser.error("--input and --output_type are required unless "
+                     "using --watch")
+
+	metrics = instrumentation.from_args("summarise_ivar", args)
+
+	if args.watch is not None:
+		with metrics.stage("load_reference"):
+			gff_features = load_gff_features(args.reference_gff)
+		# the watch stage covers the whole time spent watching
+		with metrics.stage("watch"):
+			try:
+				watch(args.watch, args.pattern, gff_features, 'summary.tsv',
+                      args.isolate_summary, args.workers, args.queue_size,
+                      args.settle)
+			except KeyboardInterrupt:
+				print("Stopped watching")
+		metrics.close()
+		sys.exit(0)
+
+	# use the worker service's already loaded annotation if it is running
+	with metrics.stage("service"):
+		output = service_client.submit('summarise_ivar',
+										{'input': args.input,
+										 'output_type': args.output_type,
+										 'reference_gff': args.reference_gff,
+										 'tsv_path': Path('summary.tsv')})
+
+	if output is None:
+		import gffutils
 
-	ref_db = gffutils.create_db(str(args.reference_gff), dbfn='ref.db',
-                                force=True, keep_order=True,
-                                merge_strategy='merge',
-                                sort_attribute_values=True)
+		with metrics.stage("load_reference"):
+			ref_db = gffutils.create_db(str(args.reference_gff), dbfn='ref.db',
+                                        force=True, keep_order=True,
+                                        merge_strategy='merge',
+                                        sort_attribute_values=True)
 
-	results = parse_inputs(args.input, ref_db)
+		with metrics.stage("annotate") as stage:
+			results = parse_inputs(args.input, ref_db)
+			stage['rows'] = len(results)
 
-	generate_output(results, args.output_type)
+		with metrics.stage("write", rows=len(results)):
+			output = generate_output(results, args.output_type)
+	print(output)
+	metrics.close()
 
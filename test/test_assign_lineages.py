@@ -0,0 +1,75 @@
+import sys
+from pathlib import Path
+import pytest
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent))
+
+import assign_lineages  # noqa: E402
+import lineage_cache  # noqa: E402
+
+
+def test_split_fasta_reuses_shards_for_the_same_records(tmp_path):
+    first = tmp_path / "first.fa"
+    first.write_text(">x\nACGT\nAC\n>y\nGGGG\n>z\nTT\n")
+    reordered = tmp_path / "reordered.fa"
+    reordered.write_text(">z\nTT\n>x\nACGTAC\n>y\nGG\nGG\n")
+    changed = tmp_path / "changed.fa"
+    changed.write_text(">z\nTT\n>x\nACGTAA\n>y\nGGGG\n")
+
+    shard_dir = tmp_path / "shards"
+    shards = assign_lineages.split_fasta(first, 2, shard_dir)
+    split = [shard.read_text() for shard in shards]
+    assign_lineages.split_fasta(reordered, 2, shard_dir)
+    assert [shard.read_text() for shard in shards] == split
+    assign_lineages.split_fasta(changed, 2, shard_dir)
+    assert shards[0].read_text() == ">z\nTT\n>x\nACGTAA\n"
+
+
+def test_assign_unique_removes_fasta_when_assignment_fails(tmp_path):
+    genomes = tmp_path / "genomes.fa"
+    genomes.write_text(">a\nACGT\n>b\nACGT\n")
+    name_hashes = lineage_cache.hash_fasta(genomes)
+    unique_fasta = tmp_path / "unique.fasta"
+
+    def fail(fasta):
+        raise RuntimeError("pangolin failed")
+
+    with pytest.raises(RuntimeError):
+        lineage_cache.assign_unique(genomes, list(name_hashes), name_hashes,
+                                    unique_fasta, fail, 'isolate')
+    assert not unique_fasta.exists()
+
+
+def test_updates_skipped_when_latest_release_unavailable(monkeypatch):
+    monkeypatch.setattr(assign_lineages, "get_tool_versions", lambda: {
+        'pangolin_version': "pangolin 2.3.2",
+        'pangoLEARN_version': "pangoLEARN 2021-02-21",
+        'nextclade_version': "0.13.0"})
+    monkeypatch.setattr(assign_lineages, "latest_github_release",
+                        lambda repo: None)
+    monkeypatch.setattr(assign_lineages, "latest_npm_version",
+                        lambda package: None)
+
+    def run_update(tool, command):
+        raise AssertionError(f"{tool} shouldn't be updated")
+
+    monkeypatch.setattr(assign_lineages, "run_update", run_update)
+    assert not assign_lineages.update_pangolin()
+    assert not assign_lineages.update_nextclade()
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+def test_update_tools_clears_versions_once(monkeypatch, parallel):
+    cleared = []
+
+    def get_tool_versions():
+        return {}
+
+    get_tool_versions.cache_clear = lambda: cleared.append(True)
+    monkeypatch.setattr(assign_lineages, "get_tool_versions",
+                        get_tool_versions)
+    monkeypatch.setattr(assign_lineages, "update_pangolin", lambda: True)
+    monkeypatch.setattr(assign_lineages, "update_nextclade", lambda: True)
+    assign_lineages.update_tools(parallel)
+    assert cleared == [True]
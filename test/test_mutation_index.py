@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent))
+
+import extract_seqs  # noqa: E402
+from mutation_index import MutationIndex  # noqa: E402
+
+
+def write_nextclade(path):
+    path.write_text("seqName\taaSubstitutions\taaDeletions\n"
+                    "a\tS:N501Y,S:E484K\t\n"
+                    "b\tS:N501Y\tS:H69-\n"
+                    "c\t\t\n")
+
+
+def test_query_and_any_of(tmp_path):
+    nextclade = tmp_path / "nextclade.tsv"
+    write_nextclade(nextclade)
+    index = MutationIndex.build(nextclade)
+    assert list(index.query(['S:N501Y'])) == ['a', 'b']
+    assert list(index.query(['S:N501Y'], ['S:E484K'])) == ['b']
+    assert list(index.query(exclude=['S:N501Y'])) == ['c']
+    assert list(index.any_of(['S:E484K', 'S:H69-'])) == ['a', 'b']
+    assert list(index.any_of(['S:D614G'])) == []
+
+
+def test_exclude_mutations_keeps_genomes_missing_from_nextclade(tmp_path):
+    nextclade = tmp_path / "nextclade.tsv"
+    write_nextclade(nextclade)
+    metadata = tmp_path / "metadata.tsv"
+    metadata.write_text("strain\tdate\n"
+                        "a\t2021-01-01\n"
+                        "c\t2021-01-01\n"
+                        "d\t2021-01-01\n")
+    index = MutationIndex.build(nextclade)
+    filtered = extract_seqs.filter_metadata(
+        metadata, None, False, False,
+        exclude_strains=index.any_of(['S:E484K']))
+    assert list(filtered['strain']) == ['c', 'd']
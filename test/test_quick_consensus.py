@@ -0,0 +1,33 @@
+import shutil
+import sys
+from pathlib import Path
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent))
+
+import quick_consensus  # noqa: E402
+from vcf_consensus import load_reference, vcf_consensus  # noqa: E402
+
+
+def test_consensus_path_uses_sample_name():
+    assert quick_consensus.consensus_path(
+        Path("test/21-B1428411R.ann.vcf")) == \
+        Path("test/21-B1428411R.vcf_consensus.fna")
+    assert quick_consensus.consensus_path(Path("./x.vcf")) == \
+        Path("x.vcf_consensus.fna")
+
+
+def test_python_engine_in_spawned_workers(tmp_path):
+    vcfs = []
+    for vcf in sorted(TEST_DIR.glob("*.vcf")):
+        vcfs.append(tmp_path / vcf.name)
+        shutil.copy(vcf, vcfs[-1])
+    consensuses, failures = quick_consensus.make_consensus(
+        vcfs, load_reference(TEST_DIR / "MN908947_3_synthetic.fasta"), 2,
+        consensus_func=vcf_consensus,
+        executor_class=quick_consensus.spawn_executor)
+    assert failures == {}
+    for vcf, consensus in consensuses.items():
+        expected = TEST_DIR / "consensus" / (vcf.name[:-len(".vcf")] +
+                                             ".bcftools.fna")
+        assert consensus.read_bytes() == expected.read_bytes()
@@ -0,0 +1,71 @@
+import shutil
+import sys
+from pathlib import Path
+import pytest
+
+TEST_DIR = Path(__file__).parent
+sys.path.insert(0, str(TEST_DIR.parent))
+
+import vcf_consensus  # noqa: E402
+
+
+# random bases with the REF alleles of test/*.vcf at their positions so
+# bcftools consensus accepts every VCF without bundling MN908947.3
+REFERENCE = TEST_DIR / "MN908947_3_synthetic.fasta"
+VCFS = sorted(TEST_DIR.glob("*.vcf")) + \
+    sorted((TEST_DIR / "consensus").glob("*.vcf"))
+
+
+def expected_consensus(vcf: Path) -> Path:
+    """
+    bcftools consensus output committed for a VCF, see test/consensus
+    """
+    return TEST_DIR / "consensus" / (vcf.name[:-len(".vcf")] +
+                                     ".bcftools.fna")
+
+
+def test_parse_vcf_skips_empty_lines(tmp_path):
+    vcf = tmp_path / "empty_lines.vcf"
+    vcf.write_bytes(b"##fileformat=VCFv4.2\n"
+                    b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+                    b"\n"
+                    b"MN908947.3\t241\t.\tC\tT\t.\tPASS\t.\n"
+                    b"\n\n")
+    assert vcf_consensus.parse_vcf(vcf) == {'MN908947.3': [(241, b'C',
+                                                            b'T')]}
+
+
+def test_parse_vcf_rejects_multiple_samples(tmp_path):
+    vcf = tmp_path / "two_samples.vcf"
+    vcf.write_bytes(b"##fileformat=VCFv4.2\n"
+                    b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\t"
+                    b"FORMAT\ta\tb\n"
+                    b"MN908947.3\t241\t.\tC\tT\t.\tPASS\t.\tGT\t1\t0\n")
+    with pytest.raises(ValueError):
+        vcf_consensus.parse_vcf(vcf)
+
+
+def test_genotype_allele():
+    assert vcf_consensus.genotype_allele(b'G', [b'T'], b'0') is None
+    assert vcf_consensus.genotype_allele(b'G', [b'T'], b'.') is None
+    assert vcf_consensus.genotype_allele(b'G', [b'T', b'C'], b'2') == b'C'
+    assert vcf_consensus.genotype_allele(b'G', [b'T'], b'1/.') == b'T'
+    assert vcf_consensus.genotype_allele(b'G', [b'T'], b'0/1') == b'K'
+    assert vcf_consensus.genotype_allele(b'A', [b'C'], b'0|1') == b'M'
+    assert vcf_consensus.genotype_allele(b'A', [b'AT'], b'0/1') == b'AT'
+
+
+@pytest.mark.parametrize("vcf", VCFS, ids=lambda vcf: vcf.name)
+def test_consensus_matches_committed_bcftools(vcf, tmp_path):
+    consensus = tmp_path / "consensus.fna"
+    vcf_consensus.vcf_consensus(vcf, vcf_consensus.load_reference(REFERENCE),
+                                consensus)
+    assert consensus.read_bytes() == expected_consensus(vcf).read_bytes()
+
+
+@pytest.mark.parametrize("vcf", VCFS, ids=lambda vcf: vcf.name)
+def test_consensus_matches_bcftools(vcf):
+    if shutil.which("bcftools") is None or shutil.which("bgzip") is None:
+        pytest.skip("bcftools and bgzip are needed to compare consensus")
+    reference = vcf_consensus.load_reference(REFERENCE)
+    assert vcf_consensus.compare_bcftools(vcf, REFERENCE, reference)
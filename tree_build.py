@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import instrumentation
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+class Step:
+    """
+    A single pipeline command with the files it reads and writes
+    """
+    def __init__(self, name, command, inputs, outputs):
+        self.name = name
+        self.command = [str(arg) for arg in command]
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+
+    def __repr__(self):
+        return f"Step({self.name})"
+
+
+def build_steps(args) -> list:
+    """
+    Steps for a focused lineage build matching the ncov settings used in
+    tree.sh
+    """
+    ncov = Path(args.ncov_dir)
+    out = Path(args.outdir)
+    seqs = Path(f"{args.prefix}_seqs.fasta")
+    metadata = Path(f"{args.prefix}_metadata.tsv")
+    reference_fasta = ncov / "defaults/reference_seq.fasta"
+    reference_gb = ncov / "defaults/reference_seq.gb"
+    aligned = out / "aligned.fasta"
+    raw_tree = out / "raw_tree.nwk"
+    refined_tree = out / "refined_tree.nwk"
+    branch_lengths = out / "branch_lengths.json"
+    nt_muts = out / "nt_muts.json"
+    aa_muts = out / "aa_muts.json"
+    traits = out / "traits.json"
+    clades = out / "clades.json"
+    colors = out / "colors.tsv"
+    recency = out / "recency.json"
+    threads = args.threads
+
+    extract_inputs = [args.nextmeta, args.nextfasta]
+    extract_command = ["python", Path(__file__).parent / "extract_seqs.py",
+                       "--nextmeta", args.nextmeta,
+                       "--nextfasta", args.nextfasta,
+                       "--query", args.query, "--output_prefix", args.prefix,
+                       "--include_reference",
+                       "--exclude_ambiguous_dates_by", "month",
+                       "--min_length", 2700,
+                       "--mask_from_beginning", 100,
+                       "--mask_from_end", 50]
+    if args.mask_sites is not None:
+        extract_command += ["--mask_sites", args.mask_sites]
+        extract_inputs.append(args.mask_sites)
+    if args.subsample_by:
+        extract_command += ["--subsample_by", *args.subsample_by,
+                            "--max_per_group", args.max_per_group,
+                            "--seed", args.seed]
+    if args.priority_strains is not None:
+        extract_command += ["--priority_strains", args.priority_strains]
+        extract_inputs.append(args.priority_strains)
+
+    steps = [
+        Step("extract", extract_command, extract_inputs, [seqs, metadata]),
+        Step("align",
+             ["augur", "align", "--sequences", seqs, "--nthreads", threads,
+              "--method", "mafft", "--reference-sequence", reference_fasta,
+              "--fill-gaps", "--output", aligned],
+             [seqs, reference_fasta], [aligned]),
+        Step("tree",
+             ["augur", "tree", "--alignment", aligned,
+              "--tree-builder-args", "-ninit 10 -n 4", "--output", raw_tree,
+              "--nthreads", threads],
+             [aligned], [raw_tree]),
+        Step("refine",
+             ["augur", "refine", "--timetree", "--tree", raw_tree,
+              "--alignment", aligned, "--metadata", metadata,
+              "--output-tree", refined_tree,
+              "--output-node-data", branch_lengths,
+              "--root", "Wuhan/Hu-1/2019", "Wuhan/WH01/2019",
+              "--clock-rate", 0.0008, "--clock-std-dev", 0.0004,
+              "--coalescent", "skyline", "--date-inference", "marginal",
+              "--divergence-unit", "mutations", "--date-confidence",
+              "--no-covariance", "--clock-filter-iqd", 4],
+             [raw_tree, aligned, metadata], [refined_tree, branch_lengths]),
+        Step("ancestral",
+             ["augur", "ancestral", "--tree", refined_tree,
+              "--alignment", aligned, "--output-node-data", nt_muts,
+              "--inference", "joint", "--infer-ambiguous"],
+             [refined_tree, aligned], [nt_muts]),
+        Step("translate",
+             ["augur", "translate", "--tree", refined_tree,
+              "--ancestral-sequences", nt_muts,
+              "--reference-sequence", reference_gb,
+              "--output-node-data", aa_muts],
+             [refined_tree, nt_muts, reference_gb], [aa_muts]),
+        Step("traits",
+             ["augur", "traits", "--tree", refined_tree,
+              "--metadata", metadata, "--output", traits,
+              "--columns", "country_exposure", "--confidence",
+              "--sampling-bias-correction", 2.5],
+             [refined_tree, metadata], [traits]),
+        Step("clades",
+             ["augur", "clades", "--tree", refined_tree,
+              "--mutations", nt_muts, aa_muts,
+              "--clades", ncov / "defaults/clades.tsv",
+              "--output-node-data", clades],
+             [refined_tree, nt_muts, aa_muts, ncov / "defaults/clades.tsv"],
+             [clades]),
+        Step("tip_frequencies",
+             ["augur", "frequencies", "--method", "kde",
+              "--metadata", metadata, "--tree", refined_tree,
+              "--min-date", 2020.0, "--pivot-interval", 1,
+              "--narrow-bandwidth", 0.05, "--proportion-wide", 0.0,
+              "--minimal-frequency", 0.01, "--stiffness", 20,
+              "--inertia", 0.2, "--output", out / "tip-frequencies.json"],
+             [metadata, refined_tree], [out / "tip-frequencies.json"]),
+        Step("nuc_frequencies",
+             ["augur", "frequencies", "--method", "diffusion",
+              "--alignments", aligned, "--gene-names", "nuc",
+              "--metadata", metadata, "--tree", refined_tree,
+              "--min-date", 2020.0, "--pivot-interval", 1,
+              "--minimal-frequency", 0.01, "--stiffness", 20,
+              "--inertia", 0.2, "--output", out / "nuc-frequencies.json"],
+             [aligned, metadata, refined_tree],
+             [out / "nuc-frequencies.json"]),
+        Step("colors",
+             ["python", ncov / "scripts/assign-colors.py",
+              "--ordering", ncov / "defaults/color_ordering.tsv",
+              "--color-schemes", ncov / "defaults/color_schemes.tsv",
+              "--output", colors, "--metadata", metadata],
+             [ncov / "defaults/color_ordering.tsv",
+              ncov / "defaults/color_schemes.tsv", metadata], [colors]),
+        Step("recency",
+             ["python",
+              ncov / "scripts/construct-recency-from-submission-date.py",
+              "--metadata", metadata, "--output", recency],
+             [metadata], [recency]),
+        Step("pangolin",
+             ["python", ncov / "scripts/add_pangolin_lineages.py",
+              "--tree", refined_tree, "--output", out / "pangolin.json"],
+             [refined_tree], [out / "pangolin.json"]),
+        Step("export",
+             ["augur", "export", "v2", "--tree", refined_tree,
+              "--metadata", metadata,
+              "--node-data", branch_lengths, nt_muts, aa_muts, clades,
+              traits, recency,
+              "--colors", colors, "--auspice-config", args.auspice_config,
+              "--lat-longs", ncov / "defaults/lat_longs.tsv",
+              "--title", args.title, "--output", out / "auspice.json",
+              "--include-root-sequence"],
+             [refined_tree, metadata, branch_lengths, nt_muts, aa_muts,
+              clades, traits, recency, colors, args.auspice_config,
+              ncov / "defaults/lat_longs.tsv"],
+             [out / "auspice.json"]),
+    ]
+    return steps
+
+
+class PipelineState:
+    """
+    Signatures and timings of completed steps, and cached file hashes so
+    large unchanged inputs aren't rehashed on every run
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.exists():
+            state = json.loads(self.path.read_text())
+        else:
+            state = {}
+        self.steps = state.get('steps', {})
+        self.file_hashes = state.get('file_hashes', {})
+
+    def file_hash(self, path):
+        """
+        Hash a file's contents, reusing the cached hash if the size and
+        modification time are unchanged
+        """
+        stat = path.stat()
+        key = str(path.resolve())
+        cached = self.file_hashes.get(key)
+        if cached and cached['size'] == stat.st_size and \
+                cached['mtime'] == stat.st_mtime:
+            return cached['sha256']
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                file_hash.update(block)
+        self.file_hashes[key] = {'size': stat.st_size,
+                                 'mtime': stat.st_mtime,
+                                 'sha256': file_hash.hexdigest()}
+        return file_hash.hexdigest()
+
+    def signature(self, step):
+        """
+        Hash of a step's command and the contents of its inputs
+        """
+        signature = hashlib.sha256(json.dumps(step.command).encode())
+        for path in step.inputs:
+            signature.update(str(path).encode())
+            signature.update(self.file_hash(path).encode())
+        return signature.hexdigest()
+
+    def is_complete(self, step):
+        """
+        Check if a step has already run with the same command and inputs
+        """
+        if not all(path.exists() for path in step.outputs + step.inputs):
+            return False
+        recorded = self.steps.get(step.name)
+        return recorded is not None and \
+            recorded['signature'] == self.signature(step)
+
+    def record(self, step, elapsed):
+        self.steps[step.name] = {'signature': self.signature(step),
+                                 'seconds': round(elapsed, 2),
+                                 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    def save(self):
+        tmp_path = Path(str(self.path) + ".tmp")
+        tmp_path.write_text(json.dumps({'steps': self.steps,
+                                        'file_hashes': self.file_hashes},
+                                       indent=2))
+        tmp_path.replace(self.path)
+
+
+def dependencies(steps) -> dict:
+    """
+    Get the steps each step depends on from which steps write its inputs
+    """
+    producers = {output: step.name for step in steps
+                 for output in step.outputs}
+    return {step.name: {producers[path] for path in step.inputs
+                        if path in producers}
+            for step in steps}
+
+
+def run_step(step, log_dir, metrics):
+    """
+    Run a step with its stdout/stderr in a log, returning the wall time
+    """
+    for output in step.outputs:
+        output.parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with metrics.stage(step.name), \
+            open(Path(log_dir) / f"{step.name}.log", 'w') as log_fh:
+        subprocess.run(step.command, stdout=log_fh, stderr=subprocess.STDOUT,
+                       check=True)
+    return time.perf_counter() - start
+
+
+def run_pipeline(steps, state, jobs, log_dir, metrics=None):
+    """
+    Run every step whose dependencies are finished, up to jobs at once,
+    skipping steps that are already complete. Returns the failed steps
+    """
+    if metrics is None:
+        metrics = instrumentation.Metrics("tree_build")
+    Path(log_dir).mkdir(parents=True, exist_ok=True)
+    depends_on = dependencies(steps)
+    steps_by_name = {step.name: step for step in steps}
+    done = set()
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            # steps downstream of a failure can't run
+            blocked = set()
+            while True:
+                newly_blocked = {name for name in steps_by_name
+                                 if name not in blocked and
+                                 depends_on[name] & (failed | blocked)}
+                if not newly_blocked:
+                    break
+                blocked |= newly_blocked
+            for name, step in steps_by_name.items():
+                if name in done or name in failed or name in blocked or \
+                        name in running.values() or \
+                        not depends_on[name] <= done:
+                    continue
+                # inputs are only hashed once upstream steps are finished
+                if state.is_complete(step):
+                    print(f"{name}: up to date, skipping")
+                    done.add(name)
+                    continue
+                print(f"{name}: running")
+                running[executor.submit(run_step, step, log_dir,
+                                        metrics)] = name
+
+            if not running:
+                # repeat in case skipped steps unblocked others
+                if all(name in done or name in failed or name in blocked
+                       for name in steps_by_name):
+                    break
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    elapsed = future.result()
+                except Exception as error:
+                    print(f"{name}: failed ({error}), see "
+                          f"{Path(log_dir) / (name + '.log')}")
+                    failed.add(name)
+                    continue
+                print(f"{name}: finished in {elapsed:.1f}s")
+                state.record(steps_by_name[name], elapsed)
+                state.save()
+                done.add(name)
+
+    return failed | {name for name in steps_by_name
+                     if name not in done and name not in failed}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Run the focused lineage tree build, "
+                                     "skipping steps whose inputs and "
+                                     "parameters are unchanged")
+    parser.add_argument('-m', '--nextmeta', type=check_file, required=True,
+                        help="Path to nextmeta file")
+    parser.add_argument('-f', '--nextfasta', type=check_file, required=True,
+                        help="Path to nextfasta file")
+    parser.add_argument("-q", "--query", type=str, required=True,
+                         help="Pandas query e.g., \"pangolin_lineage=='B.1.1.28'\"")
+    parser.add_argument("-p", "--prefix", required=True,
+                        help="Prefix for extracted metadata and seqs")
+    parser.add_argument("--mask_sites", default=None, type=check_file,
+                        help="VCF of problematic sites to mask")
+    parser.add_argument("--subsample_by", nargs="+", default=[],
+                        help="Subsample the extracted genomes within groups "
+                             "of these metadata columns e.g., division month")
+    parser.add_argument("--max_per_group", default=None, type=int,
+                        help="Maximum genomes kept from each --subsample_by "
+                             "group")
+    parser.add_argument("--priority_strains", default=None, type=check_file,
+                        help="File of strain names always kept when "
+                             "subsampling")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Random seed for subsampling")
+    parser.add_argument("--ncov_dir", default="../ncov",
+                        help="Path to ncov repository for defaults/scripts")
+    parser.add_argument("--auspice_config", type=check_file, required=True,
+                        help="Auspice config json for export")
+    parser.add_argument("--title", default="Lineage Build",
+                        help="Title of the auspice build")
+    parser.add_argument("-o", "--outdir", default="augur",
+                        help="Directory for augur outputs")
+    parser.add_argument("-t", "--threads", default=8, type=int,
+                        help="Threads for align and tree steps")
+    parser.add_argument("-j", "--jobs", default=4, type=int,
+                        help="Number of independent steps to run at once")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if bool(args.subsample_by) != (args.max_per_group is not None):
+        parser.error("--subsample_by and --max_per_group must be used "
+                     "together")
+    metrics = instrumentation.from_args("tree_build", args)
+
+    steps = build_steps(args)
+    state = PipelineState(Path(args.outdir) / "pipeline_state.json")
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+    failed = run_pipeline(steps, state, args.jobs,
+                          Path(args.outdir) / "logs", metrics)
+    metrics.close()
+
+    for name, recorded in state.steps.items():
+        print(f"{name}\t{recorded['seconds']}s\t{recorded['finished']}")
+    if failed:
+        print(f"Failed or blocked steps: {', '.join(sorted(failed))}")
+        sys.exit(1)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import instrumentation
+from variant_yaml_to_vcf import parse_yaml, definition_name, find_yamls
+
+
+# uppercase lookup for raw sequence bytes
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[ord('a'): ord('z') + 1] -= 32
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def check_input(path: str) -> Path:
+    """
+    Check an input file or directory exists
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def yaml_variants(yaml_path):
+    """
+    Get (definition, position, ref, alt, gene, amino acid change) for each
+    variant in a PHE variant definition yaml
+    """
+    variant_def = parse_yaml(yaml_path)
+    name = definition_name(variant_def, yaml_path)
+    for variant in variant_def['variants']:
+        yield (name, int(variant['one-based-reference-position']),
+               str(variant['reference-base']).upper(),
+               str(variant['variant-base']).upper(),
+               variant.get('gene'), variant.get('amino-acid-change'))
+
+
+def vcf_variants(vcf_path):
+    """
+    Get variants from a VCF, using the DEF INFO field written by
+    variant_yaml_to_vcf.py for definition names and the file name otherwise
+    """
+    with open(vcf_path) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            line = line.rstrip('\n').split('\t')
+            info = dict(field.split('=', 1) for field in line[7].split(';')
+                        if '=' in field)
+            gene, aa_change = None, None
+            if 'AA' in info:
+                gene, aa_change = info['AA'].split(',')[0].split(':', 1)
+            for name in info.get('DEF', Path(vcf_path).stem).split(','):
+                for alt in line[4].split(','):
+                    yield (name, int(line[1]), line[3].upper(), alt.upper(),
+                           gene, aa_change)
+
+
+class CompiledDefinitions:
+    """
+    Variant definitions compiled into position-indexed arrays of expected
+    reference and alt bases for vectorised typing
+    """
+    def __init__(self, variants):
+        self.columns = []
+        self.call_values = []
+        self.definitions = []
+        self.variant_definitions = []
+        expected = {}
+
+        for name, position, ref, alt, gene, aa_change in variants:
+            if name not in self.definitions:
+                self.definitions.append(name)
+
+            if len(ref) > len(alt):
+                # deletion anchored on the preceding base as in VCF
+                start = position + len(alt)
+                length = len(ref) - len(alt)
+                column = f"del:{start}:{length}"
+                positions = list(range(start - 1, start - 1 + length))
+                ref_bases = ref[len(alt):]
+                alt_bases = '-' * length
+                values = ('del', 'ref')
+            elif len(ref) < len(alt):
+                sys.stderr.write(f"Skipping insertion {ref}{position}{alt}, "
+                                 "can't be typed from a reference "
+                                 "alignment\n")
+                continue
+            else:
+                positions = list(range(position - 1, position - 1 + len(ref)))
+                ref_bases = ref
+                alt_bases = alt
+                if gene is not None and aa_change is not None:
+                    column = f"aa:{gene}:{aa_change}"
+                    values = (aa_change[-1], aa_change[0])
+                else:
+                    column = f"snp:{ref}{position}{alt}"
+                    values = (alt[-1], ref[-1])
+
+            if column not in expected:
+                expected[column] = (positions, ref_bases, alt_bases)
+                self.columns.append(column)
+                self.call_values.append(values)
+                self.variant_definitions.append(set())
+            self.variant_definitions[self.columns.index(column)].add(name)
+
+        max_length = max([len(expected[column][0]) for column in self.columns],
+                         default=1)
+        shape = (len(self.columns), max_length)
+        positions = np.zeros(shape, dtype=np.int64)
+        # padding positions always match so don't affect calls
+        self.padding = np.ones(shape, dtype=bool)
+        self.ref = np.zeros(shape, dtype=np.uint8)
+        self.alt = np.zeros(shape, dtype=np.uint8)
+        for ix, column in enumerate(self.columns):
+            variant_positions, ref_bases, alt_bases = expected[column]
+            length = len(variant_positions)
+            positions[ix, :length] = variant_positions
+            self.padding[ix, :length] = False
+            self.ref[ix, :length] = np.frombuffer(ref_bases.encode(),
+                                                  dtype=np.uint8)
+            self.alt[ix, :length] = np.frombuffer(alt_bases.encode(),
+                                                  dtype=np.uint8)
+
+        # each distinct alignment column is only read once per genome
+        self.positions, self.position_index = np.unique(positions,
+                                                        return_inverse=True)
+        self.position_index = self.position_index.reshape(shape)
+
+        # membership matrix of definition x variant
+        self.membership = np.array([[name in names
+                                     for names in self.variant_definitions]
+                                    for name in self.definitions],
+                                   dtype=np.int32).reshape(
+                                       len(self.definitions),
+                                       len(self.columns))
+
+    def call(self, bases):
+        """
+        Call each variant for a (genomes x compiled positions) array of
+        bases, returns 1 for alt, 0 for ref, and -1 for anything else
+        """
+        bases = UPPER[bases][:, self.position_index]
+        is_alt = ((bases == self.alt) | self.padding).all(axis=2)
+        is_ref = ((bases == self.ref) | self.padding).all(axis=2)
+        calls = np.full(is_alt.shape, -1, dtype=np.int8)
+        calls[is_ref] = 0
+        calls[is_alt] = 1
+        return calls
+
+
+def index_fasta(fasta_path):
+    """
+    Get the name, sequence offset, length, bases per line and bytes per
+    line of each record, using a samtools .fai index if one exists
+    """
+    fai_path = Path(str(fasta_path) + ".fai")
+    if fai_path.exists():
+        index = pd.read_csv(fai_path, sep='\t', header=None,
+                            names=['name', 'length', 'offset', 'linebases',
+                                   'linewidth'],
+                            usecols=range(5), dtype={'name': str})
+        return index
+
+    records = []
+    offset = 0
+    with open(fasta_path, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                records.append({'name': line[1:].split()[0].decode('utf-8'),
+                                'length': 0,
+                                'offset': offset + len(line),
+                                'linebases': 0,
+                                'linewidth': 0})
+            elif records:
+                record = records[-1]
+                if record['linebases'] == 0:
+                    record['linebases'] = len(line.rstrip(b'\r\n'))
+                    record['linewidth'] = len(line)
+                record['length'] += len(line.rstrip(b'\r\n'))
+            offset += len(line)
+    return pd.DataFrame(records, columns=['name', 'length', 'offset',
+                                          'linebases', 'linewidth'])
+
+
+def type_alignment(alignment_path, compiled, chunksize=10000):
+    """
+    Type every genome in a reference-coordinate alignment against the
+    compiled definitions, yielding a dataframe of calls per chunk of
+    genomes
+    """
+    index = index_fasta(alignment_path)
+    alignment = np.memmap(alignment_path, dtype=np.uint8, mode='r')
+    positions = compiled.positions
+
+    for start in range(0, len(index), chunksize):
+        chunk = index.iloc[start: start + chunksize]
+        offsets = chunk['offset'].to_numpy()[:, None]
+        linebases = np.maximum(chunk['linebases'].to_numpy(), 1)[:, None]
+        newline_bytes = (chunk['linewidth'] - chunk['linebases']).to_numpy()[:, None]
+        # byte offset of each position accounting for line wrapping
+        byte_offsets = offsets + positions + \
+            (positions // linebases) * newline_bytes
+        beyond_end = positions >= chunk['length'].to_numpy()[:, None]
+        byte_offsets[beyond_end] = 0
+        bases = alignment[byte_offsets]
+        bases[beyond_end] = ord('N')
+
+        calls = compiled.call(bases)
+
+        genotypes = {'query': chunk['name'].to_numpy()}
+        for ix, column in enumerate(compiled.columns):
+            alt_value, ref_value = compiled.call_values[ix]
+            genotypes[column] = np.where(calls[:, ix] == 1, alt_value,
+                                         np.where(calls[:, ix] == 0,
+                                                  ref_value, 'X'))
+
+        # per definition counts of alt, ref and other calls
+        counts = {}
+        for call_value, label in [(1, 'alt'), (0, 'ref'), (-1, 'other')]:
+            call_counts = (calls == call_value).astype(np.int32) @ \
+                compiled.membership.T
+            for ix, name in enumerate(compiled.definitions):
+                counts[f"{name}_{label}_count"] = call_counts[:, ix]
+
+        yield pd.DataFrame({**{'query': genotypes.pop('query')}, **counts,
+                            **genotypes})
+
+
+def load_definitions(inputs):
+    """
+    Compile variants from yaml and VCF definition files
+    """
+    variants = []
+    for path in find_yamls(inputs):
+        if path.suffix == '.vcf':
+            variants.extend(vcf_variants(path))
+        else:
+            variants.extend(yaml_variants(path))
+    return CompiledDefinitions(variants)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Type aligned genomes against variant "
+                                     "definitions in type_variants csv format")
+    parser.add_argument("-a", "--alignment", required=True, type=check_file,
+                        help="Fasta of genomes aligned to MN908947.3 "
+                             "coordinates (e.g., augur align output)")
+    parser.add_argument("-d", "--definitions", required=True, nargs="+",
+                        type=check_input,
+                        help="PHE variant definition yamls, directories of "
+                             "them, or VCFs")
+    parser.add_argument("-o", "--output", default="variant_types.csv",
+                        help="Output csv in type_variants format")
+    parser.add_argument("-c", "--chunksize", default=10000, type=int,
+                        help="Number of genomes typed at once")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("type_genomes", args)
+
+    with metrics.stage("load_definitions") as stage:
+        compiled = load_definitions(args.definitions)
+        stage['rows'] = len(compiled.columns)
+
+    header = True
+    with metrics.stage("type") as stage, open(args.output, 'w') as out_fh:
+        stage['rows'] = 0
+        for typed in type_alignment(args.alignment, compiled,
+                                    args.chunksize):
+            typed.to_csv(out_fh, index=False, header=header)
+            header = False
+            stage['rows'] += len(typed)
+    metrics.close()
@@ -1,16 +1,16 @@
 #!/usr/bin/env python
 from pathlib import Path
 import pandas as pd
-import upsetplot
-from upset_plotly import plot
 import argparse
 import os
+import instrumentation
 
 
-def parse_type_variant(input_file: Path) -> upsetplot.UpSet:
+def parse_type_variant(input_file: Path) -> pd.DataFrame:
     """
     Parse the output csv from type_variant
     """
+    import upsetplot
     variants = pd.read_csv(input_file, sep=',')
 
     variant_sets = {}
@@ -46,10 +46,11 @@ def parse_type_variant(input_file: Path) -> upsetplot.UpSet:
     return variant_sets
 
 
-def parse_ncov_watch(input_file: Path) -> upsetplot.UpSet:
+def parse_ncov_watch(input_file: Path) -> pd.DataFrame:
     """
     Parse output from ncov_watch
     """
+    import upsetplot
     variants = pd.read_csv(input_file, sep='\t')
     variant_sets = {}
     variant_sets = variants.groupby('mutation')['sample'].apply(list).to_dict()
@@ -61,6 +62,8 @@ def variant_intersections(input_file: Path, input_type: str, output_path: Path):
     """
     Parse input and generate a plot using the upset_plotly library
     """
+    # plotting libraries are slow to import so only load them when plotting
+    from upset_plotly import plot
 
     if input_type == 'type_variants':
         variant_sets = parse_type_variant(input_file)
@@ -120,8 +123,12 @@ if __name__ == '__main__':
                         type=check_output_suffix,
                         help="Output file name (ending in .html for an "
                              "interactive plot or .png for static image)")
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
-    variant_intersections(args.input, args.type,
-                          args.output)
+    metrics = instrumentation.from_args("variant_intersections", args)
+    with metrics.stage("plot"):
+        variant_intersections(args.input, args.type,
+                              args.output)
+    metrics.close()
 
@@ -1,9 +1,20 @@
 #!/usr/bin/env python
 
 import yaml
-import pyvcf
 import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+
+# use the libyaml C parser when available as it is much faster
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+REFERENCE_NAME = "MN908947.3"
+REFERENCE_LENGTH = 29903
 
 
 def check_file(path: str) -> Path:
@@ -17,35 +28,184 @@ def check_file(path: str) -> Path:
         raise argparse.ArgumentTypeError(f"{path} can't be read")
 
 
+def check_input(path: str) -> Path:
+    """
+    Check an input file or directory of yaml files exists
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
 def parse_yaml(yaml_path: Path) -> dict:
     """
     Read and parse the variant yaml into a dictionary
     """
     with open(yaml_path) as fh:
-        yaml_variant = yaml.load(fh)
+        yaml_variant = yaml.load(fh, Loader=YamlLoader)
     return yaml_variant
 
 
-def generate_vcf(variant_def: dict) -> vcf.Reader:
+def parse_reference(fasta_path: Path) -> str:
     """
+    Read the reference genome sequence from a single record fasta
+    """
+    with open(fasta_path) as fh:
+        return "".join(line.strip() for line in fh
+                       if not line.startswith('>')).upper()
+
 
+def definition_name(variant_def: dict, yaml_path: Path) -> str:
     """
+    Get the label for a variant definition, falling back to the file name
+    """
+    for key in ['phe-label', 'unique-id']:
+        if variant_def.get(key):
+            return str(variant_def[key])
+    return Path(yaml_path).stem
 
 
+def generate_vcf(variant_def: dict, name: str, reference=None) -> list:
+    """
+    Convert the variants in a definition to sorted VCF records as
+    (position, ref, alt, info) tuples, checking reference bases against the
+    reference genome if provided
+    """
+    records = []
+    for variant in variant_def['variants']:
+        position = int(variant['one-based-reference-position'])
+        ref = str(variant['reference-base']).upper()
+        alt = str(variant['variant-base']).upper()
 
+        if reference is not None:
+            reference_bases = reference[position - 1: position - 1 + len(ref)]
+            if reference_bases != ref:
+                raise ValueError(f"{name}: reference base {ref} at {position} "
+                                 f"doesn't match reference {reference_bases}")
 
+        info = {'DEF': name, 'TYPE': variant['type']}
+        if 'gene' in variant and 'amino-acid-change' in variant:
+            info['AA'] = f"{variant['gene']}:{variant['amino-acid-change']}"
+        records.append((position, ref, alt, info))
 
-if __name__ == '__main__':
+    return sorted(records, key=lambda record: record[:3])
 
-    parser = argparse.ArgumentParser("Convert PHE ncov yaml variant definitions to VCF format")
-    parser.add_argument("-i", "--input", required=True, type=check_file,
-                         help="Path to PHE genomics variant definition YAML file")
 
-    # if output name isn't supplied then
-    #parser.add_argument("-o", "--output", default=
+def convert_yaml(yaml_path: Path, reference=None) -> list:
+    """
+    Parse a single yaml definition into VCF records
+    """
+    variant_def = parse_yaml(yaml_path)
+    return generate_vcf(variant_def, definition_name(variant_def, yaml_path),
+                        reference)
 
-    args = parser.parse_args()
 
-    parse_yaml(args.input)
+def combine_records(record_sets: list) -> list:
+    """
+    Merge records from several definitions so each variant appears once,
+    listing every definition it belongs to
+    """
+    combined = {}
+    for records in record_sets:
+        for position, ref, alt, info in records:
+            key = (position, ref, alt)
+            if key not in combined:
+                combined[key] = {'DEF': [], 'TYPE': info['TYPE'], 'AA': []}
+            if info['DEF'] not in combined[key]['DEF']:
+                combined[key]['DEF'].append(info['DEF'])
+            if 'AA' in info and info['AA'] not in combined[key]['AA']:
+                combined[key]['AA'].append(info['AA'])
+    return [(position, ref, alt, combined[(position, ref, alt)])
+            for position, ref, alt in sorted(combined)]
+
+
+def format_info(info: dict) -> str:
+    """
+    Format an INFO dict as a VCF INFO column
+    """
+    fields = []
+    for key, value in info.items():
+        if isinstance(value, list):
+            if not value:
+                continue
+            value = ",".join(value)
+        fields.append(f"{key}={value}")
+    return ";".join(fields) if fields else "."
+
+
+def write_vcf(records: list, output: Path, reference_name=REFERENCE_NAME,
+              reference_length=REFERENCE_LENGTH):
+    """
+    Write VCF records to a file
+    """
+    with open(output, 'w') as out_fh:
+        out_fh.write("##fileformat=VCFv4.2\n")
+        out_fh.write(f"##contig=<ID={reference_name},"
+                     f"length={reference_length}>\n")
+        out_fh.write('##INFO=<ID=DEF,Number=.,Type=String,'
+                     'Description="Variant definitions containing variant">\n')
+        out_fh.write('##INFO=<ID=TYPE,Number=1,Type=String,'
+                     'Description="Variant type in definition">\n')
+        out_fh.write('##INFO=<ID=AA,Number=.,Type=String,'
+                     'Description="Amino acid change in definition">\n')
+        out_fh.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for position, ref, alt, info in records:
+            out_fh.write(f"{reference_name}\t{position}\t.\t{ref}\t{alt}\t.\t"
+                         f"PASS\t{format_info(info)}\n")
+
+
+def find_yamls(inputs: list) -> list:
+    """
+    Expand any directories in the inputs into the yaml files they contain
+    """
+    yaml_paths = []
+    for path in inputs:
+        if path.is_dir():
+            yaml_paths.extend(sorted(list(path.glob("*.yml")) +
+                                     list(path.glob("*.yaml"))))
+        else:
+            yaml_paths.append(path)
+    return yaml_paths
+
 
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Convert PHE ncov yaml variant definitions to VCF format")
+    parser.add_argument("-i", "--input", required=True, nargs="+",
+                        type=check_input,
+                        help="Paths to PHE genomics variant definition YAML "
+                             "files or directories containing them")
+    parser.add_argument("-o", "--output", default="variant_definitions.vcf",
+                        help="Output VCF combining all definitions")
+    parser.add_argument("-r", "--reference", default=None, type=check_file,
+                        help="MN908947.3 reference fasta to check reference "
+                             "bases against")
+    parser.add_argument("-t", "--threads", default=4, type=int,
+                        help="Number of definition files to parse at once")
+    instrumentation.add_arguments(parser)
 
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("variant_yaml_to_vcf", args)
+
+    reference = None
+    reference_length = REFERENCE_LENGTH
+    if args.reference is not None:
+        with metrics.stage("load_reference"):
+            reference = parse_reference(args.reference)
+        reference_length = len(reference)
+
+    yaml_paths = find_yamls(args.input)
+    with metrics.stage("convert", rows=len(yaml_paths)):
+        with ProcessPoolExecutor(max_workers=args.threads) as executor:
+            record_sets = list(executor.map(convert_yaml, yaml_paths,
+                                            [reference] * len(yaml_paths)))
+
+    with metrics.stage("write") as stage:
+        records = combine_records(record_sets)
+        write_vcf(records, args.output, reference_length=reference_length)
+        stage['rows'] = len(records)
+    metrics.close()
+    print(f"Wrote {len(records)} variants from {len(yaml_paths)} definitions "
+          f"to {args.output}")
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import argparse
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+import instrumentation
+from fasta_reader import read_fasta
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+def load_reference(fasta_path: Path) -> dict:
+    """
+    Load reference contigs as {name: (header, sequence bytes)}
+    """
+    return {header.split()[0].decode('utf-8'): (b'>' + header, seq)
+            for header, seq in read_fasta(fasta_path)}
+
+
+IUPAC = {frozenset(bases.encode('utf-8')): code.encode('utf-8')
+         for bases, code in [('AG', 'R'), ('CT', 'Y'), ('CG', 'S'),
+                             ('AT', 'W'), ('GT', 'K'), ('AC', 'M'),
+                             ('CGT', 'B'), ('AGT', 'D'), ('ACT', 'H'),
+                             ('ACG', 'V'), ('ACGT', 'N')]}
+
+
+def genotype_allele(ref: bytes, alts: list, genotype: bytes):
+    """
+    Allele to apply for a sample's GT as bcftools consensus does with a
+    single sample VCF: nothing for reference or missing calls, otherwise the
+    called ALT, with heterozygous calls of equal length alleles given as
+    IUPAC codes
+    """
+    alleles = [ref] + alts
+    called = [int(ix) for ix in genotype.replace(b'|', b'/').split(b'/')
+              if ix != b'.']
+    non_ref = [ix for ix in called if ix != 0]
+    if not non_ref:
+        return None
+    called = sorted(set(called))
+    if len(called) == 1 or \
+            len({len(alleles[ix]) for ix in called}) > 1:
+        return alleles[non_ref[0]]
+    return bytes(IUPAC.get(frozenset(bases), b'N')[0]
+                 if len(set(bases)) > 1 else bases[0]
+                 for bases in zip(*[alleles[ix].upper() for ix in called]))
+
+
+def parse_vcf(vcf_path: Path) -> dict:
+    """
+    Get variants from a VCF as {contig: [(position, ref, alt)]} sorted by
+    position, as with bcftools consensus without --samples the first ALT
+    allele is applied or if the VCF has a single sample its genotype is
+    """
+    variants = {}
+    with open(vcf_path, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'#CHROM'):
+                samples = len(line.rstrip(b'\r\n').split(b'\t')) - 9
+                if samples > 1:
+                    raise ValueError(f"{vcf_path}: has {samples} samples, "
+                                     "only VCFs with one or no samples are "
+                                     "supported")
+            if line.startswith(b'#') or not line.strip():
+                continue
+            fields = line.rstrip(b'\r\n').split(b'\t')
+            contig, position, _, ref, alts = fields[:5]
+            alts = alts.split(b',')
+            if len(fields) > 9 and fields[8].startswith(b'GT'):
+                alt = genotype_allele(ref, alts, fields[9].split(b':')[0])
+            else:
+                alt = alts[0]
+            # skip symbolic, missing and reference-only alleles
+            if alt is None or alt.startswith(b'<') or alt in (b'*', b'.') \
+                    or alt == ref:
+                continue
+            variants.setdefault(contig.decode('utf-8'), []).append(
+                (int(position), ref, alt))
+    for contig_variants in variants.values():
+        contig_variants.sort(key=lambda variant: variant[0])
+    return variants
+
+
+def apply_variants(sequence: bytes, variants: list, vcf_path=None) -> bytes:
+    """
+    Apply sorted variants to a reference sequence, tracking the offset
+    introduced by indels, variants overlapping an already applied variant
+    are skipped except (as in bcftools) an indel anchored on the last base
+    of a variant that wasn't an insertion, which is applied after its anchor
+    """
+    consensus = bytearray(sequence)
+    offset = 0
+    last_end = 0
+    last_insertion = False
+    for position, ref, alt in variants:
+        start = position - 1
+        if start == last_end - 1 and len(ref) != len(alt) and \
+                not last_insertion:
+            start, ref, alt = start + 1, ref[1:], alt[1:]
+        elif start < last_end:
+            sys.stderr.write(f"{vcf_path}: variant at {position} overlaps "
+                             "another variant, skipping\n")
+            continue
+        ref_bases = sequence[start: start + len(ref)]
+        if ref_bases.upper() != ref.upper():
+            raise ValueError(f"{vcf_path}: REF {ref.decode('utf-8')} at "
+                             f"{position} doesn't match the reference "
+                             f"{ref_bases.decode('utf-8')}")
+        consensus[start + offset: start + offset + len(ref)] = alt
+        offset += len(alt) - len(ref)
+        last_end = start + len(ref)
+        last_insertion = len(alt) > len(ref)
+    return bytes(consensus)
+
+
+def write_fasta(out_fh, header: bytes, sequence: bytes, line_width=60):
+    """
+    Write a fasta record wrapped at the same width as bcftools
+    """
+    out_fh.write(header + b'\n')
+    for start in range(0, len(sequence), line_width):
+        out_fh.write(sequence[start: start + line_width] + b'\n')
+
+
+def vcf_consensus(vcf: Path, reference: dict, consensus: Path):
+    """
+    Write the consensus for a VCF against the loaded reference
+    """
+    variants = parse_vcf(vcf)
+    missing = set(variants) - set(reference)
+    if missing:
+        raise ValueError(f"{vcf}: contigs {', '.join(sorted(missing))} not "
+                         "in reference")
+    tmp_consensus = Path(str(consensus) + ".tmp")
+    with open(tmp_consensus, 'wb') as out_fh:
+        for contig, (header, sequence) in reference.items():
+            write_fasta(out_fh, header,
+                        apply_variants(sequence, variants.get(contig, []),
+                                       vcf))
+    tmp_consensus.replace(consensus)
+
+
+def compare_bcftools(vcf: Path, reference_path: Path, reference: dict) -> bool:
+    """
+    Check the in-process consensus matches bcftools consensus for a VCF
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        python_consensus = Path(tmp_dir) / "python.fna"
+        vcf_consensus(vcf, reference, python_consensus)
+
+        vcf_gz = Path(tmp_dir) / (vcf.name + ".gz")
+        with open(vcf_gz, 'wb') as out_fh:
+            subprocess.run(["bgzip", "-c", str(vcf)], stdout=out_fh,
+                           check=True)
+        subprocess.run(["bcftools", "index", str(vcf_gz)], check=True)
+        bcftools_consensus = subprocess.run(["bcftools", "consensus",
+                                             "--fasta-ref",
+                                             str(reference_path),
+                                             str(vcf_gz)],
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL,
+                                            check=True).stdout
+
+        def sequence(fasta):
+            return b''.join(line.strip() for line in fasta.splitlines()
+                            if not line.startswith(b'>')).upper()
+
+        return sequence(python_consensus.read_bytes()) == \
+            sequence(bcftools_consensus)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Check the in-process consensus engine "
+                                     "used by quick_consensus.py --engine "
+                                     "python matches bcftools consensus")
+    parser.add_argument("-r", "--reference", required=True, type=check_file,
+                        help="MN908947.3 reference fasta")
+    parser.add_argument("vcfs", nargs="+", type=check_file,
+                        help="VCFs to compare e.g., test/*.vcf")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("vcf_consensus", args)
+
+    reference = load_reference(args.reference)
+
+    with metrics.stage("compare", rows=len(args.vcfs)):
+        mismatched = [vcf for vcf in args.vcfs
+                      if not compare_bcftools(vcf, args.reference, reference)]
+    metrics.close()
+    for vcf in mismatched:
+        print(f"{vcf}: consensus differs from bcftools")
+    print(f"{len(args.vcfs) - len(mismatched)}/{len(args.vcfs)} "
+          "consensus genomes match bcftools")
+    sys.exit(1 if mismatched else 0)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import argparse
+import hmac
+import io
+import json
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import summarise_ivar
+import convert_variant_watchlists
+import pho_reporting
+import instrumentation
+from service_client import DEFAULT_ADDRESS, token_file, write_token
+
+
+def check_file(path: str) -> Path:
+    """
+    Check an input file exists and is readable
+    """
+    path = Path(path)
+    if path.exists() and path.is_file():
+        return path
+    else:
+        raise argparse.ArgumentTypeError(f"{path} can't be read")
+
+
+class ReferenceMismatch(ValueError):
+    """
+    A job asked for a different reference than the one the service loaded
+    """
+
+
+class WarmState:
+    """
+    References loaded once when the service starts and shared by all jobs
+    """
+    def __init__(self, reference_gff, ref_gbk=None, reference=None,
+                 threads=4):
+        self.reference_gff = Path(reference_gff).resolve()
+        self.gff_features = summarise_ivar.load_gff_features(reference_gff)
+
+        self.ref_gbk = None
+        self.genbank = None
+        if ref_gbk is not None:
+            self.ref_gbk = Path(ref_gbk).resolve()
+            self.genbank = convert_variant_watchlists.parse_genbank(ref_gbk)
+
+        self.reference = None
+        self.minimap2_index = None
+        if reference is not None:
+            self.reference = Path(reference).resolve()
+            self.index_dir = tempfile.TemporaryDirectory()
+            self.minimap2_index = Path(self.index_dir.name) / "reference.mmi"
+            subprocess.run(["minimap2", "-x", "asm5", "-t", str(threads),
+                            "-d", str(self.minimap2_index),
+                            str(reference)],
+                           stderr=subprocess.PIPE, check=True)
+
+    def status(self):
+        return {'reference_gff': str(self.reference_gff),
+                'ref_gbk': str(self.ref_gbk) if self.ref_gbk else None,
+                'reference': str(self.reference) if self.reference else None}
+
+
+def local_path(params, path) -> Path:
+    """
+    Path from a client relative to the client's working directory
+    """
+    return Path(params['cwd']) / path
+
+
+def check_reference(params, loaded, name):
+    """
+    Only use the warm reference if it is the one the job asked for
+    """
+    requested = params[name]
+    if loaded is None or local_path(params, requested).resolve() != loaded:
+        raise ReferenceMismatch(f"service has {name} {loaded} not "
+                                f"{requested}")
+
+
+def summarise_ivar_job(state, params):
+    check_reference(params, state.reference_gff, 'reference_gff')
+    # isolates are named by the paths as the client gave them
+    isolates = {str(local_path(params, path)): path
+                for path in params['input']}
+    results = summarise_ivar.parse_inputs(list(isolates), state.gff_features)
+    results.index = results.index.map(isolates)
+    results = results.sort_values('isolate')
+    return summarise_ivar.generate_output(results, params['output_type'],
+                                          local_path(params,
+                                                     params['tsv_path']))
+
+
+def convert_watchlist_job(state, params):
+    check_reference(params, state.ref_gbk, 'ref_gbk')
+    output = io.StringIO()
+    convert_variant_watchlists.convert(local_path(params, params['input']),
+                                       params['input_type'], state.genbank,
+                                       output)
+    return output.getvalue()
+
+
+def completeness_job(state, params):
+    check_reference(params, state.reference, 'reference')
+    completeness = pho_reporting.genome_completeness(
+        local_path(params, params['input_genomes']), state.minimap2_index,
+        params['threads'])
+    return completeness.to_dict('list')
+
+
+JOBS = {'summarise_ivar': summarise_ivar_job,
+        'convert_watchlist': convert_watchlist_job,
+        'completeness': completeness_job}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    GET /status for the loaded references, POST /jobs/<job> with JSON
+    parameters to run a job in the worker pool, every request needs the
+    service's token as a bearer token
+    """
+    def authorised(self):
+        supplied = self.headers.get('Authorization', '')
+        if hmac.compare_digest(supplied.encode('utf-8'),
+                               f"Bearer {self.server.token}".encode('utf-8')):
+            return True
+        self.send_json(401, {'error': "missing or invalid token"})
+        return False
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.authorised():
+            return
+        if self.path == '/status':
+            self.send_json(200, self.server.state.status())
+        else:
+            self.send_json(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if not self.authorised():
+            return
+        job = self.path[len('/jobs/'):] if self.path.startswith('/jobs/') \
+            else None
+        if job not in JOBS:
+            self.send_json(404, {'error': f"unknown job {self.path}"})
+            return
+        try:
+            params = json.loads(self.rfile.read(
+                int(self.headers.get('Content-Length', 0))))
+        except ValueError as error:
+            self.send_json(400, {'error': f"invalid job parameters: {error}"})
+            return
+        if not isinstance(params, dict):
+            self.send_json(400, {'error': "job parameters must be a JSON "
+                                          "object"})
+            return
+        future = self.server.executor.submit(self.server.run_job, job,
+                                             params)
+        try:
+            self.send_json(200, {'result': future.result()})
+        except ReferenceMismatch as error:
+            self.send_json(409, {'error': str(error)})
+        except (Exception, SystemExit) as error:
+            self.send_json(500, {'error': f"{type(error).__name__}: {error}"})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("Keep references loaded and run "
+                                     "summarise_ivar, convert_variant_"
+                                     "watchlists, and pho_reporting "
+                                     "completeness jobs for those scripts")
+    parser.add_argument("-a", "--address", default=DEFAULT_ADDRESS,
+                        help="localhost host:port to listen on (clients use "
+                             "COVID_SCRIPTS_SERVICE if it isn't the default)")
+    parser.add_argument("-w", "--workers", default=4, type=int,
+                        help="Number of jobs to run at once")
+    parser.add_argument("-r", "--reference_gff",
+                        default='data/MN908947_3.gff3', type=check_file,
+                        help="MN908947.3 gff3 for summarise_ivar jobs")
+    parser.add_argument("-g", "--ref_gbk", default=None, type=check_file,
+                        help="MN908947.3 genbank for "
+                             "convert_variant_watchlists jobs")
+    parser.add_argument("-f", "--reference", default=None, type=check_file,
+                        help="MN908947.3 fasta for pho_reporting "
+                             "completeness jobs (indexed once with minimap2)")
+    parser.add_argument("-t", "--threads", default=4, type=int,
+                        help="Threads for building the minimap2 index")
+    parser.add_argument("--token_file", default=token_file(),
+                        help="File the service writes its access token to, "
+                             "readable only by you, which clients read it "
+                             "from (clients use COVID_SCRIPTS_SERVICE_TOKEN_FILE "
+                             "if it isn't the default)")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = instrumentation.from_args("worker_service", args)
+
+    host, port = args.address.rsplit(':', 1)
+    if host not in ['127.0.0.1', 'localhost', '::1']:
+        parser.error("the service only listens on localhost")
+
+    with metrics.stage("load_references"):
+        state = WarmState(args.reference_gff, args.ref_gbk, args.reference,
+                          args.threads)
+
+    def run_job(job, params):
+        with metrics.stage(job):
+            return JOBS[job](state, params)
+
+    server = ThreadingHTTPServer((host, int(port)), ServiceHandler)
+    server.state = state
+    server.run_job = run_job
+    server.token = write_token(args.token_file)
+    server.executor = ThreadPoolExecutor(max_workers=args.workers)
+    print(f"Worker service listening on {args.address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown()
+        server.server_close()
+        metrics.close()